@@ -0,0 +1,477 @@
+import json
+import os
+import pickle
+import signal
+import sqlite3
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import query_agent
+from local_formatter import serialize_rows
+from session_store import SessionStore
+from single_flight import prometheus_lines
+from sql import pool_metrics, pooled_connection, run_query_bounded
+from tracing import span, tracer
+
+API_WORKERS = int(os.getenv("api_workers", "1"))
+API_THREADS = int(os.getenv("api_threads", "8"))
+API_QUEUE_SIZE = int(os.getenv("api_queue_size", "64"))
+API_QUEUE_TIMEOUT = float(os.getenv("api_queue_timeout", "10"))
+API_SESSION_DB = os.getenv("api_session_db", "api_sessions.db")
+API_SESSION_TTL = float(os.getenv("api_session_ttl", "86400"))
+MAX_BODY_BYTES = 64 * 1024
+SAVE_ATTEMPTS = 3
+
+
+class Overloaded(Exception):
+    """Raised when a request cannot be admitted: the queue is full or the wait timed out."""
+
+
+class SessionConflict(Exception):
+    """Raised when a turn could not be saved because other workers kept updating the session."""
+
+
+class Admission:
+    """
+    Backpressure for one worker process: at most `max_active` requests run at once and
+    at most `max_queued` wait for a slot (up to `timeout` seconds); anything beyond
+    that is turned away immediately with 503 instead of piling up threads.
+    """
+
+    def __init__(self, max_active=API_THREADS, max_queued=API_QUEUE_SIZE, timeout=API_QUEUE_TIMEOUT):
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_active)
+        self._lock = threading.Lock()
+        self.active = 0
+        self.queued = 0
+        self.stats = {"admitted": 0, "rejected_full": 0, "rejected_timeout": 0, "wait_time_total": 0.0}
+
+    def acquire(self):
+        with self._lock:
+            if self.queued >= self.max_queued:
+                self.stats["rejected_full"] += 1
+                raise Overloaded("request queue is full")
+            self.queued += 1
+        started = time.monotonic()
+        acquired = self._slots.acquire(timeout=self.timeout)
+        with self._lock:
+            self.queued -= 1
+            if not acquired:
+                self.stats["rejected_timeout"] += 1
+                raise Overloaded(f"no worker free after {self.timeout:g}s")
+            self.active += 1
+            self.stats["admitted"] += 1
+            self.stats["wait_time_total"] += time.monotonic() - started
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+        self._slots.release()
+
+    def metrics(self):
+        with self._lock:
+            return dict(self.stats, active=self.active, queued=self.queued, max_active=self.max_active,
+                        max_queued=self.max_queued)
+
+
+class SessionDB:
+    """
+    Server-side SessionStores by session id in a SQLite file shared by all worker
+    processes (WAL mode). Each row carries a version; a save that lost a race with
+    another worker returns False so the caller can reload and apply its turn again.
+    """
+
+    def __init__(self, path=API_SESSION_DB, ttl=API_SESSION_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        self._last_purge = 0.0
+
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None or getattr(self._local, "pid", None) != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS sessions (
+                    id TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL,
+                    data BLOB NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            db.commit()
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    def load(self, session_id):
+        """Return (session, version); a new empty session with version 0 when the id is unknown or expired."""
+        row = self._db().execute("SELECT version, data, updated_at FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        if row is None or time.time() - row[2] > self.ttl:
+            return SessionStore(), 0
+        return pickle.loads(row[1]), row[0]
+
+    def save(self, session_id, session, version):
+        """Store `session` if nobody saved it since `version` was loaded; False on a conflict."""
+        db = self._db()
+        data = pickle.dumps(session, protocol=pickle.HIGHEST_PROTOCOL)
+        now = time.time()
+        if version == 0:
+            cur = db.execute(
+                "INSERT INTO sessions VALUES (?, 1, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET version = 1, data = excluded.data, updated_at = excluded.updated_at "
+                "WHERE sessions.updated_at < ?",
+                (session_id, data, now, now - self.ttl),
+            )
+        else:
+            cur = db.execute(
+                "UPDATE sessions SET version = version + 1, data = ?, updated_at = ? WHERE id = ? AND version = ?",
+                (data, now, session_id, version),
+            )
+        db.commit()
+        self._purge(now)
+        return cur.rowcount == 1
+
+    def delete(self, session_id):
+        db = self._db()
+        cur = db.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+        db.commit()
+        return cur.rowcount == 1
+
+    def _purge(self, now):
+        if now - self._last_purge < 600:
+            return
+        self._last_purge = now
+        db = self._db()
+        db.execute("DELETE FROM sessions WHERE updated_at < ?", (now - self.ttl,))
+        db.commit()
+
+    def count(self):
+        return self._db().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+
+def answer(session, question):
+    """
+    Run one question through the agent with `session` as context, like one chat turn
+    in app.py. Returns the turn result; the caller records it in the session.
+    """
+    chat_context = session.history()
+    prompt = question
+    if session.awaiting_refinement and session.pending_prompt:
+        prompt = f"{session.pending_prompt}. The user clarifies: {question}"
+    timings = {}
+    started = time.perf_counter()
+    parsed = query_agent.english_to_guarded_sql(prompt, chat_context=chat_context, session=session)
+    timings["sql_ms"] = (time.perf_counter() - started) * 1000
+
+    sql_query = parsed.get("sql")
+    result = {"answer": None, "sql": None, "follow_up": parsed.get("follow_up"), "columns": None, "rows": None,
+              "truncated": False, "timings": timings}
+    if sql_query and sql_query.strip().lower() != "null":
+        result["sql"] = sql_query
+        started = time.perf_counter()
+        try:
+            columns, rows, truncated = run_query_bounded(sql_query)
+        except Exception as e:
+            result["answer"] = f"❌ Failed to run your query: {e}"
+            return result
+        timings["query_ms"] = (time.perf_counter() - started) * 1000
+        result.update(columns=columns, rows=rows, truncated=truncated)
+        started = time.perf_counter()
+        result["answer"] = query_agent.generate_final_response(question, columns, rows, truncated=truncated,
+                                                               session=session)
+        timings["answer_ms"] = (time.perf_counter() - started) * 1000
+    elif isinstance(parsed.get("force_format_response"), dict):
+        payload = parsed["force_format_response"]
+        if not payload.get("rows"):
+            result["answer"] = "The original query had no results to format. Please try asking a new question."
+        else:
+            result["answer"] = query_agent.generate_final_response(
+                f"{payload.get('question', question)} ({question})", payload.get("columns", []), payload["rows"],
+                session=session,
+            )
+    elif parsed.get("force_format_response"):
+        # A plain-text payload is the message to show (e.g. nothing to reformat), as in async_pipeline.
+        result["answer"] = parsed["force_format_response"]
+    elif parsed.get("rejected"):
+        result["answer"] = f"❌ {parsed['rejected']}"
+    else:
+        started = time.perf_counter()
+        result["answer"] = query_agent.gemini_direct_answer(question, chat_context, session=session)
+        timings["answer_ms"] = (time.perf_counter() - started) * 1000
+    return result
+
+
+def record_turn(session, question, result):
+    """Apply an answered turn to `session` (again, after a save conflict)."""
+    session.add_turn(question, result["answer"])
+    if result["columns"] is not None:
+        session.set_result(question, result["columns"], result["rows"])
+    session.follow_up = result["follow_up"] or ""
+    session.awaiting_refinement = bool(result["follow_up"])
+    session.pending_prompt = result["follow_up"] or ""
+
+
+class APIServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, sessions=None, admission=None):
+        super().__init__(address, APIHandler)
+        self.sessions = sessions or SessionDB()
+        self.admission = admission or Admission()
+        self.stats = {"requests": 0, "errors": 0, "save_conflicts": 0, "lost_turns": 0}
+        self.stats_lock = threading.Lock()
+
+    def count(self, key):
+        with self.stats_lock:
+            self.stats[key] += 1
+
+    def prometheus_text(self):
+        admission = self.admission.metrics()
+        with self.stats_lock:
+            stats = dict(self.stats)
+        pid = os.getpid()
+        lines = [
+            "# TYPE nl2sql_api_requests_total counter",
+            f'nl2sql_api_requests_total{{worker="{pid}"}} {stats["requests"]}',
+            "# TYPE nl2sql_api_errors_total counter",
+            f'nl2sql_api_errors_total{{worker="{pid}"}} {stats["errors"]}',
+            "# TYPE nl2sql_api_session_conflicts_total counter",
+            f'nl2sql_api_session_conflicts_total{{worker="{pid}"}} {stats["save_conflicts"]}',
+            "# HELP nl2sql_api_lost_turns_total Answered turns not saved after every save attempt conflicted.",
+            "# TYPE nl2sql_api_lost_turns_total counter",
+            f'nl2sql_api_lost_turns_total{{worker="{pid}"}} {stats["lost_turns"]}',
+            "# HELP nl2sql_api_rejected_total Requests turned away with 503 (queue full or wait timed out).",
+            "# TYPE nl2sql_api_rejected_total counter",
+            f'nl2sql_api_rejected_total{{worker="{pid}",reason="full"}} {admission["rejected_full"]}',
+            f'nl2sql_api_rejected_total{{worker="{pid}",reason="timeout"}} {admission["rejected_timeout"]}',
+            "# TYPE nl2sql_api_active_requests gauge",
+            f'nl2sql_api_active_requests{{worker="{pid}"}} {admission["active"]}',
+            "# TYPE nl2sql_api_queued_requests gauge",
+            f'nl2sql_api_queued_requests{{worker="{pid}"}} {admission["queued"]}',
+        ]
+        return tracer.prometheus_text() + "\n".join(lines + prometheus_lines()) + "\n"
+
+
+class APIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "nl2sql-api"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type="application/json", headers=None):
+        data = body if isinstance(body, bytes) else json.dumps(body, ensure_ascii=False, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_json(self):
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = None
+        if length is None or length > MAX_BODY_BYTES:
+            # The body stays unread, so the connection cannot carry another request.
+            self.close_connection = True
+            raise ValueError("request body too large" if length else "invalid Content-Length")
+        body = json.loads(self.rfile.read(length) or b"{}")
+        if not isinstance(body, dict):
+            raise ValueError("expected a JSON object")
+        return body
+
+    def _unread_body(self):
+        """
+        Headers for a response that leaves the request body unread: the connection is
+        closed, or the body's bytes would be parsed as the next request.
+        """
+        if (self.headers.get("Content-Length") or "0").strip() == "0":
+            return None
+        self.close_connection = True
+        return {"Connection": "close"}
+
+    def _route(self):
+        path = self.path.split("?", 1)[0].rstrip("/")
+        if path.startswith("/v1/sessions/"):
+            return "session", path[len("/v1/sessions/"):]
+        return path, None
+
+    def do_GET(self):
+        route, session_id = self._route()
+        if route == "/health":
+            self._health()
+        elif route == "/metrics":
+            self._send(200, self.server.prometheus_text().encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8")
+        elif route == "session":
+            session, version = self.server.sessions.load(session_id)
+            if version == 0:
+                self._send(404, {"error": "unknown session"})
+                return
+            turns = [{"id": t["id"], "user": t["user"], "response": t["response"]} for t in session.turns]
+            self._send(200, {"session_id": session_id, "turns": turns, "follow_up": session.follow_up or None})
+        else:
+            self._send(404, {"error": "not found"})
+
+    def do_DELETE(self):
+        route, session_id = self._route()
+        if route != "session":
+            self._send(404, {"error": "not found"}, headers=self._unread_body())
+            return
+        deleted = self.server.sessions.delete(session_id)
+        self._send(200 if deleted else 404, {"deleted": deleted}, headers=self._unread_body())
+
+    def do_POST(self):
+        route, _ = self._route()
+        if route != "/v1/ask":
+            self._send(404, {"error": "not found"}, headers=self._unread_body())
+            return
+        try:
+            body = self._read_json()
+        except ValueError as e:
+            self._send(400, {"error": str(e)}, headers={"Connection": "close"} if self.close_connection else None)
+            return
+        question = body.get("question")
+        if not isinstance(question, str) or not question.strip():
+            self._send(400, {"error": "question is required"})
+            return
+
+        try:
+            self.server.admission.acquire()
+        except Overloaded as e:
+            self._send(503, {"error": f"server busy: {e}"}, headers={"Retry-After": "1"})
+            return
+        self.server.count("requests")
+        try:
+            self._send(200, self._ask(question.strip(), body.get("session_id") or uuid.uuid4().hex,
+                                      bool(body.get("include_rows"))))
+        except SessionConflict as e:
+            self._send(409, {"error": str(e)})
+        except Exception as e:
+            self.server.count("errors")
+            print("❌ API request failed:", e)
+            self._send(500, {"error": str(e)})
+        finally:
+            self.server.admission.release()
+
+    def _ask(self, question, session_id, include_rows):
+        sessions = self.server.sessions
+        started = time.perf_counter()
+        with span("request") as request_span:
+            session, version = sessions.load(session_id)
+            result = answer(session, question)
+            request_span.set(sql_generated=result["sql"] is not None)
+        record_turn(session, question, result)
+        for attempt in range(SAVE_ATTEMPTS):
+            if sessions.save(session_id, session, version):
+                break
+            self.server.count("save_conflicts")
+            if attempt + 1 < SAVE_ATTEMPTS:
+                # Another worker answered in this session meanwhile: add this turn to its version.
+                session, version = sessions.load(session_id)
+                record_turn(session, question, result)
+        else:
+            self.server.count("lost_turns")
+            print(f"⚠️ Turn not saved in session {session_id} after {SAVE_ATTEMPTS} conflicting saves")
+            raise SessionConflict("the session was updated concurrently and this turn was not saved; "
+                                  "please ask again")
+
+        response = {
+            "session_id": session_id,
+            "answer": result["answer"],
+            "sql": result["sql"],
+            "follow_up": result["follow_up"],
+            "row_count": len(result["rows"]) if result["rows"] is not None else None,
+            "truncated": result["truncated"],
+            "timings": {name: round(value, 1) for name, value in
+                        dict(result["timings"], total_ms=(time.perf_counter() - started) * 1000).items()},
+        }
+        if include_rows and result["columns"] is not None:
+            response.update(columns=result["columns"], rows=serialize_rows(result["columns"], result["rows"]))
+        return response
+
+    def _health(self):
+        status, checks = 200, {"worker": os.getpid(), "admission": self.server.admission.metrics()}
+        if "db=1" in self.path:
+            try:
+                with pooled_connection() as conn:
+                    cur = conn.cursor()
+                    cur.execute("SELECT 1")
+                    cur.fetchone()
+                    cur.close()
+                checks["database"] = "ok"
+                checks["pool"] = pool_metrics()
+            except Exception as e:
+                status, checks["database"] = 503, f"error: {e}"
+        self._send(status, dict(checks, status="ok" if status == 200 else "unavailable"))
+
+
+def serve(host="127.0.0.1", port=8000, workers=API_WORKERS):
+    """
+    Bind once and serve from `workers` forked processes sharing the listening socket.
+    Each worker has its own connection pool, Gemini client and admission queue;
+    sessions are shared through the SQLite session store.
+    """
+    server = APIServer((host, port))
+    server.sessions.count()   # create the table before forking
+    server.sessions._local = threading.local()
+    if workers <= 1 or not hasattr(os, "fork"):
+        print(f"✅ API listening on http://{host}:{port} (1 worker)")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        children.append(pid)
+    print(f"✅ API listening on http://{host}:{port} ({workers} workers)")
+
+    def stop(signum, frame):
+        for child in children:
+            try:
+                os.kill(child, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for child in children:
+        while True:
+            try:
+                os.waitpid(child, 0)
+                break
+            except InterruptedError:
+                continue
+            except ChildProcessError:
+                break
+    server.server_close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="HTTP/JSON API for the NL -> SQL -> answer flow.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=API_WORKERS, help="worker processes sharing the port")
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers)
@@ -0,0 +1,297 @@
+import asyncio
+import os
+import weakref
+
+import psycopg2
+from psycopg2 import extensions
+
+import query_agent
+from prompt_builder import count_tokens
+from query_guard import QueryRejected, guard_query
+from schema_catalog import get_catalog
+from sql_validator import InvalidSQL, validate_sql
+from result_cache import estimate_size, is_read_only, referenced_tables
+from sql import QUERY_MAX_ROWS, STATEMENT_TIMEOUT_MS, result_cache
+from tracing import span
+
+LLM_TIMEOUT = float(os.getenv("llm_timeout", "60"))
+DB_TIMEOUT = float(os.getenv("db_timeout", "30"))
+ASYNC_DB_POOL_MAX = int(os.getenv("async_db_pool_max", "10"))
+
+
+class StageTimeout(Exception):
+    """Raised when one stage of the pipeline exceeds its timeout."""
+
+    def __init__(self, stage, timeout):
+        super().__init__(f"{stage} timed out after {timeout:g}s")
+        self.stage = stage
+        self.timeout = timeout
+
+
+async def run_stage(stage, coro, timeout):
+    try:
+        return await asyncio.wait_for(coro, timeout)
+    except asyncio.TimeoutError:
+        raise StageTimeout(stage, timeout) from None
+
+
+async def _wait(conn):
+    """Drive an async psycopg2 connection until the pending operation completes."""
+    loop = asyncio.get_running_loop()
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            return
+        future = loop.create_future()
+
+        def ready():
+            if not future.done():
+                future.set_result(None)
+
+        fd = conn.fileno()
+        if state == extensions.POLL_READ:
+            loop.add_reader(fd, ready)
+            try:
+                await future
+            finally:
+                loop.remove_reader(fd)
+        elif state == extensions.POLL_WRITE:
+            loop.add_writer(fd, ready)
+            try:
+                await future
+            finally:
+                loop.remove_writer(fd)
+        else:
+            raise psycopg2.OperationalError(f"Unexpected poll state: {state}")
+
+
+async def _connect():
+    # Async connections are in autocommit mode, so SET LOCAL would not stick; the server-side
+    # statement_timeout is set for the whole session at connect time instead (no extra round trip).
+    options = {"options": f"-c statement_timeout={int(STATEMENT_TIMEOUT_MS)}"} if STATEMENT_TIMEOUT_MS else {}
+    conn = psycopg2.connect(
+        host=os.getenv("hostname", "localhost"),
+        dbname=os.getenv("dbname", "pagila"),
+        user=os.getenv("user_name", "postgres"),
+        password=os.getenv("password", ""),
+        port=5432,
+        async_=1,
+        **options,
+    )
+    await _wait(conn)
+    return conn
+
+
+class AsyncConnectionPool:
+    """Bounded pool of non-blocking psycopg2 connections for one event loop."""
+
+    def __init__(self, max_size=ASYNC_DB_POOL_MAX):
+        self.max_size = max_size
+        self._idle = []
+        self._slots = asyncio.Semaphore(max_size)
+
+    async def acquire(self):
+        await self._slots.acquire()
+        try:
+            while self._idle:
+                conn = self._idle.pop()
+                if not conn.closed:
+                    return conn
+            return await _connect()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn, discard=False):
+        if discard or conn.closed:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        else:
+            self._idle.append(conn)
+        self._slots.release()
+
+    def close(self):
+        while self._idle:
+            self._idle.pop().close()
+
+
+_pools = weakref.WeakKeyDictionary()
+
+
+def get_async_pool():
+    loop = asyncio.get_running_loop()
+    pool = _pools.get(loop)
+    if pool is None:
+        pool = _pools[loop] = AsyncConnectionPool()
+    return pool
+
+
+async def _execute(query, max_rows):
+    pool = get_async_pool()
+    conn = await pool.acquire()
+    discard = False
+    try:
+        cur = conn.cursor()
+        cur.execute(query)
+        try:
+            await _wait(conn)
+        except asyncio.CancelledError:
+            # Stop the statement on the server too; the connection state is unknown afterwards.
+            discard = True
+            try:
+                conn.cancel()
+            except Exception:
+                pass
+            raise
+        rows = cur.fetchmany(max_rows + 1) if cur.description else []
+        columns = [desc[0] for desc in cur.description] if cur.description else []
+        cur.close()
+        return columns, rows
+    except BaseException:
+        discard = True
+        raise
+    finally:
+        pool.release(conn, discard=discard)
+
+
+async def run_query_async(query, max_rows=None, timeout=None):
+    """Async counterpart of sql.run_query_bounded. Returns (columns, rows, truncated)."""
+    with span("run_query_async") as s:
+        columns, rows, truncated = await _run_query_async(query, max_rows, timeout, s)
+        if s.recording:
+            s.set(rows=len(rows), result_bytes=estimate_size(columns or [], rows), truncated=truncated)
+        return columns, rows, truncated
+
+
+async def _run_query_async(query, max_rows, timeout, s):
+    max_rows = QUERY_MAX_ROWS if max_rows is None else max_rows
+    timeout = DB_TIMEOUT if timeout is None else timeout
+    cached = result_cache.get(query)
+    s.set(cache_hit=cached is not None)
+    if cached is not None:
+        columns, rows = cached
+        return columns, rows[:max_rows], len(rows) > max_rows
+
+    read_only = is_read_only(query)
+    statement = query
+    if read_only:
+        # Async connections cannot use named cursors, so bound the result on the server.
+        body = query.strip().rstrip(";")
+        statement = f"SELECT * FROM (\n{body}\n) AS bounded LIMIT {max_rows + 1}"
+    try:
+        columns, rows = await run_stage("database", _execute(statement, max_rows), timeout)
+    except Exception as e:
+        print("❌ SQL Execution Error:", e)
+        raise
+
+    truncated = len(rows) > max_rows
+    rows = rows[:max_rows]
+    if read_only and not truncated:
+        result_cache.put(query, columns, rows)
+    elif not read_only:
+        result_cache.invalidate_tables(referenced_tables(query))
+    return columns, rows, truncated
+
+
+async def _generate(prompt, timeout, kind):
+    timeout = LLM_TIMEOUT if timeout is None else timeout
+    with span(f"gemini_{kind}") as s:
+        response = await run_stage("gemini", query_agent.get_model().generate_content_async(prompt), timeout)
+        if s.recording:
+            usage = getattr(response, "usage_metadata", None)
+            s.set(
+                prompt_tokens=getattr(usage, "prompt_token_count", None) or count_tokens(prompt),
+                response_tokens=getattr(usage, "candidates_token_count", None) or count_tokens(response.text),
+            )
+        return response.text
+
+
+async def english_to_sql_async(prompt, chat_context=None, timeout=None, feedback=None, session=None):
+    answer, full_prompt = query_agent.prepare_sql_request(prompt, chat_context, feedback, session)
+    if answer is not None:
+        return answer
+    try:
+        return query_agent.finish_sql_request(prompt, await _generate(full_prompt, timeout, "sql"))
+    except Exception as e:
+        return dict(query_agent.SQL_REQUEST_FAILED, error=f"{type(e).__name__}: {e}")
+
+
+async def english_to_guarded_sql_async(prompt, chat_context=None, timeout=None, session=None):
+    """Async counterpart of query_agent.english_to_guarded_sql; EXPLAIN runs in a worker thread."""
+    parsed = await english_to_sql_async(prompt, chat_context, timeout, session=session)
+    for attempt in range(query_agent.SQL_REGENERATE_ATTEMPTS + 1):
+        sql_query = parsed.get("sql")
+        if not sql_query or sql_query.strip().lower() == "null":
+            return parsed
+        try:
+            # Validation is local and memoized, so it runs on the event loop.
+            sql_query = validate_sql(sql_query, get_catalog(list(query_agent.SCHEMAS)))
+            return dict(parsed, sql=await asyncio.to_thread(guard_query, sql_query))
+        except (InvalidSQL, QueryRejected) as e:
+            print("❌", e)
+            if attempt == query_agent.SQL_REGENERATE_ATTEMPTS:
+                return dict(parsed, sql=None, rejected=query_agent.rejection_message(e))
+            parsed = await english_to_sql_async(prompt, chat_context, timeout, feedback=e.feedback(), session=session)
+    return parsed
+
+
+async def generate_final_response_async(user_question, columns, rows, truncated=False, timeout=None, session=None):
+    answer = query_agent.local_final_response(user_question, columns, rows, truncated, session)
+    if answer is not None:
+        return answer
+    formatting_prompt, rows_json = query_agent.build_formatting_prompt(user_question, columns, rows, truncated)
+    try:
+        text = await _generate(formatting_prompt, timeout, "format")
+        return query_agent.finish_final_response(text, user_question, columns, rows_json, session)
+    except Exception as e:
+        return f"Error formatting response: {e}"
+
+
+async def gemini_direct_answer_async(prompt, chat_context=None, timeout=None, session=None):
+    full_prompt = query_agent.build_direct_prompt(prompt, chat_context, session)
+    try:
+        return (await _generate(full_prompt, timeout, "direct")).strip()
+    except Exception as e:
+        return f"Gemini error: {e}"
+
+
+async def answer_question(question, chat_context=None, session=None):
+    """
+    Run the full question -> SQL -> answer flow without blocking the event loop.
+    Returns a dict with the answer, the generated SQL, the follow-up and the rows.
+    """
+    with span("answer_question"):
+        return await _answer_question(question, chat_context, session)
+
+
+async def _answer_question(question, chat_context, session):
+    parsed = await english_to_guarded_sql_async(question, chat_context, session=session)
+    sql_query = parsed.get("sql")
+    result = {"answer": None, "sql": sql_query, "follow_up": parsed.get("follow_up"), "columns": [], "rows": [], "truncated": False}
+
+    if sql_query and sql_query.strip().lower() != "null":
+        try:
+            columns, rows, truncated = await run_query_async(sql_query)
+        except Exception as e:
+            result["answer"] = f"❌ Failed to run your query: {e}"
+            return result
+        result.update(columns=columns, rows=rows, truncated=truncated)
+        result["answer"] = await generate_final_response_async(question, columns, rows, truncated, session=session)
+    elif isinstance(parsed.get("force_format_response"), dict):
+        payload = parsed["force_format_response"]
+        rows = payload.get("rows", [])
+        if not rows:
+            result["answer"] = "The original query had no results to format. Please try asking a new question."
+        else:
+            result["answer"] = await generate_final_response_async(
+                f"{payload.get('question', question)} ({question})", payload.get("columns", []), rows, session=session
+            )
+    elif parsed.get("force_format_response"):
+        result["answer"] = parsed["force_format_response"]
+    elif parsed.get("rejected"):
+        result["answer"] = f"❌ {parsed['rejected']}"
+    else:
+        result["answer"] = await gemini_direct_answer_async(question, chat_context, session=session)
+    return result
@@ -0,0 +1,187 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import query_agent
+from local_formatter import serialize_rows
+from nl_cache import normalize_question
+from session_store import SessionStore
+from sql import run_query_bounded
+from tracing import span
+
+BATCH_LLM_CONCURRENCY = int(os.getenv("batch_llm_concurrency", "4"))
+BATCH_DB_CONCURRENCY = int(os.getenv("batch_db_concurrency", "4"))
+
+
+def read_questions(path):
+    """Yield (id, question) from a JSONL file of {"id": ..., "question": ...} objects or bare strings."""
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"⚠️ Skipping line {line_no}: {e}")
+                continue
+            if isinstance(item, str):
+                item = {"question": item}
+            question = item.get("question") if isinstance(item, dict) else None
+            if not isinstance(question, str) or not question.strip():
+                print(f"⚠️ Skipping line {line_no}: no question")
+                continue
+            yield item.get("id", line_no), question.strip()
+
+
+def dedupe(items):
+    """Group (id, question) pairs by normalized question, keeping first-seen order."""
+    groups = {}
+    for item_id, question in items:
+        key = normalize_question(question)
+        if key not in groups:
+            groups[key] = {"question": question, "ids": []}
+        groups[key]["ids"].append(item_id)
+    return groups
+
+
+def completed_keys(path):
+    """
+    Keys already answered in an existing output file. Items that ended in an error, or
+    whose answer is the error text of a failed Gemini call, are retried.
+    """
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue   # a line cut short by an interrupted run
+            if record.get("status") in ("ok", "rejected") and not query_agent.is_failed_answer(record.get("answer")):
+                done.add(record.get("key"))
+    return done
+
+
+def _ends_with_newline(path):
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+class BatchRunner:
+    """
+    Answer questions without a Streamlit session. Every question gets its own
+    SessionStore, so answers do not depend on each other; Gemini calls and database
+    queries are bounded by separate semaphores.
+    """
+
+    def __init__(self, llm_concurrency=BATCH_LLM_CONCURRENCY, db_concurrency=BATCH_DB_CONCURRENCY, include_rows=False):
+        self.llm_concurrency = llm_concurrency
+        self.db_concurrency = db_concurrency
+        self.include_rows = include_rows
+        self._llm = threading.BoundedSemaphore(llm_concurrency)
+        self._db = threading.BoundedSemaphore(db_concurrency)
+
+    def _stage(self, timings, stage, semaphore, fn, *args, **kwargs):
+        queued = time.perf_counter()
+        with semaphore:
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                timings["wait_ms"] = timings.get("wait_ms", 0.0) + (started - queued) * 1000
+                timings[f"{stage}_ms"] = timings.get(f"{stage}_ms", 0.0) + (time.perf_counter() - started) * 1000
+
+    def answer(self, key, question, ids):
+        """Return the output record for one deduplicated question."""
+        session = SessionStore()
+        timings = {}
+        record = {"key": key, "ids": ids, "question": question, "status": "ok", "sql": None, "answer": None,
+                  "follow_up": None, "row_count": None, "truncated": False}
+        start = time.perf_counter()
+        with span("batch_question") as s:
+            try:
+                # Generation takes an LLM slot; validation and the cost guard's EXPLAIN take a DB slot.
+                parsed = query_agent.english_to_guarded_sql(
+                    question, session=session,
+                    translate=lambda *args, **kwargs: self._stage(timings, "sql", self._llm, query_agent.english_to_sql,
+                                                                  *args, **kwargs),
+                    check=lambda sql_query: self._stage(timings, "guard", self._db, query_agent.check_sql, sql_query),
+                )
+                if parsed.get("error"):
+                    raise RuntimeError(f"SQL generation failed: {parsed['error']}")
+                sql_query = parsed.get("sql")
+                record["follow_up"] = parsed.get("follow_up")
+                if sql_query and sql_query.strip().lower() != "null":
+                    record["sql"] = sql_query
+                    columns, rows, truncated = self._stage(timings, "query", self._db, run_query_bounded, sql_query)
+                    record.update(row_count=len(rows), truncated=truncated)
+                    if self.include_rows:
+                        record.update(columns=columns, rows=serialize_rows(columns, rows))
+                    record["answer"] = self._stage(timings, "answer", self._llm, query_agent.generate_final_response,
+                                                   question, columns, rows, truncated, session=session)
+                elif parsed.get("rejected"):
+                    record.update(status="rejected", answer=f"❌ {parsed['rejected']}")
+                else:
+                    record["answer"] = self._stage(timings, "answer", self._llm, query_agent.gemini_direct_answer,
+                                                   question, session=session)
+                if query_agent.is_failed_answer(record["answer"]):
+                    raise RuntimeError(record["answer"])
+            except Exception as e:
+                record.update(status="error", error=f"{type(e).__name__}: {e}")
+            s.set(status=record["status"], rows=record["row_count"] or 0)
+        timings["total_ms"] = (time.perf_counter() - start) * 1000
+        record["timings"] = {name: round(value, 1) for name, value in timings.items()}
+        return record
+
+    def run(self, input_path, output_path, restart=False):
+        """Answer every question of `input_path`, appending one JSON line per unique question to `output_path`."""
+        items = list(read_questions(input_path))
+        groups = dedupe(items)
+        if restart and os.path.exists(output_path):
+            os.remove(output_path)
+        done = completed_keys(output_path)
+        pending = [(key, group) for key, group in groups.items() if key not in done]
+        print(f"📊 {len(items)} questions, {len(groups)} unique, {len(groups) - len(pending)} already answered")
+
+        stats = {"ok": 0, "rejected": 0, "error": 0}
+        start = time.perf_counter()
+        workers = self.llm_concurrency + self.db_concurrency
+        with open(output_path, "a", encoding="utf-8") as out, ThreadPoolExecutor(max_workers=workers) as executor:
+            if out.tell() and not _ends_with_newline(output_path):
+                out.write("\n")
+            futures = [executor.submit(self.answer, key, group["question"], group["ids"]) for key, group in pending]
+            for future in as_completed(futures):
+                record = future.result()
+                stats[record["status"]] += 1
+                out.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+                out.flush()   # every finished line survives an interrupted run
+
+        elapsed = time.perf_counter() - start
+        print(f"✅ Answered {len(pending)} questions in {elapsed:.1f}s "
+              f"({stats['ok']} ok, {stats['rejected']} rejected, {stats['error']} errors)")
+        return dict(stats, questions=len(items), unique=len(groups), skipped=len(groups) - len(pending),
+                    seconds=round(elapsed, 2))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Answer a JSONL file of questions without the Streamlit app.")
+    parser.add_argument("input", help='JSONL with {"id": ..., "question": ...} per line')
+    parser.add_argument("output", help="JSONL results, one line per unique question (appended; resumable)")
+    parser.add_argument("--llm-concurrency", type=int, default=BATCH_LLM_CONCURRENCY, help="parallel Gemini calls")
+    parser.add_argument("--db-concurrency", type=int, default=BATCH_DB_CONCURRENCY, help="parallel database queries")
+    parser.add_argument("--rows", action="store_true", help="include the result rows in the output")
+    parser.add_argument("--restart", action="store_true", help="discard the existing output instead of resuming")
+    args = parser.parse_args()
+
+    BatchRunner(
+        llm_concurrency=args.llm_concurrency,
+        db_concurrency=args.db_concurrency,
+        include_rows=args.rows,
+    ).run(args.input, args.output, restart=args.restart)
@@ -0,0 +1,523 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+STAGES = ["english_to_sql", "run_query", "generate_final_response", "gemini_direct_answer"]
+
+# Representative questions with the SQL a good model would write for them. The SQL is kept
+# to what both Postgres and the SQLite fixture accept; `None` means a direct (no SQL) answer.
+QUESTIONS = [
+    {"question": "How many films are in the database?",
+     "sql": "SELECT COUNT(*) AS film_count FROM public.film"},
+    {"question": "Which 10 actors appear in the most films?",
+     "sql": "SELECT a.first_name, a.last_name, COUNT(*) AS films FROM public.actor a "
+            "JOIN public.film_actor fa ON fa.actor_id = a.actor_id "
+            "GROUP BY a.actor_id, a.first_name, a.last_name ORDER BY films DESC LIMIT 10"},
+    {"question": "What is the total revenue per store?",
+     "sql": "SELECT i.store_id, SUM(p.amount) AS revenue FROM public.payment p "
+            "JOIN public.rental r ON r.rental_id = p.rental_id "
+            "JOIN public.inventory i ON i.inventory_id = r.inventory_id "
+            "GROUP BY i.store_id ORDER BY i.store_id"},
+    {"question": "How many films are there in each category?",
+     "sql": "SELECT c.name, COUNT(*) AS films FROM public.category c "
+            "JOIN public.film_category fc ON fc.category_id = c.category_id "
+            "GROUP BY c.name ORDER BY films DESC"},
+    {"question": "Who are the top 5 customers by total payments?",
+     "sql": "SELECT c.first_name, c.last_name, SUM(p.amount) AS total_paid FROM public.customer c "
+            "JOIN public.payment p ON p.customer_id = c.customer_id "
+            "GROUP BY c.customer_id, c.first_name, c.last_name ORDER BY total_paid DESC LIMIT 5"},
+    {"question": "What is the average rental rate by rating?",
+     "sql": "SELECT rating, AVG(rental_rate) AS avg_rate FROM public.film GROUP BY rating ORDER BY rating"},
+    {"question": "Which films have never been rented?",
+     "sql": "SELECT f.title FROM public.film f "
+            "LEFT JOIN public.inventory i ON i.film_id = f.film_id "
+            "LEFT JOIN public.rental r ON r.inventory_id = i.inventory_id "
+            "WHERE r.rental_id IS NULL ORDER BY f.title"},
+    {"question": "Show every rental made by customer 1 with its return date",
+     "sql": "SELECT r.rental_id, r.rental_date, r.return_date FROM public.rental r "
+            "WHERE r.customer_id = 1 ORDER BY r.rental_date"},
+    {"question": "What is the longest film?",
+     "sql": "SELECT title, length FROM public.film ORDER BY length DESC, title LIMIT 1"},
+    {"question": "How many customers are active in each store?",
+     "sql": "SELECT store_id, COUNT(*) AS active_customers FROM public.customer "
+            "WHERE active = 1 GROUP BY store_id ORDER BY store_id"},
+    {"question": "Hi! What kind of questions can you answer?", "sql": None},
+    {"question": "What does a PG-13 rating mean?", "sql": None},
+]
+
+CANNED_ANSWER = """Here is what the data shows:
+
+| Name | Value |
+|------|-------|
+| first | 42 |
+| second | 17 |
+| third | 8 |
+
+The first entry is clearly ahead of the rest."""
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeGenerativeModel:
+    """
+    Offline stand-in for genai.GenerativeModel. Every call sleeps `latency` seconds
+    (plus up to `jitter`) and returns canned text: the corpus SQL as fenced JSON for
+    SQL-generation prompts and a short markdown answer for everything else.
+    """
+
+    def __init__(self, latency=0.3, jitter=0.1, chunks=8, questions=QUESTIONS, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.chunks = chunks
+        self.sql_by_question = {q["question"]: q["sql"] for q in questions}
+        self.calls = {"sql": 0, "answer": 0}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _delay(self):
+        with self._lock:
+            return self.latency + self._random.uniform(0, self.jitter)
+
+    def _respond(self, prompt):
+        if "Return ONLY a JSON" not in prompt:
+            with self._lock:
+                self.calls["answer"] += 1
+            return CANNED_ANSWER
+        with self._lock:
+            self.calls["sql"] += 1
+        question = prompt.rstrip().rsplit("User: ", 1)[-1].strip()
+        sql = self.sql_by_question.get(question)
+        payload = {
+            "schema": "public" if sql else None,
+            "sql": sql,
+            "response": "Sure, let me get that for you.",
+            "follow_up": None,
+        }
+        return f"```json\n{json.dumps(payload, indent=2)}\n```"
+
+    def _stream(self, text, delay):
+        size = max(1, len(text) // self.chunks)
+        for start in range(0, len(text), size):
+            time.sleep(delay / self.chunks)
+            yield FakeResponse(text[start:start + size])
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        text = self._respond(prompt)
+        delay = self._delay()
+        if stream:
+            return self._stream(text, delay)
+        time.sleep(delay)
+        return FakeResponse(text)
+
+    async def generate_content_async(self, prompt, **kwargs):
+        text = self._respond(prompt)
+        await asyncio.sleep(self._delay())
+        return FakeResponse(text)
+
+
+FIXTURE_TABLES = """
+    CREATE TABLE public.language (language_id INTEGER PRIMARY KEY, name TEXT);
+    CREATE TABLE public.category (category_id INTEGER PRIMARY KEY, name TEXT);
+    CREATE TABLE public.actor (actor_id INTEGER PRIMARY KEY, first_name TEXT, last_name TEXT);
+    CREATE TABLE public.store (store_id INTEGER PRIMARY KEY, manager_staff_id INTEGER);
+    CREATE TABLE public.film (
+        film_id INTEGER PRIMARY KEY, title TEXT, description TEXT, release_year INTEGER,
+        language_id INTEGER REFERENCES language(language_id), rental_duration INTEGER,
+        rental_rate NUMERIC, length INTEGER, replacement_cost NUMERIC, rating TEXT);
+    CREATE TABLE public.film_actor (
+        actor_id INTEGER REFERENCES actor(actor_id), film_id INTEGER REFERENCES film(film_id),
+        PRIMARY KEY (actor_id, film_id));
+    CREATE TABLE public.film_category (
+        film_id INTEGER REFERENCES film(film_id), category_id INTEGER REFERENCES category(category_id),
+        PRIMARY KEY (film_id, category_id));
+    CREATE TABLE public.customer (
+        customer_id INTEGER PRIMARY KEY, store_id INTEGER REFERENCES store(store_id),
+        first_name TEXT, last_name TEXT, email TEXT, active INTEGER);
+    CREATE TABLE public.inventory (
+        inventory_id INTEGER PRIMARY KEY, film_id INTEGER REFERENCES film(film_id),
+        store_id INTEGER REFERENCES store(store_id));
+    CREATE TABLE public.rental (
+        rental_id INTEGER PRIMARY KEY, rental_date TEXT, inventory_id INTEGER REFERENCES inventory(inventory_id),
+        customer_id INTEGER REFERENCES customer(customer_id), return_date TEXT);
+    CREATE TABLE public.payment (
+        payment_id INTEGER PRIMARY KEY, customer_id INTEGER REFERENCES customer(customer_id),
+        rental_id INTEGER REFERENCES rental(rental_id), amount NUMERIC, payment_date TEXT);
+"""
+
+FIRST_NAMES = ["MARY", "PATRICIA", "LINDA", "BARBARA", "ELIZABETH", "JENNIFER", "JOHN", "ROBERT", "MICHAEL", "DAVID"]
+LAST_NAMES = ["SMITH", "JOHNSON", "WILLIAMS", "JONES", "BROWN", "DAVIS", "MILLER", "WILSON", "MOORE", "TAYLOR"]
+WORDS = ["ACADEMY", "DINOSAUR", "ACE", "GOLDFINGER", "ADAPTATION", "HOLES", "AFFAIR", "PREJUDICE", "AGENT", "TRUMAN"]
+CATEGORIES = ["Action", "Animation", "Children", "Classics", "Comedy", "Documentary", "Drama", "Family",
+              "Foreign", "Games", "Horror", "Music", "New", "Sci-Fi", "Sports", "Travel"]
+RATINGS = ["G", "PG", "PG-13", "R", "NC-17"]
+
+
+def build_fixture(path, scale=1.0, seed=0):
+    """Create a Pagila-shaped SQLite database at `path` (about 50k rows at scale 1)."""
+    rng = random.Random(seed)
+    films = int(1000 * scale) or 1
+    actors = int(200 * scale) or 1
+    customers = int(599 * scale) or 1
+    inventory = int(4500 * scale) or 1
+    rentals = int(16000 * scale) or 1
+
+    conn = sqlite3.connect(":memory:")
+    conn.execute("ATTACH DATABASE ? AS public", (path,))
+    conn.executescript(FIXTURE_TABLES)
+    conn.executemany("INSERT INTO public.language VALUES (?, ?)", [(1, "English"), (2, "Italian")])
+    conn.executemany("INSERT INTO public.category VALUES (?, ?)", list(enumerate(CATEGORIES, 1)))
+    conn.executemany("INSERT INTO public.store VALUES (?, ?)", [(1, 1), (2, 2)])
+    conn.executemany("INSERT INTO public.actor VALUES (?, ?, ?)", [
+        (i, rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)) for i in range(1, actors + 1)
+    ])
+    conn.executemany("INSERT INTO public.film VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", [
+        (i, f"{rng.choice(WORDS)} {rng.choice(WORDS)} {i}", "A Epic Drama of a Feminist And a Mad Scientist",
+         2006, 1, rng.randint(3, 7), rng.choice([0.99, 2.99, 4.99]), rng.randint(46, 185),
+         rng.choice([9.99, 14.99, 19.99, 24.99]), rng.choice(RATINGS))
+        for i in range(1, films + 1)
+    ])
+    conn.executemany("INSERT OR IGNORE INTO public.film_actor VALUES (?, ?)", [
+        (rng.randint(1, actors), film) for film in range(1, films + 1) for _ in range(5)
+    ])
+    conn.executemany("INSERT INTO public.film_category VALUES (?, ?)", [
+        (film, rng.randint(1, len(CATEGORIES))) for film in range(1, films + 1)
+    ])
+    conn.executemany("INSERT INTO public.customer VALUES (?, ?, ?, ?, ?, ?)", [
+        (i, rng.randint(1, 2), rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), f"customer{i}@example.org",
+         int(rng.random() > 0.03))
+        for i in range(1, customers + 1)
+    ])
+    # Only part of the catalogue is stocked, so "never rented" has answers.
+    conn.executemany("INSERT INTO public.inventory VALUES (?, ?, ?)", [
+        (i, rng.randint(1, max(1, films * 9 // 10)), rng.randint(1, 2)) for i in range(1, inventory + 1)
+    ])
+    rental_rows = []
+    payment_rows = []
+    for i in range(1, rentals + 1):
+        day = 1 + rng.randrange(180)
+        rented = f"2022-{1 + (day - 1) // 30:02d}-{1 + (day - 1) % 28:02d} {rng.randrange(24):02d}:00:00"
+        customer = rng.randint(1, customers)
+        rental_rows.append((i, rented, rng.randint(1, inventory), customer, rented))
+        payment_rows.append((i, customer, i, rng.choice([0.99, 1.99, 2.99, 4.99, 5.99]), rented))
+    conn.executemany("INSERT INTO public.rental VALUES (?, ?, ?, ?, ?)", rental_rows)
+    conn.executemany("INSERT INTO public.payment VALUES (?, ?, ?, ?, ?)", payment_rows)
+    conn.commit()
+    conn.close()
+
+
+class FixtureCursor:
+    """The slice of the psycopg2 cursor API used by sql.py, on top of sqlite3."""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.itersize = 2000
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    def execute(self, query, params=None):
+        if query.lstrip().upper().startswith("SET "):
+            # Postgres session settings such as statement_timeout have no SQLite equivalent.
+            return None
+        if params is None:
+            return self._cursor.execute(query)
+        return self._cursor.execute(query.replace("%s", "?"), params)
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchmany(self, size=None):
+        return self._cursor.fetchmany(size or self.itersize)
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def close(self):
+        self._cursor.close()
+
+
+class FixtureConnection:
+    """A psycopg2-shaped connection to the SQLite fixture, so the real pool and sql.py run unchanged."""
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(":memory:", check_same_thread=False)
+        self._conn.execute("ATTACH DATABASE ? AS public", (path,))
+        self.closed = 0
+
+    def cursor(self, name=None):
+        # Named (server-side) cursors become plain cursors; fetchmany keeps the batching.
+        return FixtureCursor(self._conn.cursor())
+
+    def get_transaction_status(self):
+        from psycopg2 import extensions
+
+        if self._conn.in_transaction:
+            return extensions.TRANSACTION_STATUS_INTRANS
+        return extensions.TRANSACTION_STATUS_IDLE
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def close(self):
+        self._conn.close()
+        self.closed = 1
+
+
+def fixture_catalog(path):
+    """Build the SchemaCatalog the app would load from Postgres, from the fixture's own metadata."""
+    from schema_catalog import SchemaCatalog
+
+    conn = sqlite3.connect(":memory:")
+    conn.execute("ATTACH DATABASE ? AS public", (path,))
+    tables = {}
+    names = [row[0] for row in conn.execute("SELECT name FROM public.sqlite_master WHERE type = 'table'")]
+    for table in names:
+        info = conn.execute(f"PRAGMA public.table_info({table})").fetchall()
+        keys = sorted((row for row in info if row[5]), key=lambda row: row[5])
+        tables[f"public.{table}"] = {
+            "columns": [[row[1], row[2].lower()] for row in info],
+            "primary_key": [row[1] for row in keys],
+            "foreign_keys": {
+                row[3]: [f"public.{row[2]}", row[4]]
+                for row in conn.execute(f"PRAGMA public.foreign_key_list({table})")
+            },
+            "comment": None,
+            "column_comments": {},
+        }
+    conn.close()
+    return SchemaCatalog(["public"], tables, {name: "fixture" for name in tables}, revision=1)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of `values` (0 for no values)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, round(pct / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+class StageRecorder:
+    """Collects per-stage durations and, when tracemalloc is on, per-stage allocation peaks."""
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.durations = {stage: [] for stage in STAGES}
+        self.peaks = {stage: 0 for stage in STAGES}
+        self._lock = threading.Lock()
+
+    def timed(self, stage, fn, *args, **kwargs):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            peak = tracemalloc.get_traced_memory()[1] if self.trace_memory else 0
+            with self._lock:
+                self.durations[stage].append(elapsed)
+                self.peaks[stage] = max(self.peaks[stage], peak)
+
+    def summary(self):
+        stages = {}
+        for stage, values in self.durations.items():
+            total = sum(values)
+            stages[stage] = {
+                "calls": len(values),
+                "p50_ms": round(percentile(values, 50) * 1000, 2),
+                "p95_ms": round(percentile(values, 95) * 1000, 2),
+                "p99_ms": round(percentile(values, 99) * 1000, 2),
+                "mean_ms": round(statistics.fmean(values) * 1000, 2) if values else 0.0,
+                "calls_per_second": round(len(values) / total, 2) if total else 0.0,
+            }
+            if self.trace_memory:
+                stages[stage]["peak_kib"] = round(self.peaks[stage] / 1024, 1)
+        return stages
+
+
+def _peak_rss_kib():
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_question(recorder, item, chat_context):
+    """One turn through the same stages app.py runs for a question."""
+    import query_agent
+    from sql import run_query_bounded
+    from tracing import span
+
+    question = item["question"]
+    with span("request"):
+        parsed = recorder.timed("english_to_sql", query_agent.english_to_sql, question, chat_context=chat_context)
+        sql_query = parsed.get("sql")
+        if sql_query:
+            columns, rows, truncated = recorder.timed("run_query", run_query_bounded, sql_query)
+            return recorder.timed("generate_final_response", query_agent.generate_final_response,
+                                  question, columns, rows, truncated=truncated)
+        return recorder.timed("gemini_direct_answer", query_agent.gemini_direct_answer,
+                              question, chat_context=chat_context)
+
+
+def run_benchmark(passes=3, concurrency=1, latency=0.3, jitter=0.1, history_turns=4, scale=1.0,
+                  cache=True, trace_memory=False, fixture_path=None, questions=QUESTIONS):
+    """
+    Run the question corpus `passes` times against the fake model and the SQLite fixture
+    and return the report dict. With cache=False the translation and result caches are
+    cleared before every question, so each pass measures the uncached path.
+    """
+    workdir = tempfile.mkdtemp(prefix="nl2sql-bench-")
+    # The fixture catalog must not be refreshed from (or saved over) a real database's snapshot.
+    os.environ["schema_refresh_interval"] = "0"
+    os.environ["schema_snapshot_path"] = os.path.join(workdir, "schema_snapshot.json")
+    os.environ["nl_cache_path"] = ""
+
+    fixture_path = fixture_path or os.path.join(workdir, "pagila.sqlite")
+    if not os.path.exists(fixture_path):
+        build_fixture(fixture_path, scale=scale)
+
+    import query_agent
+    import schema_catalog
+    import sql
+    from single_flight import single_flight_metrics
+
+    model = FakeGenerativeModel(latency=latency, jitter=jitter, questions=questions)
+    query_agent.model = model
+    sql.get_connection = lambda: FixtureConnection(fixture_path)
+    sql._pool = None
+    schema_catalog._catalog = fixture_catalog(fixture_path)
+    schema_catalog._last_check = time.monotonic()
+    query_agent.translation_cache.clear()
+    sql.result_cache.clear()
+
+    recorder = StageRecorder(trace_memory=trace_memory)
+    if trace_memory:
+        tracemalloc.start()
+
+    def turn(index):
+        item = questions[index % len(questions)]
+        earlier = [questions[i % len(questions)] for i in range(max(0, index - history_turns), index)]
+        chat_context = [{"user": q["question"], "response": CANNED_ANSWER} for q in earlier]
+        if not cache:
+            query_agent.translation_cache.clear()
+            sql.result_cache.clear()
+        return run_question(recorder, item, chat_context)
+
+    total = passes * len(questions)
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(turn, range(total)))
+    else:
+        for index in range(total):
+            turn(index)
+    wall = time.perf_counter() - started
+
+    report = {
+        "settings": {
+            "passes": passes, "concurrency": concurrency, "latency": latency, "jitter": jitter,
+            "history_turns": history_turns, "scale": scale, "cache": cache, "questions": len(questions),
+        },
+        "stages": recorder.summary(),
+        "total": {
+            "questions": total,
+            "wall_seconds": round(wall, 3),
+            "questions_per_second": round(total / wall, 2) if wall else 0.0,
+            "llm_calls": dict(model.calls),
+            "peak_rss_kib": _peak_rss_kib(),
+        },
+        "caches": {"translation": query_agent.translation_cache.metrics(), "result": sql.result_cache.metrics()},
+        "pool": sql.pool_metrics(),
+        "single_flight": single_flight_metrics(),
+    }
+    if trace_memory:
+        report["total"]["traced_peak_kib"] = round(tracemalloc.get_traced_memory()[1] / 1024, 1)
+        tracemalloc.stop()
+    sql.get_pool().closeall()
+    return report
+
+
+def compare(report, baseline, tolerance):
+    """Return the stages whose p95 is more than `tolerance` (a fraction) slower than the baseline."""
+    regressions = []
+    for stage, stats in report["stages"].items():
+        before = baseline.get("stages", {}).get(stage, {}).get("p95_ms")
+        if before and stats["calls"] and stats["p95_ms"] > before * (1 + tolerance):
+            regressions.append(f"{stage}: p95 {stats['p95_ms']}ms vs baseline {before}ms")
+    return regressions
+
+
+def print_report(report):
+    print(f"{'stage':<26}{'calls':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'calls/s':>10}{'peak KiB':>11}")
+    for stage, stats in report["stages"].items():
+        peak = stats.get("peak_kib", "-")
+        print(f"{stage:<26}{stats['calls']:>7}{stats['p50_ms']:>10}{stats['p95_ms']:>10}"
+              f"{stats['p99_ms']:>10}{stats['calls_per_second']:>10}{peak:>11}")
+    total = report["total"]
+    print(f"📊 {total['questions']} questions in {total['wall_seconds']}s "
+          f"({total['questions_per_second']} questions/s), LLM calls: {total['llm_calls']}, "
+          f"peak RSS: {total['peak_rss_kib']} KiB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline latency/throughput benchmark of the NL -> SQL -> answer pipeline.")
+    parser.add_argument("--passes", type=int, default=3, help="times to run the question corpus")
+    parser.add_argument("--concurrency", type=int, default=1, help="questions answered in parallel")
+    parser.add_argument("--latency", type=float, default=0.3, help="fake model latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.1, help="random extra latency in seconds")
+    parser.add_argument("--history", type=int, default=4, help="earlier turns sent as chat history")
+    parser.add_argument("--scale", type=float, default=1.0, help="fixture size (1.0 is about Pagila's size)")
+    parser.add_argument("--fixture", default=None, help="reuse this SQLite fixture file (built if missing)")
+    parser.add_argument("--no-cache", action="store_true", help="clear the caches before every question")
+    parser.add_argument("--trace-memory", action="store_true", help="per-stage allocation peaks (slower)")
+    parser.add_argument("--output", default=None, help="write the report as JSON")
+    parser.add_argument("--baseline", default=None, help="fail if p95 regresses against this JSON report")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed p95 regression (fraction)")
+    args = parser.parse_args()
+
+    result = run_benchmark(
+        passes=args.passes,
+        concurrency=args.concurrency,
+        latency=args.latency,
+        jitter=args.jitter,
+        history_turns=args.history,
+        scale=args.scale,
+        cache=not args.no_cache,
+        trace_memory=args.trace_memory,
+        fixture_path=args.fixture,
+    )
+    print_report(result)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2, default=str)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            problems = compare(result, json.load(f), args.tolerance)
+        for problem in problems:
+            print("❌ Regression:", problem)
+        if problems:
+            raise SystemExit(1)
+        print("✅ No p95 regressions against the baseline.")
@@ -0,0 +1,203 @@
+import os
+import re
+from collections import OrderedDict
+from functools import lru_cache
+
+import markdown
+from markdown.extensions.tables import TableExtension
+
+from session_store import PENDING_RESPONSE
+
+RENDER_CACHE_SIZE = int(os.getenv("render_cache_size", "200"))
+
+THEME_CSS = {
+    "Dark": """
+        body, .stApp {
+            background-color: #0e1117;
+            color: white;
+        }
+        input, textarea, .sttextInput input, .sttextArea textarea {
+            color: white !important;
+            background-color: #1e1e1e !important;
+            caret-color: white !important;
+            border: 1px solid #555 !important;
+        }
+        .follow-up-box {
+            background-color: #263238;
+            padding: 10px;
+            border-radius: 8px;
+            color: #80cbc4;
+            margin-top: 10px;
+        }
+        button {
+            background-color: #80cbc4 !important;
+            color: black !important;
+        }
+        .user-bubble {
+            text-align: right;
+            background-color: #2c2f36;
+            color: #e0e0e0;
+            padding: 8px 12px;
+            margin-bottom: 6px;
+            border-radius: 10px;
+            max-width: 80%;
+            margin-left: auto;
+        }
+        .bot-bubble {
+            text-align: left;
+            background-color: #1a1a1a;
+            color: white;
+            padding: 10px 14px;
+            margin-bottom: 8px;
+            border-radius: 10px;
+            max-width: 80%;
+            white-space: pre-wrap;
+            line-height: 1.4;
+            overflow-x: auto;
+        }
+        .bot-bubble table {
+            border-collapse: collapse;
+            width: 100%;
+            margin-top: 5px;
+        }
+        .bot-bubble th, .bot-bubble td {
+            border: 1px solid #90caf9;
+            padding: 6px 10px;
+            text-align: left;
+            color: white;
+        }
+        .bot-bubble th {
+            background-color: #2c3e50;
+            font-weight: bold;
+        }
+        .bot-bubble p {
+            margin: 0;
+        }
+        .bot-bubble ul {
+            margin: 0;
+            padding-left: 20px;
+        }
+        .bot-bubble li {
+            margin: 0;
+            padding: 0;
+            line-height: 1.2;
+            list-style-position: inside;
+        }
+        .st-expanderHeader, .st-expanderContent {
+            background-color: #121212 !important;
+            color: white !important;
+        }
+""",
+    "Light": """
+        body, .stApp {
+            background-color: white;
+            color: #1e1e1e;
+        }
+        input, textarea, .sttextInput input, .stTextArea textarea {
+            color: #1e1e1e !important;
+            background-color: white !important;
+            caret-color: black !important;
+            border: 1px solid #ccc !important;
+        }
+        ::placeholder {
+            color: #999 !important;
+        }
+        .follow-up-box {
+            background-color: #e0f7fa;
+            padding: 10px;
+            border-radius: 8px;
+            color: #00796b;
+            margin-top: 10px;
+        }
+        button {
+            background-color: #00796b !important;
+            color: white !important;
+        }
+        .user-bubble {
+            text-align: right;
+            background-color: #f0f0f0;
+            color: #1e1e1e;
+            padding: 8px 12px;
+            margin-bottom: 6px;
+            border-radius: 10px;
+            max-width: 80%;
+            margin-left: auto;
+        }
+        .bot-bubble {
+            text-align: left;
+            background-color: #e3f2fd;
+            color: #1e1e1e;
+            padding: 10px 14px;
+            margin-bottom: 8px;
+            border-radius: 10px;
+            max-widht: 80%;
+            white-space: pre-wrap;
+            line-height: 1.4;
+            overflow-x: auto;
+        }
+""",
+}
+
+
+@lru_cache(maxsize=None)
+def theme_css(theme):
+    """The <style> block of a theme, minified once per process."""
+    css = THEME_CSS.get(theme, THEME_CSS["Light"])
+    css = re.sub(r"\s*([{};:,])\s*", r"\1", css)
+    css = re.sub(r"\s+", " ", css).strip()
+    return f"<style>{css}</style>"
+
+
+def contains_markdown_table(text):
+    return text.strip().startswith("|") and "\n|---" in text
+
+
+def markdown_to_html_table(md):
+    return markdown.markdown(md, extensions=[TableExtension()])
+
+
+def render_turn(user, response):
+    """
+    Convert one chat turn to HTML. Returns (user_html, layout, bot_html) where layout
+    is "table" or "long" (shown in an expander), "plain" or "pending".
+    """
+    user_html = f"<div class='user-bubble'><b>You:</b> {user}</div>"
+    if response == PENDING_RESPONSE:
+        return user_html, "pending", f"<div class='bot-bubble'>{response}</div>"
+    if contains_markdown_table(response):
+        return user_html, "table", f"<div class='bot-bubble'>{markdown_to_html_table(response)}</div>"
+    layout = "long" if response.count("\n") > 10 or len(response) > 600 else "plain"
+    return user_html, layout, f"<div class='bot-bubble'>{response}</div>"
+
+
+class RenderCache:
+    """
+    Rendered HTML per chat turn, keyed by (turn id, theme). A turn is converted
+    again only when its response text changed; pending turns are never cached.
+    """
+
+    def __init__(self, max_entries=RENDER_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()   # (turn id, theme) -> (response, rendered)
+        self.stats = {"hits": 0, "misses": 0}
+
+    def render(self, turn, theme):
+        response = turn["response"]
+        if response == PENDING_RESPONSE:
+            return render_turn(turn["user"], response)
+        key = (turn["id"], theme)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == response:
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[1]
+        self.stats["misses"] += 1
+        rendered = render_turn(turn["user"], response)
+        self._entries[key] = (response, rendered)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return rendered
+
+    def clear(self):
+        self._entries.clear()
@@ -0,0 +1,224 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from psycopg2 import extensions
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection could be checked out before the timeout."""
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of psycopg2 connections.
+    Connections are health-checked on checkout, rolled back on return and
+    closed again once they have been idle longer than `idle_timeout`
+    (never going below `min_size`).
+    """
+
+    def __init__(self, connect, min_size=1, max_size=10, idle_timeout=300.0,
+                 checkout_timeout=30.0, health_check_after=30.0, reap_interval=60.0):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError(f"Invalid pool size: min={min_size}, max={max_size}")
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.health_check_after = health_check_after
+        self.reap_interval = reap_interval
+
+        self._cond = threading.Condition()
+        self._idle = []          # [(conn, returned_at)], most recently returned last
+        self._in_use = set()
+        self._opening = 0
+        self._closed = False
+        self._stats = {
+            "created": 0,
+            "closed": 0,
+            "checkouts": 0,
+            "timeouts": 0,
+            "health_check_failures": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+        }
+
+        for _ in range(min_size):
+            conn = self._new_connection()
+            self._idle.append((conn, time.monotonic()))
+
+        self._reaper = None
+        if reap_interval:
+            self._reaper = threading.Thread(target=self._reap_loop, name="db-pool-reaper", daemon=True)
+            self._reaper.start()
+
+    def _new_connection(self):
+        conn = self._connect()
+        with self._cond:
+            self._stats["created"] += 1
+        return conn
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._stats["closed"] += 1
+
+    def _is_healthy(self, conn, idle_for):
+        if conn.closed:
+            return False
+        if idle_for < self.health_check_after:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchone()
+            cur.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def getconn(self, timeout=None):
+        """Check out a healthy connection, waiting up to `timeout` seconds for one to free up."""
+        timeout = self.checkout_timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+
+        while True:
+            conn = None
+            idle_for = 0.0
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise PoolTimeout("Connection pool is closed")
+                    if self._idle:
+                        conn, returned_at = self._idle.pop()
+                        idle_for = time.monotonic() - returned_at
+                        self._in_use.add(conn)
+                        break
+                    if len(self._in_use) + self._opening < self.max_size:
+                        self._opening += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise PoolTimeout(f"No database connection available after {timeout:.1f}s")
+                    self._cond.wait(remaining)
+
+            if conn is None:
+                try:
+                    conn = self._new_connection()
+                finally:
+                    with self._cond:
+                        self._opening -= 1
+                        if conn is not None:
+                            self._in_use.add(conn)
+                        else:
+                            self._cond.notify()
+            elif not self._is_healthy(conn, idle_for):
+                with self._cond:
+                    self._in_use.discard(conn)
+                    self._stats["health_check_failures"] += 1
+                    self._cond.notify()
+                self._close(conn)
+                continue
+
+            waited = time.monotonic() - started
+            with self._cond:
+                self._stats["checkouts"] += 1
+                self._stats["wait_time_total"] += waited
+                self._stats["wait_time_max"] = max(self._stats["wait_time_max"], waited)
+            return conn
+
+    def putconn(self, conn, discard=False):
+        """Return a connection to the pool, rolling back any open transaction."""
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                discard = True
+        if conn.closed:
+            discard = True
+
+        with self._cond:
+            self._in_use.discard(conn)
+            if not discard and not self._closed:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+                return
+            self._cond.notify()
+        self._close(conn)
+
+    @contextmanager
+    def connection(self, timeout=None):
+        conn = self.getconn(timeout)
+        try:
+            yield conn
+        finally:
+            # Also reached on GeneratorExit when a streaming caller stops early.
+            self.putconn(conn)
+
+    def reap_idle(self):
+        """Close connections idle for longer than `idle_timeout`, keeping at least `min_size` open."""
+        now = time.monotonic()
+        expired = []
+        with self._cond:
+            keep = []
+            total = len(self._idle) + len(self._in_use)
+            # Oldest first, so the most recently used connections survive.
+            for conn, returned_at in self._idle:
+                if now - returned_at > self.idle_timeout and total > self.min_size:
+                    expired.append(conn)
+                    total -= 1
+                else:
+                    keep.append((conn, returned_at))
+            self._idle = keep
+        for conn in expired:
+            self._close(conn)
+        return len(expired)
+
+    def _reap_loop(self):
+        while True:
+            time.sleep(self.reap_interval)
+            if self._closed:
+                return
+            try:
+                self.reap_idle()
+            except Exception as e:
+                print("❌ Connection pool reaper error:", e)
+
+    def metrics(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats["in_use"] = len(self._in_use)
+            stats["idle"] = len(self._idle)
+            stats["size"] = len(self._in_use) + len(self._idle)
+            stats["min_size"] = self.min_size
+            stats["max_size"] = self.max_size
+        checkouts = stats["checkouts"]
+        stats["wait_time_avg"] = stats["wait_time_total"] / checkouts if checkouts else 0.0
+        return stats
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle = [conn for conn, _ in self._idle]
+            self._idle = []
+            self._cond.notify_all()
+        for conn in idle:
+            self._close(conn)
+
+
+def pool_settings_from_env():
+    return {
+        "min_size": int(os.getenv("db_pool_min", "1")),
+        "max_size": int(os.getenv("db_pool_max", "10")),
+        "idle_timeout": float(os.getenv("db_pool_idle_timeout", "300")),
+        "checkout_timeout": float(os.getenv("db_pool_timeout", "30")),
+    }
@@ -0,0 +1,427 @@
+import os
+import time
+import uuid
+
+from psycopg2.extras import execute_values
+
+from sql import get_primary_keys, get_text_columns, pooled_connection, result_cache
+
+DEFAULT_CORRUPTION_REGEX = "Ã|â€™|â€“|â€œ|â€|Ãƒ"
+REPAIR_BATCH_SIZE = int(os.getenv("repair_batch_size", "1000"))
+REPAIR_COMMIT_ROWS = int(os.getenv("repair_commit_rows", "10000"))
+REPAIR_PAGE_SIZE = int(os.getenv("repair_page_size", "1000"))
+REPAIR_THROTTLE = float(os.getenv("repair_throttle", "0"))
+REPAIR_SERVER_SIDE = os.getenv("repair_server_side", "0").lower() in ("1", "true", "yes")
+
+# Session-local helper: latin1 first, then cp1252 for mojibake containing characters such as
+# "€" or "™" that latin1 cannot encode. NULL instead of an error when neither codec yields
+# valid UTF-8, so one bad value cannot abort the whole UPDATE.
+REPAIR_FUNCTION = """
+    CREATE OR REPLACE FUNCTION pg_temp.repair_mojibake(value text) RETURNS text
+    LANGUAGE plpgsql IMMUTABLE AS $$
+    BEGIN
+        BEGIN
+            RETURN convert_from(convert_to(value, 'LATIN1'), 'UTF8');
+        EXCEPTION WHEN untranslatable_character OR character_not_in_repertoire THEN
+            NULL;
+        END;
+        RETURN convert_from(convert_to(value, 'WIN1252'), 'UTF8');
+    EXCEPTION WHEN untranslatable_character OR character_not_in_repertoire THEN
+        RETURN NULL;
+    END
+    $$
+"""
+
+
+def quote_ident(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def repair_value(value):
+    """
+    Return the repaired text, or None when the value is not mojibake. Like
+    pg_temp.repair_mojibake, latin1 is tried first and cp1252 second, for text that
+    went through cp1252 (curly quotes, €, dashes).
+    """
+    if not isinstance(value, str):
+        return None
+    for codec in ("latin1", "cp1252"):
+        try:
+            fixed = value.encode(codec).decode("utf-8")
+        except (UnicodeEncodeError, UnicodeDecodeError):
+            continue
+        return fixed if fixed != value else None
+    return None
+
+
+def column_types(cur, full_table, columns):
+    """Return the SQL type of each column so VALUES lists can be cast to match."""
+    cur.execute(
+        """
+        SELECT a.attname, format_type(a.atttypid, a.atttypmod)
+        FROM pg_attribute a
+        WHERE a.attrelid = %s::regclass AND a.attname = ANY(%s)
+        """,
+        (full_table, list(columns)),
+    )
+    types = dict(cur.fetchall())
+    return [types[col] for col in columns]
+
+
+def _apply_updates(cur, full_table, pk_columns, pk_types, columns, updates):
+    """
+    Write one batch with a single UPDATE ... FROM (VALUES ...). A NULL in a column slot
+    means "leave as is", which is safe because a repaired value is never NULL.
+    """
+    value_names = [f"pk{i}" for i in range(len(pk_columns))] + [f"c{i}" for i in range(len(columns))]
+    assignments = ", ".join(
+        f"{quote_ident(col)} = COALESCE(v.c{i}, t.{quote_ident(col)})" for i, col in enumerate(columns)
+    )
+    match = " AND ".join(f"t.{quote_ident(pk)} = v.pk{i}" for i, pk in enumerate(pk_columns))
+    # Typed keys keep the join on the primary key index (a text literal would not match a uuid key).
+    template = "(" + ", ".join([f"%s::{t}" for t in pk_types] + ["%s::text"] * len(columns)) + ")"
+    execute_values(
+        cur,
+        f"UPDATE {full_table} AS t SET {assignments} "
+        f"FROM (VALUES %s) AS v({', '.join(value_names)}) WHERE {match}",
+        updates,
+        template=template,
+        page_size=len(updates),
+    )
+
+
+def _cursor_batches(reader, query, params, batch_size):
+    """Stream the whole scan through one named server-side cursor."""
+    cur = reader.cursor(name=f"repair_{uuid.uuid4().hex}")
+    cur.itersize = batch_size
+    try:
+        cur.execute(query, params)
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                return
+            yield rows
+    finally:
+        cur.close()
+
+
+def _keyset_batches(reader, query, params, pk_list, pk_types, start_after, page_size, throttle):
+    """
+    Walk the table in primary key order, one short `WHERE (pk) > (last) LIMIT n` query
+    per page, so no snapshot is held open across pages and memory stays at one page.
+    """
+    key_width = len(pk_types)
+    placeholders = ", ".join(f"%s::{t}" for t in pk_types)
+    joiner = " AND " if " WHERE " in query else " WHERE "
+    last = tuple(start_after) if start_after is not None else None
+    cur = reader.cursor()
+    try:
+        while True:
+            if last is None:
+                page_query, page_params = query, list(params)
+            else:
+                page_query = f"{query}{joiner}({pk_list}) > ({placeholders})"
+                page_params = list(params) + list(last)
+            cur.execute(f"{page_query} ORDER BY {pk_list} LIMIT {int(page_size)}", page_params)
+            rows = cur.fetchall()
+            reader.rollback()
+            if not rows:
+                return
+            yield rows
+            if len(rows) < page_size:
+                return
+            last = tuple(rows[-1][:key_width])
+            if throttle:
+                time.sleep(throttle)
+    finally:
+        cur.close()
+
+
+def repair_table(schema, table, columns, pk_columns, corruption_regex=DEFAULT_CORRUPTION_REGEX,
+                 batch_size=None, commit_rows=None, dry_run=False, start_after=None, on_commit=None,
+                 scan_mode=None, page_size=None, throttle=None):
+    """
+    Repair every given text column of one table in a single pass: all columns of a
+    row are fixed together and the changes are written with batched
+    UPDATE ... FROM (VALUES ...), committing every `commit_rows` updated rows.
+    With dry_run=True only the per-column counts are reported.
+
+    scan_mode "cursor" streams matching rows through a server-side cursor; "keyset"
+    reads `page_size` rows per primary key ordered page, sleeping `throttle` seconds
+    between pages. The default is keyset for full scans (no corruption_regex) and
+    cursor otherwise. Composite primary keys are supported in both modes.
+
+    For resumable runs, rows are read in primary key order after `start_after` and
+    on_commit(cursor, last_key, report, finished) is called inside each transaction
+    just before it commits, so progress can be recorded atomically with the fixes.
+    """
+    batch_size = batch_size or REPAIR_BATCH_SIZE
+    commit_rows = commit_rows or REPAIR_COMMIT_ROWS
+    page_size = page_size or REPAIR_PAGE_SIZE
+    throttle = REPAIR_THROTTLE if throttle is None else throttle
+    scan_mode = scan_mode or ("cursor" if corruption_regex else "keyset")
+    if scan_mode not in ("cursor", "keyset"):
+        raise ValueError(f"Unknown scan_mode: {scan_mode}")
+
+    full_table = f"{quote_ident(schema)}.{quote_ident(table)}"
+    select_list = ", ".join(quote_ident(c) for c in pk_columns + columns)
+    pk_list = ", ".join(quote_ident(c) for c in pk_columns)
+    resumable = on_commit is not None or start_after is not None
+
+    report = {"table": f"{schema}.{table}", "scanned": 0, "rows_updated": 0, "fixed": dict.fromkeys(columns, 0)}
+    key_width = len(pk_columns)
+
+    with pooled_connection() as reader, pooled_connection() as writer:
+        write_cur = writer.cursor()
+        uncommitted = 0
+        scanned_since_commit = 0
+        last_key = tuple(start_after) if start_after is not None else None
+        try:
+            pk_types = column_types(write_cur, full_table, pk_columns)
+            writer.commit()
+
+            query = f"SELECT {select_list} FROM {full_table}"
+            params = []
+            if corruption_regex:
+                query += " WHERE (" + " OR ".join(f"{quote_ident(c)} ~ %s" for c in columns) + ")"
+                params.extend([corruption_regex] * len(columns))
+
+            if scan_mode == "keyset":
+                batches = _keyset_batches(reader, query, params, pk_list, pk_types, start_after, page_size, throttle)
+            else:
+                if start_after is not None:
+                    placeholders = ", ".join(f"%s::{t}" for t in pk_types)
+                    query += (" AND " if params else " WHERE ") + f"({pk_list}) > ({placeholders})"
+                    params.extend(start_after)
+                if resumable:
+                    query += f" ORDER BY {pk_list}"
+                batches = _cursor_batches(reader, query, params, batch_size)
+
+            for rows in batches:
+                last_key = tuple(rows[-1][:key_width])
+                scanned_since_commit += len(rows)
+                updates = []
+                for row in rows:
+                    report["scanned"] += 1
+                    fixes = [repair_value(value) for value in row[key_width:]]
+                    if not any(fix is not None for fix in fixes):
+                        continue
+                    for col, fix in zip(columns, fixes):
+                        if fix is not None:
+                            report["fixed"][col] += 1
+                    updates.append(tuple(row[:key_width]) + tuple(fixes))
+
+                report["rows_updated"] += len(updates)
+                if dry_run:
+                    continue
+                if updates:
+                    _apply_updates(write_cur, full_table, pk_columns, pk_types, columns, updates)
+                    uncommitted += len(updates)
+                # Checkpoints also advance through stretches of clean rows.
+                if uncommitted >= commit_rows or (on_commit and scanned_since_commit >= commit_rows):
+                    if on_commit:
+                        on_commit(write_cur, last_key, report, False)
+                    writer.commit()
+                    uncommitted = 0
+                    scanned_since_commit = 0
+            if not dry_run:
+                if on_commit:
+                    on_commit(write_cur, last_key, report, True)
+                writer.commit()
+        finally:
+            write_cur.close()
+
+    if report["rows_updated"] and not dry_run:
+        result_cache.invalidate_tables([f"{schema}.{table}"])
+    for col, count in report["fixed"].items():
+        if dry_run:
+            print(f"🔎 Would fix {count} entries in {schema}.{table}.{col}")
+        else:
+            print(f"✅ Fixed {count} entries in {schema}.{table}.{col}")
+    return report
+
+
+def _key_condition(pk_list, pk_types, name, op):
+    placeholders = ", ".join(f"%({name}{i})s::{t}" for i, t in enumerate(pk_types))
+    return f"({pk_list}) {op} ({placeholders})"
+
+
+def _chunk_upper_key(cur, full_table, pk_list, pk_types, last_key, chunk_rows):
+    """The primary key `chunk_rows` rows after `last_key`, or None when fewer rows are left."""
+    where, params = "", {}
+    if last_key is not None:
+        where = " WHERE " + _key_condition(pk_list, pk_types, "lo", ">")
+        params = {f"lo{i}": value for i, value in enumerate(last_key)}
+    cur.execute(f"SELECT {pk_list} FROM {full_table}{where} ORDER BY {pk_list} OFFSET %(skip)s LIMIT 1",
+                dict(params, skip=int(chunk_rows) - 1))
+    row = cur.fetchone()
+    return tuple(row) if row is not None else None
+
+
+def _server_side_query(full_table, columns, pk_columns, pk_types, corruption_regex, dry_run, lower, upper):
+    """
+    One statement per primary key range (lower, upper]: convert the candidate values with
+    pg_temp.repair_mojibake, update the rows where any column changed and return only
+    counts - rows updated, then per column the fixed and the unconvertible counts.
+    """
+    pk_list = ", ".join(quote_ident(c) for c in pk_columns)
+    candidates = ", ".join(
+        f"{quote_ident(c)} AS o{i}, pg_temp.repair_mojibake({quote_ident(c)}) AS f{i}" for i, c in enumerate(columns)
+    )
+    conditions, params = [], {}
+    if lower is not None:
+        conditions.append(_key_condition(pk_list, pk_types, "lo", ">"))
+        params.update({f"lo{i}": value for i, value in enumerate(lower)})
+    if upper is not None:
+        conditions.append(_key_condition(pk_list, pk_types, "hi", "<="))
+        params.update({f"hi{i}": value for i, value in enumerate(upper)})
+    if corruption_regex:
+        conditions.append("(" + " OR ".join(f"{quote_ident(c)} ~ %(regex)s" for c in columns) + ")")
+        params["regex"] = corruption_regex
+    where = " WHERE " + " AND ".join(conditions) if conditions else ""
+    changed = [f"COALESCE(c.f{i} <> c.o{i}, false)" for i in range(len(columns))]
+    # Without a regex every non-UTF-8 value is "unconvertible"; only regex matches are worth reporting.
+    unconvertible = [
+        f"count(*) FILTER (WHERE f{i} IS NULL AND o{i} ~ %(regex)s)" if corruption_regex else "0"
+        for i in range(len(columns))
+    ]
+
+    if dry_run:
+        query = f"WITH candidates AS (SELECT {candidates} FROM {full_table}{where})"
+        fixed = [f"count(*) FILTER (WHERE {flag})" for flag in changed]
+        query += (
+            f" SELECT count(*) FILTER (WHERE {' OR '.join(changed)}), {', '.join(fixed + unconvertible)}"
+            " FROM candidates c"
+        )
+        return query, params
+
+    # FOR UPDATE locks the candidates first, so a row changed concurrently is converted from its latest value.
+    keys = ", ".join(f"{quote_ident(c)} AS k{i}" for i, c in enumerate(pk_columns))
+    query = f"WITH candidates AS (SELECT {keys}, {candidates} FROM {full_table}{where} FOR UPDATE)"
+    assignments = ", ".join(
+        f"{quote_ident(col)} = CASE WHEN {flag} THEN c.f{i} ELSE t.{quote_ident(col)} END"
+        for i, (col, flag) in enumerate(zip(columns, changed))
+    )
+    match = " AND ".join(f"t.{quote_ident(pk)} = c.k{i}" for i, pk in enumerate(pk_columns))
+    fixed = [f"(SELECT count(*) FILTER (WHERE fixed{i}) FROM updated)" for i in range(len(columns))]
+    query += (
+        f", updated AS (UPDATE {full_table} AS t SET {assignments} FROM candidates c"
+        f" WHERE {match} AND ({' OR '.join(changed)})"
+        f" RETURNING {', '.join(f'{flag} AS fixed{i}' for i, flag in enumerate(changed))})"
+        f" SELECT (SELECT count(*) FROM updated), {', '.join(fixed)},"
+        f" {', '.join(f'(SELECT {expr} FROM candidates)' if corruption_regex else expr for expr in unconvertible)}"
+    )
+    return query, params
+
+
+def repair_table_in_database(schema, table, columns, pk_columns=None, corruption_regex=DEFAULT_CORRUPTION_REGEX,
+                             dry_run=False, commit_rows=None, throttle=None, **scan_options):
+    """
+    Detect and convert mojibake entirely inside Postgres with
+    convert_from(convert_to(col, 'LATIN1'), 'UTF8'), retrying values latin1 cannot
+    represent with WIN1252: rows never leave the server and only counts come back. The
+    table is walked in primary key ranges of `commit_rows` rows, each updated and
+    committed on its own, sleeping `throttle` seconds in between. Values neither codec
+    converts but that still match `corruption_regex` are reported as unconvertible.
+    """
+    commit_rows = commit_rows or REPAIR_COMMIT_ROWS
+    throttle = REPAIR_THROTTLE if throttle is None else throttle
+    full_table = f"{quote_ident(schema)}.{quote_ident(table)}"
+    report = {
+        "table": f"{schema}.{table}", "scanned": None, "rows_updated": 0,
+        "fixed": dict.fromkeys(columns, 0), "unconvertible": dict.fromkeys(columns, 0),
+    }
+    if not pk_columns:
+        print(f"Skipping {schema}.{table} - no suitable primary key found.")
+        return report
+
+    width = len(columns)
+    with pooled_connection() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute("SHOW server_encoding")
+            encoding = cur.fetchone()[0]
+            if encoding.upper() not in ("UTF8", "UTF-8"):
+                conn.rollback()
+                print(f"❌ Server-side repair needs a UTF8 database (found {encoding}); skipping {schema}.{table}.")
+                return report
+            pk_list = ", ".join(quote_ident(c) for c in pk_columns)
+            pk_types = column_types(cur, full_table, pk_columns)
+            # pg_temp functions live as long as the session, so the chunks below can commit.
+            cur.execute(REPAIR_FUNCTION)
+            conn.commit()
+
+            lower = None
+            while True:
+                upper = _chunk_upper_key(cur, full_table, pk_list, pk_types, lower, commit_rows)
+                query, params = _server_side_query(full_table, columns, pk_columns, pk_types, corruption_regex,
+                                                   dry_run, lower, upper)
+                cur.execute(query, params)
+                counts = cur.fetchone()
+                if dry_run:
+                    conn.rollback()
+                else:
+                    conn.commit()
+                report["rows_updated"] += counts[0]
+                for i, col in enumerate(columns):
+                    report["fixed"][col] += counts[1 + i]
+                    report["unconvertible"][col] += counts[1 + width + i]
+                if upper is None:
+                    break
+                lower = upper
+                if throttle:
+                    time.sleep(throttle)
+        finally:
+            cur.close()
+
+    if report["rows_updated"] and not dry_run:
+        result_cache.invalidate_tables([f"{schema}.{table}"])
+    for col, count in report["fixed"].items():
+        if dry_run:
+            print(f"🔎 Would fix {count} entries in {schema}.{table}.{col}")
+        else:
+            print(f"✅ Fixed {count} entries in {schema}.{table}.{col}")
+        if report["unconvertible"][col]:
+            print(f"⚠️ {report['unconvertible'][col]} entries in {schema}.{table}.{col} match the corruption "
+                  f"pattern but could not be converted as latin1 or cp1252")
+    return report
+
+
+def primary_keys_by_table():
+    keys = {}
+    for schema, table, column, _ in get_primary_keys():
+        keys.setdefault((schema, table), []).append(column)
+    return keys
+
+
+def text_columns_by_table():
+    tables = {}
+    for schema, table, column in get_text_columns():
+        tables.setdefault((schema, table), []).append(column)
+    return tables
+
+
+def fix_all_encoding_issues(corruption_regex=DEFAULT_CORRUPTION_REGEX, dry_run=False, batch_size=None,
+                            commit_rows=None, scan_mode=None, page_size=None, throttle=None, server_side=None):
+    """
+    Repair all text/varchar/char columns, one pass per table.
+    `corruption_regex` can be changed or set to None for full scan.
+    With server_side=True (default: repair_server_side) the work is done inside Postgres.
+    """
+    server_side = REPAIR_SERVER_SIDE if server_side is None else server_side
+    keys = primary_keys_by_table()
+    reports = []
+    for (schema, table), columns in text_columns_by_table().items():
+        pk_columns = keys.get((schema, table))
+        scan_options = {"batch_size": batch_size, "commit_rows": commit_rows,
+                        "scan_mode": scan_mode, "page_size": page_size, "throttle": throttle}
+        if not pk_columns:
+            print(f"Skipping {schema}.{table} - no suitable primary key found.")
+            continue
+        repair = repair_table_in_database if server_side else repair_table
+        try:
+            reports.append(repair(schema, table, columns, pk_columns, corruption_regex,
+                                  dry_run=dry_run, **scan_options))
+        except Exception as e:
+            print(f"❌ Error processing {schema}.{table}:", e)
+    return reports
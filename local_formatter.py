@@ -0,0 +1,126 @@
+import datetime
+import os
+import re
+import threading
+from decimal import Decimal
+
+LOCAL_FORMATTER = os.getenv("local_formatter", "1").lower() not in ("0", "false", "no")
+
+# Questions that ask for explanation, comparison, charts or rewording need Gemini's prose.
+NEEDS_PROSE = re.compile(
+    r"\b(why|how come|explain|describe|compare|comparison|summar\w*|insight\w*|trend\w*|analy\w*|"
+    r"recommend\w*|suggest\w*|chart|plot|graph|visuali\w*|pie|rephrase|reword|rewrite|simplify|"
+    r"shorter|paragraph|story|bullets?)\b",
+    re.IGNORECASE,
+)
+WANTS_TABLE = re.compile(r"\b(table|tabular)\b", re.IGNORECASE)
+
+NO_DATA_ANSWER = "I dont have any data for this question."
+MAX_LISTED_ROWS = 50
+
+_lock = threading.Lock()
+_stats = {"local": 0, "llm": 0}
+
+
+def serialize_value(val):
+    """Make a database value JSON-friendly (durations as text, dates ISO, numbers rounded)."""
+    if isinstance(val, datetime.timedelta):
+        days = val.days
+        hours = val.seconds // 3600
+        minutes = (val.seconds % 3600) // 60
+        text = f"{days} days"
+        if hours:
+            text += f", {hours} hours"
+        if minutes:
+            text += f", {minutes} minutes"
+        return text
+    if isinstance(val, (datetime.datetime, datetime.date)):
+        return val.isoformat()
+    if isinstance(val, (float, Decimal)):
+        return round(float(val), 2)
+    return val
+
+
+def serialize_rows(columns, rows):
+    return [{col: serialize_value(val) for col, val in zip(columns, r)} for r in rows]
+
+
+def _label(column):
+    return column.replace("_", " ")
+
+
+def _text(val):
+    val = serialize_value(val)
+    if val is None:
+        return "N/A"
+    if isinstance(val, float):
+        return f"{val:,.2f}"
+    return str(val)
+
+
+def _sentence(columns, row):
+    parts = [f"{_label(col)} {_text(val)}" for col, val in zip(columns, row)]
+    if len(parts) == 1:
+        return f"The {_label(columns[0])} is {_text(row[0])}."
+    return f"The result has {', '.join(parts[:-1])} and {parts[-1]}."
+
+
+def _table(columns, rows):
+    lines = [
+        "| " + " | ".join(_label(col).title() for col in columns) + " |",
+        "|" + "|".join("---" for _ in columns) + "|",
+    ]
+    for row in rows:
+        lines.append("| " + " | ".join(_text(val).replace("|", "\\|") for val in row) + " |")
+    return "\n".join(lines)
+
+
+def _bullets(columns, rows):
+    lines = []
+    for row in rows[:MAX_LISTED_ROWS]:
+        if len(columns) == 1:
+            lines.append(f"- {_text(row[0])}")
+        else:
+            lines.append("- " + ", ".join(f"{_label(col)}: {_text(val)}" for col, val in zip(columns, row)))
+    return "\n".join(lines)
+
+
+def format_locally(user_question, columns, rows, truncated=False):
+    """
+    Render the result with the formatting prompt's own size rules, or return None
+    when the question needs prose that only Gemini can write.
+    """
+    if not LOCAL_FORMATTER or NEEDS_PROSE.search(user_question):
+        _count("llm")
+        return None
+
+    if not rows or not columns:
+        answer = NO_DATA_ANSWER
+    elif len(rows) == 1 and len(columns) <= 3 and not WANTS_TABLE.search(user_question):
+        answer = _sentence(columns, rows[0])
+    elif (2 <= len(columns) <= 4 and len(rows) <= 20) or (WANTS_TABLE.search(user_question) and len(rows) <= MAX_LISTED_ROWS):
+        answer = _table(columns, rows)
+    else:
+        answer = _bullets(columns, rows)
+        hidden = len(rows) - MAX_LISTED_ROWS
+        if truncated:
+            answer += f"\n- …showing the first {min(len(rows), MAX_LISTED_ROWS)} rows; the full result is larger."
+        elif hidden > 0:
+            answer += f"\n- …and {hidden} more rows."
+
+    _count("local")
+    return answer
+
+
+def _count(path):
+    with _lock:
+        _stats[path] += 1
+
+
+def formatter_metrics():
+    with _lock:
+        stats = dict(_stats)
+    total = stats["local"] + stats["llm"]
+    stats["enabled"] = LOCAL_FORMATTER
+    stats["local_rate"] = stats["local"] / total if total else 0.0
+    return stats
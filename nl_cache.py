@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Follow-ups like "what about her?" depend on the conversation, not just the text.
+CONTEXTUAL_WORDS = re.compile(
+    r"\b(this|that|these|those|it|its|he|him|his|she|her|they|them|their|same|previous|above|earlier|again)\b",
+    re.IGNORECASE,
+)
+
+
+def normalize_question(question):
+    text = question.strip().lower()
+    text = text.replace("’", "'").replace("“", '"').replace("”", '"')
+    text = re.sub(r"\s+", " ", text)
+    return text.rstrip(" ?.!")
+
+
+def schema_fingerprint(schemas):
+    payload = json.dumps(schemas, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def is_cacheable_question(question):
+    return not CONTEXTUAL_WORDS.search(question)
+
+
+class TranslationCache:
+    """
+    LRU/TTL cache of english_to_sql results keyed on the normalized question and
+    the schema fingerprint. An optional SQLite file keeps entries across restarts.
+    """
+
+    def __init__(self, max_entries=1000, ttl=86400.0, path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> (stored_at, value)
+        self._fingerprint = None
+        self._db = None
+        self.stats = {"hits": 0, "misses": 0, "disk_hits": 0, "evictions": 0, "expired": 0, "invalidated": 0}
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS translations (
+                    key TEXT PRIMARY KEY,
+                    fingerprint TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    stored_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+                """
+            )
+            self._db.commit()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_entries=int(os.getenv("nl_cache_size", "1000")),
+            ttl=float(os.getenv("nl_cache_ttl", "86400")),
+            path=os.getenv("nl_cache_path") or None,
+        )
+
+    @staticmethod
+    def make_key(question, fingerprint):
+        raw = f"{fingerprint}\x00{normalize_question(question)}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _check_fingerprint(self, fingerprint):
+        """Drop every entry built against a different schema text."""
+        if fingerprint == self._fingerprint:
+            return
+        dropped = len(self._entries) if self._fingerprint is not None else 0
+        self._entries.clear()
+        if self._db is not None:
+            # The file is the superset of what is in memory.
+            cur = self._db.execute("DELETE FROM translations WHERE fingerprint != ?", (fingerprint,))
+            dropped = cur.rowcount
+            self._db.commit()
+        self.stats["invalidated"] += dropped
+        self._fingerprint = fingerprint
+
+    def get(self, question, fingerprint):
+        key = self.make_key(question, fingerprint)
+        now = time.time()
+        with self._lock:
+            self._check_fingerprint(fingerprint)
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored_at, value = entry
+                if now - stored_at <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return dict(value)
+                del self._entries[key]
+                self.stats["expired"] += 1
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, stored_at FROM translations WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    value, stored_at = json.loads(row[0]), row[1]
+                    if now - stored_at <= self.ttl:
+                        self._db.execute("UPDATE translations SET accessed_at = ? WHERE key = ?", (now, key))
+                        self._db.commit()
+                        self._remember(key, stored_at, value)
+                        self.stats["hits"] += 1
+                        self.stats["disk_hits"] += 1
+                        return dict(value)
+                    self._db.execute("DELETE FROM translations WHERE key = ?", (key,))
+                    self._db.commit()
+                    self.stats["expired"] += 1
+
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, question, fingerprint, value):
+        key = self.make_key(question, fingerprint)
+        now = time.time()
+        value = dict(value)
+        with self._lock:
+            self._check_fingerprint(fingerprint)
+            self._remember(key, now, value)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?, ?)",
+                    (key, fingerprint, json.dumps(value), now, now),
+                )
+                overflow = self._db.execute("SELECT COUNT(*) FROM translations").fetchone()[0] - self.max_entries
+                if overflow > 0:
+                    self._db.execute(
+                        "DELETE FROM translations WHERE key IN "
+                        "(SELECT key FROM translations ORDER BY accessed_at LIMIT ?)",
+                        (overflow,),
+                    )
+                self._db.commit()
+
+    def _remember(self, key, stored_at, value):
+        self._entries[key] = (stored_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM translations")
+                self._db.commit()
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self._entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
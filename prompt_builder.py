@@ -0,0 +1,178 @@
+import os
+import re
+import threading
+from collections import deque
+
+HISTORY_TOKEN_BUDGET = int(os.getenv("history_token_budget", "1500"))
+HISTORY_TURN_TOKENS = int(os.getenv("history_turn_tokens", "300"))
+HISTORY_SUMMARY_TOKENS = int(os.getenv("history_summary_tokens", "150"))
+SCHEMA_FILTER = os.getenv("schema_filter", "1").lower() not in ("0", "false", "no")
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+TABLE_LINE = re.compile(r"^\s*-\s*(\w+)\.(\w+)\(([^)]*)\)\s*$")
+
+# Words users say for tables whose names they never type.
+SYNONYMS = {
+    "revenue": "payment", "sales": "payment", "earning": "payment", "earnings": "payment",
+    "income": "payment", "paid": "payment", "spent": "payment", "spend": "payment",
+    "rent": "rental", "rented": "rental", "rentals": "rental", "returned": "rental",
+    "movie": "film", "movies": "film", "genre": "category", "genres": "category",
+    "employee": "staff", "employees": "staff", "manager": "staff", "stock": "inventory",
+    "copies": "inventory", "cast": "actor", "actors": "actor",
+}
+GENERIC_COLUMNS = {"last_update", "id", "name"}
+
+_lock = threading.Lock()
+_recent = deque(maxlen=200)
+
+
+def count_tokens(text):
+    """Local token estimate: words and punctuation, with long words counted per 4 characters."""
+    return sum(max(1, (len(tok) + 3) // 4) for tok in TOKEN_PATTERN.findall(text))
+
+
+def _truncate(text, max_tokens):
+    if count_tokens(text) <= max_tokens:
+        return text
+    kept = []
+    used = 0
+    for tok in re.split(r"(\s+)", text):
+        cost = count_tokens(tok)
+        if used + cost > max_tokens:
+            break
+        kept.append(tok)
+        used += cost
+    return "".join(kept).rstrip() + " …"
+
+
+def build_history(chat_context, budget=None):
+    """
+    Return (history_text, turns_kept, turns_summarized) keeping the most recent turns
+    that fit in `budget` tokens, newest first like the original prompt. Older turns
+    are reduced to a one-line list of their questions.
+    """
+    budget = HISTORY_TOKEN_BUDGET if budget is None else budget
+    if not chat_context:
+        return "", 0, 0
+
+    lines = []
+    used = 0
+    kept = 0
+    for entry in reversed(chat_context):
+        turn = f"User: {entry['user']}\nBot: {_truncate(entry.get('response', ''), HISTORY_TURN_TOKENS)}\n"
+        cost = count_tokens(turn)
+        if used + cost > budget:
+            break
+        lines.append(turn)
+        used += cost
+        kept += 1
+
+    older = chat_context[:len(chat_context) - kept]
+    if older:
+        questions = "; ".join(entry["user"] for entry in older)
+        lines.append(f"(Earlier questions, oldest first: {_truncate(questions, HISTORY_SUMMARY_TOKENS)})\n")
+    return "".join(lines), kept, len(older)
+
+
+def question_words(text):
+    words = set()
+    for word in re.findall(r"[a-z]+", text.lower()):
+        words.add(word)
+        if word.endswith("es"):
+            words.add(word[:-2])
+        if word.endswith("s"):
+            words.add(word[:-1])
+        if word in SYNONYMS:
+            words.add(SYNONYMS[word])
+    return words
+
+
+def parse_schema_tables(definition):
+    """Split a schema blob into (header_lines, {table: (line, columns)})."""
+    header = []
+    tables = {}
+    for line in definition.splitlines():
+        match = TABLE_LINE.match(line)
+        if match:
+            columns = [c.strip() for c in match.group(3).split(",")]
+            tables[f"{match.group(1)}.{match.group(2)}"] = (line, columns)
+        elif line.strip():
+            header.append(line)
+    return header, tables
+
+
+def relevant_tables(question, tables):
+    """Tables whose name or distinctive columns appear in the question, plus the tables they reference."""
+    words = question_words(question)
+    selected = set()
+    for name, (_, columns) in tables.items():
+        table = name.split(".", 1)[1]
+        if table in words or set(table.split("_")) <= words:
+            selected.add(name)
+            continue
+        for col in columns:
+            if col not in GENERIC_COLUMNS and (col in words or set(col.split("_")) <= words):
+                selected.add(name)
+                break
+    if not selected:
+        return set(tables)
+
+    # One hop along "<table>_id" columns so the join path is available.
+    by_key = {f"{name.split('.', 1)[1]}_id": name for name in tables}
+    for name in list(selected):
+        for col in tables[name][1]:
+            target = by_key.get(col)
+            if target:
+                selected.add(target)
+    return selected
+
+
+def select_schema_text(question, schemas, index=None):
+    """
+    Render the schema text with only the tables relevant to `question`, using the
+    database-backed SchemaIndex when one is available and the SCHEMAS text otherwise.
+    """
+    blocks = []
+    tables_used = []
+    if index is not None and SCHEMA_FILTER:
+        selected = index.search(question)
+        for schema_name in schemas:
+            names = [name for name in selected if name.split(".", 1)[0] == schema_name]
+            blocks.append(f"Schema ({schema_name}):\n    Tables:\n{index.render(names)}")
+            tables_used.extend(names)
+        return "\n\n".join(blocks), tables_used
+
+    for schema_name, definition in schemas.items():
+        header, tables = parse_schema_tables(definition)
+        if not SCHEMA_FILTER or not tables:
+            blocks.append(f"Schema ({schema_name}):\n{definition}")
+            tables_used.extend(tables)
+            continue
+        keep = relevant_tables(question, tables)
+        lines = header + [line for name, (line, _) in tables.items() if name in keep]
+        blocks.append(f"Schema ({schema_name}):\n" + "\n".join(lines))
+        tables_used.extend(name for name in tables if name in keep)
+    return "\n\n".join(blocks), tables_used
+
+
+def record_prompt(kind, prompt, **details):
+    """Remember the size of a prompt sent to Gemini and return the stats entry."""
+    entry = {"kind": kind, "prompt_tokens": count_tokens(prompt), "prompt_chars": len(prompt)}
+    entry.update(details)
+    with _lock:
+        _recent.append(entry)
+    return entry
+
+
+def prompt_metrics():
+    with _lock:
+        recent = list(_recent)
+    stats = {}
+    for entry in recent:
+        kind = stats.setdefault(entry["kind"], {"calls": 0, "avg_tokens": 0.0, "max_tokens": 0})
+        kind["calls"] += 1
+        kind["avg_tokens"] += entry["prompt_tokens"]
+        kind["max_tokens"] = max(kind["max_tokens"], entry["prompt_tokens"])
+    for kind in stats.values():
+        kind["avg_tokens"] = round(kind["avg_tokens"] / kind["calls"], 1)
+    return {"recent": recent[-10:], "by_kind": stats}
@@ -1,17 +1,44 @@
-import google.generativeai as genai
 import os
+import hashlib
 import json
 import re
+import threading
 from dotenv import load_dotenv
 import datetime
-import streamlit as st
+import time
 from decimal import Decimal
 
+from local_formatter import format_locally, serialize_rows
+from nl_cache import TranslationCache, is_cacheable_question, normalize_question, schema_fingerprint
+from prompt_builder import build_history, count_tokens, record_prompt, select_schema_text
+from query_templates import question_shape, rebind_sql, sql_binds_values
+from query_guard import QueryRejected, guard_query
+from schema_catalog import get_catalog, get_schema_index
+from session_store import SessionContext
+from single_flight import single_flight
+from sql_validator import InvalidSQL, validate_sql
+from tracing import span
+
 load_dotenv()
 
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-model = genai.GenerativeModel("gemini-2.5-flash")
+GEMINI_MODEL = os.getenv("gemini_model", "gemini-2.5-flash")
+
+# Created on first use by get_model(), so importing the agent does not load the Gemini client.
+model = None
+_model_lock = threading.Lock()
+
+def get_model():
+    """The Gemini model, configured on first use (tests and the benchmark may assign `model` directly)."""
+    global model
+    if model is None:
+        with _model_lock:
+            if model is None:
+                import google.generativeai as genai
+                genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+                model = genai.GenerativeModel(GEMINI_MODEL)
+    return model
 
+# Used only when neither a schema snapshot nor the database catalog is available.
 SCHEMAS = {
     "public": """
     Tables in Pagila:
@@ -34,6 +61,35 @@ SCHEMAS = {
     """
 }
 
+translation_cache = TranslationCache.from_env()
+
+# Larger results are sent to the formatting prompt as a prefix plus per-column aggregates.
+PROMPT_ROW_LIMIT = int(os.getenv("prompt_row_limit", "50"))
+
+STREAM_RESPONSES = os.getenv("stream_responses", "1").lower() not in ("0", "false", "no")
+
+# Regenerations after the validator or the cost guard rejects a query.
+SQL_REGENERATE_ATTEMPTS = int(os.getenv("sql_regenerate_attempts", "1"))
+
+def get_schemas():
+    """Schema texts rendered from the live catalog, falling back to the hand-written SCHEMAS."""
+    catalog = get_catalog(list(SCHEMAS))
+    if catalog is None or not catalog.tables:
+        return SCHEMAS
+    return catalog.schema_texts()
+
+_fallback_fingerprint = None
+
+def current_schema_fingerprint():
+    """Fingerprint of the schema text, used to key the translation cache."""
+    global _fallback_fingerprint
+    catalog = get_catalog(list(SCHEMAS))
+    if catalog is not None and catalog.tables:
+        return catalog.fingerprint()
+    if _fallback_fingerprint is None:
+        _fallback_fingerprint = schema_fingerprint(SCHEMAS)
+    return _fallback_fingerprint
+
 def extract_json(response):
     try:
         match = re.search(r"{[\s\S]+}", response)
@@ -43,33 +99,45 @@ def extract_json(response):
     except json.JSONDecodeError:
         return {}
 
-def english_to_sql(prompt, chat_context=None):
-    if re.search(r'\b(format|clean|style|table|tabular|list|bullets|rewrite|shorter|rephrase|reword|simplify|again|visual|text-based|in text|as table|re-display)\b', prompt, re.IGNORECASE):
-        last_data = st.session_state.get("last_result")
-        if not last_data:
+def _context(session):
+    """The caller's SessionContext, or a one-off context for stateless calls."""
+    return session if session is not None else SessionContext()
+
+def prepare_sql_request(prompt, chat_context=None, feedback=None, session=None):
+    """
+    Return (answer, None) when the request can be answered without Gemini
+    (reformat requests, cache hits), otherwise (None, full_prompt).
+    `feedback` explains why a previous attempt was rejected and forces a new generation.
+    `session` is the caller's SessionContext; without one there is no earlier result.
+    """
+    # A reformat request needs an earlier turn; a first question like "list all films" is a real query.
+    if feedback is None and chat_context and re.search(r'\b(format|clean|style|table|tabular|list|bullets|rewrite|shorter|rephrase|reword|simplify|again|visual|text-based|in text|as table|re-display)\b', prompt, re.IGNORECASE):
+        last_data = _context(session).last_result
+        if last_data is None:
             return {
                 "sql": None,
                 "follow_up": None,
                 "force_format_response": "I'm sorry, I can't reformat because there is no recent data available. Can you please restate your original question?"
-            }
+            }, None
 
         return {
             "sql": None,
             "follow_up": None,
             "force_format_response": {
-                "question": last_data["question"],
-                "columns": last_data["columns"],
-                "rows": last_data["rows"],
+                "question": last_data.question,
+                "columns": last_data.columns,
+                "rows": last_data.rows(),
                 "format_hint": prompt
             }
-        }
+        }, None
 
-    history_text = ""
-    if chat_context:
-        for entry in reversed(chat_context):
-            history_text += f"User: {entry['user']}\nBot: {entry.get('response', '')}\n"
+    if feedback is None and is_cacheable_question(prompt):
+        cached = translation_cache.get(prompt, current_schema_fingerprint()) or cached_template(prompt)
+        if cached is not None:
+            return cached, None
 
-    schema_text = "\n\n".join([f"Schema ({name}):\n{definition}" for name, definition in SCHEMAS.items()])
+    history_text, turns_kept, turns_summarized = build_history(chat_context)
+    schema_text, tables = select_schema_text(prompt, get_schemas(), get_schema_index(list(SCHEMAS)))
 
     full_prompt = f"""
 You are an intelligent SQL generator assistant for multiple PostgreSQL schemas.
@@ -138,42 +206,174 @@ Conversation so far:
 {history_text}
 User: {prompt}
 """
+    if feedback:
+        full_prompt += f"\n{feedback}\n"
+    record_prompt("sql_retry" if feedback else "sql", full_prompt,
+                  tables=len(tables), turns_kept=turns_kept, turns_summarized=turns_summarized)
+    return None, full_prompt
 
-    try:
-        response = model.generate_content(full_prompt).text
-        return extract_json(response)
-    except Exception:
-        return {
-            "schema": None,
-            "sql": None,
-            "response": "Sorry, I couldn't process that.",
-            "follow_up": None
-        }
-
-def generate_final_response(user_question, columns, rows):
-    rows_json = []
-    for r in rows:
-        row_dict = {}
-        for col, val in zip(columns, r):
-            if isinstance(val, datetime.timedelta):
-                days = val.days
-                hours = val.seconds // 3600
-                minutes = (val.seconds % 3600) // 60
-                text = f"{days} days"
-                if hours:
-                    text += f", {hours} hours"
-                if minutes:
-                    text += f", {minutes} minutes"
-                row_dict[col] = text
-            elif isinstance(val, (datetime.datetime, datetime.date)):
-                row_dict[col] = val.isoformat()
-            elif isinstance(val, (float, Decimal)):
-                row_dict[col] = round(float(val), 2)
+def cached_template(prompt):
+    """
+    A cached translation of a question that differs from `prompt` only in its numbers or
+    quoted values ("revenue for store 1" vs "store 2"), with the new values put in its SQL.
+    """
+    shape, values = question_shape(prompt)
+    if not values:
+        return None
+    cached = translation_cache.get(shape, current_schema_fingerprint())
+    if cached is None:
+        return None
+    old_values = cached.pop("question_values", None)
+    sql = rebind_sql(cached["sql"], old_values, values) if old_values and cached.get("sql") else None
+    if sql is None:
+        return None
+    return dict(cached, sql=sql)
+
+def finish_sql_request(prompt, response_text):
+    parsed = extract_json(response_text)
+    if parsed and is_cacheable_question(prompt):
+        fingerprint = current_schema_fingerprint()
+        translation_cache.put(prompt, fingerprint, parsed)
+        shape, values = question_shape(prompt)
+        # Reusable for other values only when each value of the question is exactly one literal of the SQL.
+        if values and isinstance(parsed.get("sql"), str) and sql_binds_values(parsed["sql"], values):
+            translation_cache.put(shape, fingerprint, dict(parsed, question_values=values))
+    return parsed
+
+SQL_REQUEST_FAILED = {
+    "schema": None,
+    "sql": None,
+    "response": "Sorry, I couldn't process that.",
+    "follow_up": None
+}
+
+# The answers shown in place of a Gemini reply when the call failed.
+FAILED_ANSWER_PREFIXES = ("Gemini error:", "Error formatting response:")
+
+def is_failed_answer(answer):
+    """True for the error text gemini_direct_answer and generate_final_response return when Gemini failed."""
+    return isinstance(answer, str) and answer.startswith(FAILED_ANSWER_PREFIXES)
+
+def _generate(prompt, kind):
+    """Call Gemini inside a `gemini_<kind>` span that records prompt and response tokens."""
+    with span(f"gemini_{kind}") as s:
+        response = get_model().generate_content(prompt)
+        text = response.text
+        if s.recording:
+            usage = getattr(response, "usage_metadata", None)
+            s.set(
+                prompt_tokens=getattr(usage, "prompt_token_count", None) or count_tokens(prompt),
+                response_tokens=getattr(usage, "candidates_token_count", None) or count_tokens(text),
+            )
+        return text
+
+def _generate_stream(prompt, kind, cleaner):
+    """Yield cleaned chunks of a streamed Gemini call inside a `gemini_<kind>` span."""
+    with span(f"gemini_{kind}", stream=True) as s:
+        started = time.perf_counter()
+        for chunk in get_model().generate_content(prompt, stream=True):
+            piece = cleaner.feed(_chunk_text(chunk))
+            if piece:
+                if s.recording and "first_chunk_ms" not in s.attrs:
+                    s.set(first_chunk_ms=round((time.perf_counter() - started) * 1000, 1))
+                yield piece
+        if s.recording:
+            s.set(prompt_tokens=count_tokens(prompt), response_tokens=count_tokens(cleaner.text))
+
+def english_to_sql(prompt, chat_context=None, feedback=None, session=None):
+    with span("english_to_sql") as s:
+        with span("build_sql_prompt"):
+            answer, full_prompt = prepare_sql_request(prompt, chat_context, feedback, session)
+        if answer is not None:
+            if answer.get("force_format_response") is not None:
+                s.set(reformat=True)
             else:
-                row_dict[col] = val
-        rows_json.append(row_dict)
+                s.set(cache_hit=True)
+            return answer
+        s.set(cache_hit=False)
+        try:
+            return dict(single_flight("english_to_sql").do(sql_flight_key(prompt, full_prompt, feedback),
+                                                           _translate, prompt, full_prompt))
+        except Exception as e:
+            return dict(SQL_REQUEST_FAILED, error=f"{type(e).__name__}: {e}")
+
+def sql_flight_key(prompt, full_prompt, feedback=None):
+    """
+    Requests sharing this key get the same translation: the normalized question and
+    schema for questions the translation cache would share, the exact prompt otherwise.
+    """
+    if feedback is None and is_cacheable_question(prompt):
+        return ("question", normalize_question(prompt), current_schema_fingerprint())
+    return ("prompt", hashlib.sha1(full_prompt.encode("utf-8")).hexdigest())
+
+def _translate(prompt, full_prompt):
+    return finish_sql_request(prompt, _generate(full_prompt, "sql"))
+
+def rejection_message(error):
+    if isinstance(error, QueryRejected):
+        return f"{error}. Please narrow the question (e.g. a date range or a top N)."
+    return f"{error}. Please rephrase the question."
+
+def check_sql(sql_query):
+    """Validate and canonicalize one generated query, then run the EXPLAIN cost guard on it."""
+    return guard_query(validate_sql(sql_query, get_catalog(list(SCHEMAS))))
+
+def english_to_guarded_sql(prompt, chat_context=None, session=None, translate=None, check=None):
+    """
+    english_to_sql followed by local validation (the canonical SQL is kept) and the
+    EXPLAIN cost guard. A rejected query is sent back to Gemini with the problems or the
+    plan summary up to SQL_REGENERATE_ATTEMPTS times; if it is still rejected, "sql" is
+    None and "rejected" carries the reason. `translate` and `check` stand in for
+    english_to_sql and check_sql (the batch runner wraps them in its concurrency limits).
+    """
+    translate = translate or english_to_sql
+    check = check or check_sql
+    parsed = translate(prompt, chat_context, session=session)
+    for attempt in range(SQL_REGENERATE_ATTEMPTS + 1):
+        sql_query = parsed.get("sql")
+        if not sql_query or sql_query.strip().lower() == "null":
+            return parsed
+        try:
+            return dict(parsed, sql=check(sql_query))
+        except (InvalidSQL, QueryRejected) as e:
+            print("❌", e)
+            if attempt == SQL_REGENERATE_ATTEMPTS:
+                return dict(parsed, sql=None, rejected=rejection_message(e))
+            parsed = translate(prompt, chat_context, feedback=e.feedback(), session=session)
+    return parsed
+
+def summarize_columns(columns, rows):
+    """Per-column count/distinct and numeric min/max/sum/avg over `rows`."""
+    stats = {}
+    for index, col in enumerate(columns):
+        values = [r[index] for r in rows if r[index] is not None]
+        info = {"non_null": len(values)}
+        numbers = [float(v) for v in values if isinstance(v, (int, float, Decimal)) and not isinstance(v, bool)]
+        if numbers and len(numbers) == len(values):
+            info.update({
+                "min": round(min(numbers), 2),
+                "max": round(max(numbers), 2),
+                "sum": round(sum(numbers), 2),
+                "avg": round(sum(numbers) / len(numbers), 2),
+            })
+        else:
+            info["distinct"] = len({str(v) for v in values})
+        stats[col] = info
+    return stats
+
+def build_formatting_prompt(user_question, columns, rows, truncated=False):
+    """Return (formatting_prompt, rows_json) for the result-formatting Gemini call."""
+    prompt_rows = rows[:PROMPT_ROW_LIMIT]
+    rows_json = serialize_rows(columns, prompt_rows)
 
     formatted_data = json.dumps(rows_json, separators=(',', ':'))
+    if truncated or len(rows) > len(prompt_rows):
+        total = f"more than {len(rows)}" if truncated else str(len(rows))
+        stats_json = json.dumps(summarize_columns(columns, rows), separators=(',', ':'))
+        formatted_data += (
+            f"\n\nOnly the first {len(prompt_rows)} of {total} rows are shown above. "
+            f"Aggregate statistics over the {len(rows)} fetched rows:\n{stats_json}"
+        )
 
     formatting_prompt = f"""
 You are a helpful assistant. Given the user's question and the database results in JSON, return a clean, readable answer.
@@ -229,36 +429,104 @@ If the result has exactly one row and 3 or fewer columns, you MUST respond with
 
 Return the cleaned, user-friendly answer only:
 """
+    record_prompt("format", formatting_prompt, rows=len(rows_json))
+    return formatting_prompt, rows_json
 
-    try:
-        response = model.generate_content(formatting_prompt)
-        raw_response = response.text.strip()
+def finish_final_response(response_text, user_question, columns, rows_json, session=None):
+    """Tidy the formatted answer and remember the result for follow-up questions."""
+    raw_response = response_text.strip()
 
-        cleaned_response = re.sub(r'\n{3,}', '\n\n', raw_response)
-        cleaned_response = re.sub(r'(\n\s*)+\Z', '', cleaned_response)
-        cleaned_response = re.sub(r' +\n', '\n', cleaned_response)
+    cleaned_response = re.sub(r'\n{3,}', '\n\n', raw_response)
+    cleaned_response = re.sub(r'(\n\s*)+\Z', '', cleaned_response)
+    cleaned_response = re.sub(r' +\n', '\n', cleaned_response)
 
 
-        st.session_state["last_result_summary"] = {
-            "columns": columns,
-            "rows": rows_json,
-            "user_question": user_question
-        }
+    # The rows themselves live once, in columnar form, in the session's last result.
+    entities = []
+    if rows_json and columns:
+        top_row = rows_json[0]
+        for col in columns:
+            val = top_row.get(col)
+            if isinstance(val, str) and val.isalpha():
+                entities.append(val)
 
-        entities = []
-        if rows_json and columns:
-            top_row = rows_json[0]
-            for col in columns:
-                val = top_row.get(col)
-                if isinstance(val, str) and val.isalpha():
-                    entities.append(val)
+    _context(session).entities = entities
 
-        st.session_state["last_result_entities"] = entities
 
+    return cleaned_response
 
-        return cleaned_response
-    except Exception as e:
-        return f"Error formatting response: {e}"
+class IncrementalCleaner:
+    """
+    Apply the finish_final_response whitespace clean-up to streamed chunks.
+    Trailing whitespace is held back until the next non-blank text arrives, so
+    every run is cleaned once it is complete and the end of the answer is trimmed.
+    """
+
+    def __init__(self, collapse=True):
+        self.collapse = collapse
+        self.text = ""
+        self._pending = ""
+
+    def feed(self, chunk):
+        text = self._pending + chunk
+        ready = text.rstrip()
+        self._pending = text[len(ready):]
+        if not self.text:
+            ready = ready.lstrip()
+            if not ready:
+                self._pending = ""
+                return ""
+        if self.collapse:
+            ready = re.sub(r'\n{3,}', '\n\n', ready)
+            ready = re.sub(r' +\n', '\n', ready)
+        self.text += ready
+        return ready
+
+def _chunk_text(chunk):
+    try:
+        return chunk.text
+    except ValueError:
+        # Chunks without parts (e.g. the final one carrying only the finish reason).
+        return ""
+
+def local_final_response(user_question, columns, rows, truncated=False, session=None):
+    """Return the answer rendered without Gemini when the formatting rules decide it, else None."""
+    answer = format_locally(user_question, columns, rows, truncated)
+    if answer is None:
+        return None
+    return finish_final_response(answer, user_question, columns, serialize_rows(columns, rows[:PROMPT_ROW_LIMIT]),
+                                 session)
+
+def stream_final_response(user_question, columns, rows, truncated=False, session=None):
+    """Yield the formatted answer in cleaned chunks as Gemini produces it."""
+    with span("generate_final_response", stream=True) as s:
+        answer = local_final_response(user_question, columns, rows, truncated, session)
+        s.set(local=answer is not None)
+        if answer is not None:
+            yield answer
+            return
+        formatting_prompt, rows_json = build_formatting_prompt(user_question, columns, rows, truncated)
+        cleaner = IncrementalCleaner()
+        try:
+            yield from _generate_stream(formatting_prompt, "format", cleaner)
+            finish_final_response(cleaner.text, user_question, columns, rows_json, session)
+        except Exception as e:
+            yield f"Error formatting response: {e}"
+
+def generate_final_response(user_question, columns, rows, truncated=False, session=None):
+    with span("generate_final_response") as s:
+        answer = local_final_response(user_question, columns, rows, truncated, session)
+        s.set(local=answer is not None)
+        if answer is not None:
+            return answer
+        formatting_prompt, rows_json = build_formatting_prompt(user_question, columns, rows, truncated)
+        try:
+            # The prompt holds the question and the rows, so its digest is the question + result fingerprint.
+            text = single_flight("generate_final_response").do(
+                hashlib.sha1(formatting_prompt.encode("utf-8")).hexdigest(), _generate, formatting_prompt, "format")
+            return finish_final_response(text, user_question, columns, rows_json, session)
+        except Exception as e:
+            return f"Error formatting response: {e}"
 
 
 def format_row_data(rows):
@@ -281,25 +549,21 @@ def format_row_data(rows):
     return formatted
 
 
-def gemini_direct_answer(prompt, chat_context=None):
-
-    history_text = ""
-    if chat_context:
-        for entry in reversed(chat_context[-1:]):
-            history_text += f"User: {entry['user']}\nBot: {entry.get('response', '')}\n"
+def build_direct_prompt(prompt, chat_context=None, session=None):
+    history_text, _, _ = build_history(chat_context[-1:] if chat_context else None)
 
-    if "last_result_summary" in st.session_state:
-        last_summary = st.session_state["last_result_summary"]
-        columns = last_summary.get("columns", [])
-        rows = last_summary.get("rows", [])
-        last_user_q = last_summary.get("user_question", "")
-        formatted_rows = format_row_data(rows[:5]) if rows else []
-        preview = json.dumps(formatted_rows, indent=2)
+    session = _context(session)
+    last_result = session.last_result
+    if last_result is not None:
+        columns = last_result.columns
+        last_user_q = last_result.question
+        formatted_rows = format_row_data(last_result.rows(5))
+        preview = json.dumps(serialize_rows(columns, formatted_rows), indent=2, default=str)
         colnames = ", ".join(columns) if columns else "none"
 
         entities_info = ""
-        if "last_result_entities" in st.session_state and st.session_state["last_result_entities"]:
-            top_entities = ", ".join(st.session_state["last_result_entities"][:5])
+        if session.entities:
+            top_entities = ", ".join(session.entities[:5])
             entities_info = f"\nThe last result included key values such as: {top_entities}."
 
         result_context = f"""
@@ -364,11 +628,24 @@ Conversation history:
 
 User: {prompt}
 """
-
-    try:
-        response = model.generate_content(full_prompt)
-        return response.text.strip()
-    except Exception as e:
-        return f"Gemini error: {e}"
+    record_prompt("direct", full_prompt)
+    return full_prompt
+
+def gemini_direct_answer(prompt, chat_context=None, session=None):
+    with span("gemini_direct_answer"):
+        full_prompt = build_direct_prompt(prompt, chat_context, session)
+        try:
+            return _generate(full_prompt, "direct").strip()
+        except Exception as e:
+            return f"Gemini error: {e}"
+
+def stream_direct_answer(prompt, chat_context=None, session=None):
+    with span("gemini_direct_answer", stream=True):
+        full_prompt = build_direct_prompt(prompt, chat_context, session)
+        cleaner = IncrementalCleaner(collapse=False)
+        try:
+            yield from _generate_stream(full_prompt, "direct", cleaner)
+        except Exception as e:
+            yield f"Gemini error: {e}"
 
 
@@ -0,0 +1,207 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from result_cache import is_read_only, normalize_sql
+from sql import limited_query, pooled_connection, set_statement_timeout
+from tracing import span
+
+QUERY_GUARD = os.getenv("query_guard", "1").lower() not in ("0", "false", "no")
+QUERY_MAX_COST = float(os.getenv("query_max_cost", "1000000"))
+QUERY_MAX_PLAN_ROWS = float(os.getenv("query_max_plan_rows", "1000000"))
+QUERY_AUTO_LIMIT = os.getenv("query_auto_limit", "1").lower() not in ("0", "false", "no")
+PLAN_CACHE_SIZE = int(os.getenv("plan_cache_size", "500"))
+PLAN_CACHE_TTL = float(os.getenv("plan_cache_ttl", "600"))
+EXPLAIN_TIMEOUT_MS = int(os.getenv("explain_timeout_ms", "5000"))
+
+SUMMARY_NODES = 8
+
+
+class QueryRejected(Exception):
+    """Raised when the planner's estimates for a generated query exceed the configured limits."""
+
+    def __init__(self, query, cost, rows, summary, max_cost=QUERY_MAX_COST, max_rows=QUERY_MAX_PLAN_ROWS):
+        super().__init__(
+            f"Query rejected: estimated cost {cost:,.0f} (limit {max_cost:,.0f}), "
+            f"estimated rows {rows:,.0f} (limit {max_rows:,.0f})"
+        )
+        self.query = query
+        self.cost = cost
+        self.rows = rows
+        self.summary = summary
+
+    def feedback(self):
+        """Text for the regeneration prompt: the rejected SQL and why the planner objected."""
+        return (
+            f"Your previous SQL for this question was rejected before running because it is too expensive.\n"
+            f"Previous SQL:\n{self.query}\n"
+            f"{self}.\n"
+            f"Plan summary:\n{self.summary}\n"
+            "Write a cheaper query: join every table on its keys (no cartesian products), filter or "
+            "aggregate as early as possible and add a LIMIT when listing rows."
+        )
+
+
+def _walk(node, depth=0):
+    yield node, depth
+    for child in node.get("Plans", []):
+        yield from _walk(child, depth + 1)
+
+
+def _is_cartesian(node):
+    """A nested loop with no join condition anywhere is a cross product."""
+    if node.get("Node Type") != "Nested Loop" or node.get("Join Filter"):
+        return False
+    for child, _ in _walk(node):
+        if child is not node and any(key in child for key in ("Index Cond", "Recheck Cond", "Hash Cond", "Merge Cond")):
+            return False
+    return True
+
+
+def summarize_plan(plan):
+    """The most expensive plan nodes, one line each, with cross products flagged."""
+    nodes = list(_walk(plan))
+    ranked = sorted(nodes, key=lambda item: -item[0].get("Total Cost", 0))[:SUMMARY_NODES]
+    lines = []
+    for node, depth in sorted(ranked, key=lambda item: nodes.index(item)):
+        label = node.get("Node Type", "?")
+        if node.get("Relation Name"):
+            label += f" on {node.get('Schema', 'public')}.{node['Relation Name']}"
+        line = f"{'  ' * depth}- {label} (cost={node.get('Total Cost', 0):,.0f}, rows={node.get('Plan Rows', 0):,.0f})"
+        if _is_cartesian(node):
+            line += "  <- cartesian join, no join condition"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def explain(query):
+    """Return the top plan node of `EXPLAIN (FORMAT JSON) query`; the query itself is not run."""
+    with pooled_connection() as conn:
+        cur = conn.cursor()
+        try:
+            set_statement_timeout(cur, EXPLAIN_TIMEOUT_MS)
+            cur.execute(f"EXPLAIN (FORMAT JSON) {query}")
+            result = cur.fetchone()[0]
+        finally:
+            cur.close()
+            conn.rollback()
+    if isinstance(result, str):
+        result = json.loads(result)
+    return result[0]["Plan"]
+
+
+class QueryGuard:
+    """
+    EXPLAIN generated SQL before it runs. Queries whose estimated cost or row count
+    exceed the limits are wrapped in a LIMIT when that brings the cost down, and
+    rejected otherwise. Decisions are cached per normalized SQL for `ttl` seconds.
+    """
+
+    def __init__(self, max_cost=QUERY_MAX_COST, max_rows=QUERY_MAX_PLAN_ROWS, auto_limit=QUERY_AUTO_LIMIT,
+                 max_entries=PLAN_CACHE_SIZE, ttl=PLAN_CACHE_TTL):
+        self.max_cost = max_cost
+        self.max_rows = max_rows
+        self.auto_limit = auto_limit
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._plans = OrderedDict()   # normalized SQL -> (stored_at, decision)
+        self.stats = {"explains": 0, "cache_hits": 0, "allowed": 0, "limited": 0, "rejected": 0, "errors": 0}
+
+    def _cached(self, key):
+        with self._lock:
+            entry = self._plans.get(key)
+            if entry is None:
+                return None
+            stored_at, decision = entry
+            if time.time() - stored_at > self.ttl:
+                del self._plans[key]
+                return None
+            self._plans.move_to_end(key)
+            self.stats["cache_hits"] += 1
+            return decision
+
+    def _store(self, key, decision):
+        with self._lock:
+            self._plans[key] = (time.time(), decision)
+            self._plans.move_to_end(key)
+            while len(self._plans) > self.max_entries:
+                self._plans.popitem(last=False)
+
+    def _plan(self, query):
+        with self._lock:
+            self.stats["explains"] += 1
+        plan = explain(query)
+        return plan.get("Total Cost", 0.0), plan.get("Plan Rows", 0.0), plan
+
+    def decide(self, query):
+        """Return the decision dict: action ("allow", "limit" or "reject"), query to run, cost, rows, summary."""
+        cost, rows, plan = self._plan(query)
+        decision = {"action": "allow", "query": query, "cost": cost, "rows": rows, "summary": None}
+        if cost <= self.max_cost and rows <= self.max_rows:
+            return decision
+
+        decision["summary"] = summarize_plan(plan)
+        if self.auto_limit and is_read_only(query):
+            wrapped = limited_query(query)
+            limited_cost, limited_rows, _ = self._plan(wrapped)
+            if limited_cost <= self.max_cost:
+                return dict(decision, action="limit", query=wrapped, cost=limited_cost, rows=limited_rows,
+                            estimated_rows=rows)
+        decision["action"] = "reject"
+        return decision
+
+    def check(self, query):
+        """
+        Return the SQL to execute for `query` (possibly with an added LIMIT) or raise
+        QueryRejected with the plan summary. If EXPLAIN itself fails the query is let
+        through unchanged, so the real error surfaces from run_query.
+        """
+        key = normalize_sql(query)
+        with span("guard_query") as s:
+            decision = self._cached(key)
+            s.set(cache_hit=decision is not None)
+            if decision is None:
+                try:
+                    decision = self.decide(query)
+                except Exception as e:
+                    with self._lock:
+                        self.stats["errors"] += 1
+                    print("❌ EXPLAIN failed, running the query unguarded:", e)
+                    return query
+                self._store(key, decision)
+            s.set(action=decision["action"], cost=decision["cost"], plan_rows=decision["rows"])
+
+            action = decision["action"]
+            with self._lock:
+                self.stats["rejected" if action == "reject" else "limited" if action == "limit" else "allowed"] += 1
+            if action == "reject":
+                raise QueryRejected(query, decision["cost"], decision["rows"], decision["summary"],
+                                    self.max_cost, self.max_rows)
+            if action == "limit":
+                print(f"⚠️ Added LIMIT to a query estimated at {decision['estimated_rows']:,.0f} rows")
+            return decision["query"]
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["cached_plans"] = len(self._plans)
+        stats["max_cost"] = self.max_cost
+        stats["max_rows"] = self.max_rows
+        return stats
+
+
+query_guard = QueryGuard()
+
+
+def guard_query(query):
+    """Cost-check `query` with the process-wide guard; a no-op when query_guard is off."""
+    if not QUERY_GUARD:
+        return query
+    return query_guard.check(query)
+
+
+def guard_metrics():
+    return query_guard.metrics()
@@ -0,0 +1,237 @@
+import hashlib
+import os
+import re
+import threading
+import weakref
+from collections import OrderedDict
+
+from psycopg2 import extensions
+
+from sql_validator import KEYWORDS, canonicalize, tokenize
+from tracing import current_span
+
+PREPARED_STATEMENTS = os.getenv("prepared_statements", "1").lower() not in ("0", "false", "no")
+PREPARED_CACHE_SIZE = int(os.getenv("prepared_cache_size", "100"))
+
+# Literals right after these keep their value in the template: the planner needs them as constants.
+CONSTANT_AFTER = {"limit", "offset", "fetch", "interval"}
+# Clauses whose numbers are column ordinals (GROUP BY 1) and end where these keywords start.
+ORDINAL_CLAUSE_END = {"having", "limit", "offset", "fetch", "union", "intersect", "except", "window", "for"}
+QUESTION_VALUE = re.compile(r"'([^']+)'|\"([^\"]+)\"|(?<![\w.])(\d+(?:\.\d+)?)(?![\w.])")
+VALUE_SLOT = "{}"
+
+
+def _number_type(text):
+    """The type Postgres gives a numeric literal: integer, bigint or numeric."""
+    if re.fullmatch(r"\d+", text):
+        value = int(text)
+        return "integer" if value < 2**31 else "bigint" if value < 2**63 else "numeric"
+    return "numeric"
+
+
+def templatize(query):
+    """
+    Replace the literals of a SELECT by $n parameters. Returns (template, values) where
+    values are the literal texts to pass to EXECUTE, or None when the query already has
+    parameters or cannot be tokenized. Numbers keep their literal type with a cast;
+    strings stay untyped so Postgres infers their type from the context, as it does for
+    the literal. LIMIT/OFFSET values, GROUP BY/ORDER BY ordinals, type modifiers and
+    typed literals (DATE '...') stay in the template.
+    """
+    try:
+        tokens = tokenize(query.strip())
+    except ValueError:
+        return None
+    while tokens and tokens[-1][1] == ";":
+        tokens.pop()
+    if not tokens or any(kind in ("param", "dollar") for kind, _ in tokens):
+        return None
+
+    out, values = [], []
+    constant_parens = []   # per open "(": True inside a type modifier such as ::numeric(10, 2)
+    ordinal_depth = None   # paren depth of an open GROUP BY / ORDER BY clause
+    for i, (kind, text) in enumerate(tokens):
+        previous = tokens[i - 1][1] if i else ""
+        if text == "(":
+            constant_parens.append(i >= 2 and tokens[i - 2][1] == "::" or bool(constant_parens and constant_parens[-1]))
+        elif text == ")":
+            if ordinal_depth is not None and len(constant_parens) <= ordinal_depth:
+                ordinal_depth = None
+            if constant_parens:
+                constant_parens.pop()
+        elif text == "by" and previous in ("group", "order"):
+            ordinal_depth = len(constant_parens)
+        elif kind == "word" and text in ORDINAL_CLAUSE_END and ordinal_depth == len(constant_parens):
+            ordinal_depth = None
+
+        keep = (
+            previous in CONSTANT_AFTER
+            or (constant_parens and constant_parens[-1])
+            or (kind == "number" and ordinal_depth is not None)
+            or (kind == "string" and tokens[i - 1][0] == "word" and previous not in KEYWORDS if i else False)
+            or (kind == "string" and i + 1 < len(tokens) and tokens[i + 1][1] == "uescape")
+        )
+        if kind == "number" and not keep:
+            values.append(text)
+            out.extend([("param", f"${len(values)}"), ("punct", "::"), ("word", _number_type(text))])
+        elif kind == "string" and not keep:
+            values.append(text)
+            out.append(("param", f"${len(values)}"))
+        else:
+            out.append((kind, text))
+    return canonicalize(out), values
+
+
+def question_shape(question):
+    """Return (shape, values): the question with quoted strings and numbers replaced by a slot."""
+    values = []
+
+    def slot(match):
+        values.append(next(group for group in match.groups() if group is not None))
+        return VALUE_SLOT
+
+    return QUESTION_VALUE.sub(slot, question), values
+
+
+def _literal_value(kind, text):
+    if kind == "number":
+        return text
+    if kind == "string" and text[0] == "'":
+        return text[1:-1].replace("''", "'")
+    return None
+
+
+def _value_positions(tokens, values):
+    """Index of the one literal token holding each value, or None if any value is missing or repeated."""
+    if len(set(values)) != len(values):
+        return None
+    found = {}
+    for i, (kind, text) in enumerate(tokens):
+        value = _literal_value(kind, text)
+        if value in values:
+            if value in found:
+                return None
+            found[value] = i
+    if len(found) != len(values):
+        return None
+    return [found[value] for value in values]
+
+
+def sql_binds_values(sql, values):
+    """True when every question value appears exactly once as a literal in `sql`, so it can be rebound."""
+    try:
+        return _value_positions(tokenize(sql), values) is not None
+    except ValueError:
+        return False
+
+
+def rebind_sql(sql, old_values, new_values):
+    """Put `new_values` where `old_values` appear in `sql` (one literal each); None if that is not possible."""
+    if len(old_values) != len(new_values):
+        return None
+    try:
+        tokens = tokenize(sql)
+    except ValueError:
+        return None
+    positions = _value_positions(tokens, old_values)
+    if positions is None:
+        return None
+    for position, value in zip(positions, new_values):
+        kind = tokens[position][0]
+        if kind == "number":
+            if not re.fullmatch(r"\d+(?:\.\d+)?", value):
+                return None
+            tokens[position] = ("number", value)
+        else:
+            tokens[position] = ("string", "'" + value.replace("'", "''") + "'")
+    return canonicalize(tokens)
+
+
+class PreparedStatements:
+    """The prepared statements of one connection, keyed by template and bounded LRU."""
+
+    def __init__(self, max_entries=PREPARED_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._names = OrderedDict()   # template -> statement name
+
+    def prepare(self, cur, template):
+        """Return (statement name, reused), running PREPARE when the template is new on this connection."""
+        name = self._names.get(template)
+        if name is not None:
+            self._names.move_to_end(template)
+            return name, True
+        name = "nl2sql_" + hashlib.sha1(template.encode("utf-8")).hexdigest()[:16]
+        cur.execute(f"PREPARE {name} AS {template}")
+        self._names[template] = name
+        while len(self._names) > self.max_entries:
+            _, oldest = self._names.popitem(last=False)
+            cur.execute(f"DEALLOCATE {oldest}")
+            _count("deallocations")
+        return name, False
+
+
+_statements = weakref.WeakKeyDictionary()   # connection -> PreparedStatements
+_unpreparable = OrderedDict()               # templates whose PREPARE failed
+_stats_lock = threading.Lock()
+template_stats = {"executions": 0, "prepares": 0, "plan_reuses": 0, "prepare_errors": 0, "deallocations": 0,
+                  "skipped": 0}
+
+
+def _count(key, amount=1):
+    with _stats_lock:
+        template_stats[key] += amount
+
+
+def prepared_statements_for(conn):
+    """The statement cache of a psycopg2 connection; None for other connection types or when disabled."""
+    if not PREPARED_STATEMENTS or not isinstance(conn, extensions.connection):
+        return None
+    statements = _statements.get(conn)
+    if statements is None:
+        statements = _statements[conn] = PreparedStatements()
+    return statements
+
+
+def execute_prepared(conn, cur, query, setup=None):
+    """
+    Run `query` on `cur` as EXECUTE of a prepared template. Returns True when it ran
+    (fetch from `cur`), False when the caller should set up the transaction and run the
+    plain text instead. `setup(cur)` (e.g. the statement timeout) runs just before the
+    statement; a failed PREPARE rolls the transaction back.
+    """
+    statements = prepared_statements_for(conn)
+    templated = templatize(query) if statements is not None else None
+    if templated is None or templated[0] in _unpreparable:
+        _count("skipped")
+        return False
+    template, values = templated
+    if setup is not None:
+        setup(cur)
+    try:
+        name, reused = statements.prepare(cur, template)
+    except Exception as e:
+        # Typically a parameter whose type cannot be inferred; run this template as plain text from now on.
+        conn.rollback()
+        with _stats_lock:
+            template_stats["prepare_errors"] += 1
+            _unpreparable[template] = True
+            while len(_unpreparable) > PREPARED_CACHE_SIZE * 10:
+                _unpreparable.popitem(last=False)
+        print("⚠️ Could not prepare the query, running it as plain text:", e)
+        return False
+    # No parameters are passed to psycopg2, so "%" in the literals needs no escaping.
+    cur.execute(f"EXECUTE {name}" + (f" ({', '.join(values)})" if values else ""))
+    with _stats_lock:
+        template_stats["executions"] += 1
+        template_stats["prepares" if not reused else "plan_reuses"] += 1
+    current_span().set(prepared=True, plan_reused=reused, parameters=len(values))
+    return True
+
+
+def template_metrics():
+    with _stats_lock:
+        stats = dict(template_stats, unpreparable=len(_unpreparable))
+    stats["connections"] = len(_statements)
+    stats["prepared"] = sum(len(s._names) for s in list(_statements.values()))
+    stats["reuse_rate"] = stats["plan_reuses"] / stats["executions"] if stats["executions"] else 0.0
+    return stats
@@ -0,0 +1,263 @@
+import json
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from encoding_repair import (
+    DEFAULT_CORRUPTION_REGEX,
+    primary_keys_by_table,
+    quote_ident,
+    repair_table,
+    text_columns_by_table,
+)
+from db_pool import pool_settings_from_env
+from sql import get_pool, pooled_connection
+
+CHECKPOINT_TABLE = os.getenv("repair_checkpoint_table", "encoding_repair_checkpoint")
+REPAIR_WORKERS = int(os.getenv("repair_workers", "4"))
+REPORT_INTERVAL = float(os.getenv("repair_report_interval", "10"))
+
+
+def ensure_checkpoint_table():
+    with pooled_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS public.{quote_ident(CHECKPOINT_TABLE)} (
+                schema_name text NOT NULL,
+                table_name text NOT NULL,
+                column_name text NOT NULL,
+                last_pk text,
+                rows_scanned bigint NOT NULL DEFAULT 0,
+                rows_fixed bigint NOT NULL DEFAULT 0,
+                status text NOT NULL DEFAULT 'running',
+                updated_at timestamptz NOT NULL DEFAULT now(),
+                PRIMARY KEY (schema_name, table_name, column_name)
+            )
+        """)
+        conn.commit()
+        cur.close()
+
+
+def load_checkpoints():
+    """Return {(schema, table, column): (last_pk, rows_scanned, rows_fixed, status)}."""
+    with pooled_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            f"SELECT schema_name, table_name, column_name, last_pk, rows_scanned, rows_fixed, status "
+            f"FROM public.{quote_ident(CHECKPOINT_TABLE)}"
+        )
+        rows = cur.fetchall()
+        cur.close()
+    return {(s, t, c): (json.loads(pk) if pk else None, scanned, fixed, status) for s, t, c, pk, scanned, fixed, status in rows}
+
+
+def clear_checkpoints():
+    with pooled_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f"DELETE FROM public.{quote_ident(CHECKPOINT_TABLE)}")
+        conn.commit()
+        cur.close()
+
+
+def _write_checkpoint(cur, schema, table, columns, last_key, base, report, finished):
+    scanned = base["scanned"] + report["scanned"]
+    for col in columns:
+        cur.execute(
+            f"""
+            INSERT INTO public.{quote_ident(CHECKPOINT_TABLE)}
+                (schema_name, table_name, column_name, last_pk, rows_scanned, rows_fixed, status, updated_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, now())
+            ON CONFLICT (schema_name, table_name, column_name) DO UPDATE
+            SET last_pk = EXCLUDED.last_pk, rows_scanned = EXCLUDED.rows_scanned,
+                rows_fixed = EXCLUDED.rows_fixed, status = EXCLUDED.status, updated_at = now()
+            """,
+            (
+                schema, table, col,
+                json.dumps(list(last_key), default=str) if last_key is not None else None,
+                scanned, base["fixed"].get(col, 0) + report["fixed"][col],
+                "done" if finished else "running",
+            ),
+        )
+
+
+def run_task(task, corruption_regex, batch_size, commit_rows, scan_options=None):
+    """Repair one table, resuming after its checkpoint. Runs in a worker thread or process."""
+    schema, table, columns, pk_columns, start_after, base = task
+
+    def on_commit(cur, last_key, report, finished):
+        _write_checkpoint(cur, schema, table, columns, last_key, base, report, finished)
+
+    started = time.monotonic()
+    report = repair_table(schema, table, columns, pk_columns, corruption_regex,
+                          batch_size=batch_size, commit_rows=commit_rows,
+                          start_after=start_after, on_commit=on_commit, **(scan_options or {}))
+    report["seconds"] = time.monotonic() - started
+    report["rows_per_second"] = report["scanned"] / report["seconds"] if report["seconds"] else 0.0
+    return report
+
+
+class RepairScheduler:
+    """
+    Run fix_all_encoding_issues as per-table tasks over a bounded pool of threads or
+    processes (each drawing its own connections). Progress is checkpointed in
+    CHECKPOINT_TABLE by schema/table/column and last primary key, so a rerun resumes
+    where the previous one stopped and skips finished tables.
+    """
+
+    def __init__(self, workers=None, use_processes=False, corruption_regex=DEFAULT_CORRUPTION_REGEX,
+                 batch_size=None, commit_rows=None, report_interval=None, scan_mode=None, page_size=None,
+                 throttle=None):
+        self.workers = workers or REPAIR_WORKERS
+        self.use_processes = use_processes
+        self.corruption_regex = corruption_regex
+        self.batch_size = batch_size
+        self.commit_rows = commit_rows
+        self.report_interval = REPORT_INTERVAL if report_interval is None else report_interval
+        self.scan_options = {"scan_mode": scan_mode, "page_size": page_size, "throttle": throttle}
+        self._stop = threading.Event()
+
+    def tasks(self):
+        checkpoints = load_checkpoints()
+        keys = primary_keys_by_table()
+        tasks = []
+        for (schema, table), columns in text_columns_by_table().items():
+            if table == CHECKPOINT_TABLE:
+                continue
+            pk_columns = keys.get((schema, table))
+            if not pk_columns:
+                print(f"Skipping {schema}.{table} - no suitable primary key found.")
+                continue
+            saved = [checkpoints.get((schema, table, col)) for col in columns]
+            if all(s is not None and s[3] == "done" for s in saved):
+                continue
+            start_after = None
+            base = {"scanned": 0, "fixed": {}}
+            # Columns are checkpointed together; any missing one means the table starts over.
+            if all(s is not None for s in saved) and len({json.dumps(s[0]) for s in saved}) == 1:
+                start_after = saved[0][0]
+                base = {"scanned": saved[0][1], "fixed": {col: s[2] for col, s in zip(columns, saved)}}
+            tasks.append((schema, table, columns, pk_columns, start_after, base))
+        return tasks
+
+    def _estimated_rows(self, tasks):
+        names = [f"{quote_ident(s)}.{quote_ident(t)}" for s, t, *_ in tasks]
+        if not names:
+            return 0
+        with pooled_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT COALESCE(SUM(GREATEST(reltuples, 0)), 0) FROM pg_class WHERE oid = ANY(%s::regclass[])", (names,))
+            total = cur.fetchone()[0]
+            cur.close()
+        return int(total)
+
+    def _report_progress(self, total_rows, total_tables):
+        previous = {}
+        last = time.monotonic()
+        while not self._stop.wait(self.report_interval):
+            now = time.monotonic()
+            try:
+                checkpoints = load_checkpoints()
+            except Exception as e:
+                print("❌ Failed to read repair progress:", e)
+                continue
+            tables = {}
+            for (schema, table, _), (_, scanned, _, status) in checkpoints.items():
+                tables[f"{schema}.{table}"] = (scanned, status)
+            scanned_total = sum(scanned for scanned, _ in tables.values())
+            done = sum(1 for _, status in tables.values() if status == "done")
+            percent = f" (~{100 * scanned_total / total_rows:.1f}% of rows)" if total_rows else ""
+            print(f"📊 Repair progress: {done}/{total_tables} tables done, {scanned_total} rows scanned{percent}")
+            for name, (scanned, status) in sorted(tables.items()):
+                if status != "running":
+                    continue
+                rate = (scanned - previous.get(name, scanned)) / (now - last) if name in previous else 0.0
+                print(f"   {name}: {scanned} rows scanned, {rate:,.0f} rows/s")
+            previous = {name: scanned for name, (scanned, _) in tables.items()}
+            last = now
+
+    def check_pool_size(self):
+        """
+        Each task holds a reader and a writer connection at once, so a pool smaller than
+        that would leave every worker holding a reader while waiting for a writer.
+        """
+        if self.use_processes:
+            # One task at a time per worker process, each with its own pool.
+            needed, max_size = 2, pool_settings_from_env()["max_size"]
+        else:
+            needed, max_size = 2 * self.workers + (1 if self.report_interval else 0), get_pool().max_size
+        if needed > max_size:
+            raise ValueError(
+                f"{self.workers} repair workers need {needed} pooled connections but db_pool_max is {max_size}; "
+                f"raise db_pool_max or lower repair_workers"
+            )
+
+    def run(self, restart=False):
+        self.check_pool_size()
+        ensure_checkpoint_table()
+        if restart:
+            clear_checkpoints()
+        tasks = self.tasks()
+        if not tasks:
+            print("✅ Nothing to repair - every table is already checkpointed as done.")
+            return []
+
+        reporter = None
+        if self.report_interval:
+            reporter = threading.Thread(
+                target=self._report_progress, args=(self._estimated_rows(tasks), len(tasks)), daemon=True
+            )
+            reporter.start()
+
+        if self.use_processes:
+            # Spawned, not forked: a forked child would inherit (and on cleanup terminate) the
+            # parent's pooled connections, which the checkpoint reads and the reporter still use.
+            executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        else:
+            executor = ThreadPoolExecutor(max_workers=self.workers)
+        reports = []
+        try:
+            with executor:
+                futures = {
+                    executor.submit(
+                        run_task, task, self.corruption_regex, self.batch_size, self.commit_rows, self.scan_options
+                    ): task
+                    for task in tasks
+                }
+                for future in as_completed(futures):
+                    schema, table = futures[future][:2]
+                    try:
+                        report = future.result()
+                    except Exception as e:
+                        print(f"❌ Error processing {schema}.{table}:", e)
+                        continue
+                    reports.append(report)
+                    print(f"✅ {schema}.{table}: {report['scanned']} rows in {report['seconds']:.1f}s "
+                          f"({report['rows_per_second']:,.0f} rows/s)")
+        finally:
+            self._stop.set()
+        return reports
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Repair latin1/UTF-8 mojibake in all text columns, resumably.")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--processes", action="store_true", help="use worker processes instead of threads")
+    parser.add_argument("--restart", action="store_true", help="ignore existing checkpoints")
+    parser.add_argument("--full-scan", action="store_true", help="check every row instead of regex matches")
+    parser.add_argument("--scan-mode", choices=["cursor", "keyset"], default=None)
+    parser.add_argument("--page-size", type=int, default=None, help="rows per keyset page")
+    parser.add_argument("--throttle", type=float, default=None, help="seconds to sleep between keyset pages")
+    args = parser.parse_args()
+
+    RepairScheduler(
+        workers=args.workers,
+        use_processes=args.processes,
+        corruption_regex=None if args.full_scan else DEFAULT_CORRUPTION_REGEX,
+        scan_mode=args.scan_mode,
+        page_size=args.page_size,
+        throttle=args.throttle,
+    ).run(restart=args.restart)
@@ -0,0 +1,175 @@
+import os
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+READ_ONLY_START = re.compile(r"^\s*(select|with)\b", re.IGNORECASE)
+WRITE_KEYWORDS = re.compile(r"\b(insert|update|delete|merge|truncate|alter|drop|create|grant|revoke|copy|call|lock)\b", re.IGNORECASE)
+VOLATILE_FUNCTIONS = re.compile(r"\b(random|now|clock_timestamp|statement_timestamp|timeofday|nextval|current_timestamp|localtimestamp)\b", re.IGNORECASE)
+# A table name with an optional alias, then more of them after commas (FROM a x, b AS y).
+ALIAS_STOP = r"(?:join|inner|left|right|full|cross|natural|on|using|where|group|order|having|window|limit|offset|fetch|for|union|intersect|except|set|values|select|returning|default)\b"
+TABLE_NAME = rf'(?:"?\w+"?\.)?"?\w+"?(?:\s+(?:as\s+)?(?!{ALIAS_STOP})"?\w+"?)?'
+TABLE_REFERENCE = re.compile(rf'\b(?:from|join|update|into|truncate(?:\s+table)?)\s+({TABLE_NAME}(?:\s*,\s*{TABLE_NAME})*)', re.IGNORECASE)
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+
+
+def normalize_sql(query):
+    """Collapse whitespace outside string literals and drop the trailing semicolon."""
+    parts = []
+    last = 0
+    for match in STRING_LITERAL.finditer(query):
+        parts.append(re.sub(r"\s+", " ", query[last:match.start()]))
+        parts.append(match.group())
+        last = match.end()
+    parts.append(re.sub(r"\s+", " ", query[last:]))
+    return "".join(parts).strip().rstrip(";").strip()
+
+
+def _strip_literals(query):
+    return STRING_LITERAL.sub("''", query)
+
+
+def is_read_only(query):
+    body = _strip_literals(query)
+    return bool(READ_ONLY_START.match(body)) and not WRITE_KEYWORDS.search(body)
+
+
+def referenced_tables(query, default_schema="public"):
+    """Return the schema-qualified tables named after FROM/JOIN/UPDATE/INTO/TRUNCATE."""
+    tables = set()
+    for match in TABLE_REFERENCE.finditer(_strip_literals(query)):
+        for name in match.group(1).split(","):
+            name = name.split()[0].replace('"', "").lower() if name.strip() else ""
+            if not name or name in ("select", "lateral", "only"):
+                continue
+            if "." not in name:
+                name = f"{default_schema}.{name}"
+            tables.add(name)
+    return tables
+
+
+def estimate_size(columns, rows):
+    size = sys.getsizeof(rows) + sum(sys.getsizeof(c) for c in columns)
+    for row in rows:
+        size += sys.getsizeof(row)
+        for cell in row:
+            size += sys.getsizeof(cell)
+    return size
+
+
+class ResultCache:
+    """
+    Cache of SELECT results keyed by normalized SQL text. Entries expire after
+    `ttl` seconds, are dropped when one of their tables is invalidated, and the
+    least recently used ones are evicted to stay under `max_bytes`.
+    """
+
+    def __init__(self, ttl=60.0, max_bytes=64 * 1024 * 1024, enabled=True):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> (stored_at, columns, rows, tables, size)
+        self._by_table = {}             # table -> set of keys
+        self._bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expired": 0, "invalidated": 0, "skipped": 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            ttl=float(os.getenv("result_cache_ttl", "60")),
+            max_bytes=int(os.getenv("result_cache_max_bytes", str(64 * 1024 * 1024))),
+            enabled=os.getenv("result_cache_enabled", "1").lower() not in ("0", "false", "no"),
+        )
+
+    def get(self, query):
+        if not self.enabled:
+            return None
+        key = normalize_sql(query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            stored_at, columns, rows = entry[:3]
+            if time.monotonic() - stored_at > self.ttl:
+                self._drop(key)
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return list(columns), list(rows)
+
+    def put(self, query, columns, rows):
+        """Store a result if the statement is a deterministic read-only query that fits the budget."""
+        if not self.enabled:
+            return False
+        if not is_read_only(query) or VOLATILE_FUNCTIONS.search(_strip_literals(query)):
+            self.stats["skipped"] += 1
+            return False
+        rows = list(rows)
+        size = estimate_size(columns, rows)
+        if size > self.max_bytes:
+            self.stats["skipped"] += 1
+            return False
+        key = normalize_sql(query)
+        tables = referenced_tables(query)
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.monotonic(), list(columns), rows, tables, size)
+            self._bytes += size
+            for table in tables:
+                self._by_table.setdefault(table, set()).add(key)
+            while self._bytes > self.max_bytes and self._entries:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                self.stats["evictions"] += 1
+            self.stats["stores"] += 1
+        return True
+
+    def invalidate_tables(self, tables):
+        """Drop every entry that read from any of `tables` (schema-qualified names)."""
+        dropped = 0
+        with self._lock:
+            for table in tables:
+                table = table.replace('"', "").lower()
+                if "." not in table:
+                    table = f"public.{table}"
+                for key in list(self._by_table.get(table, ())):
+                    self._drop(key)
+                    dropped += 1
+            self.stats["invalidated"] += dropped
+        return dropped
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        tables, size = entry[3], entry[4]
+        self._bytes -= size
+        for table in tables:
+            keys = self._by_table.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_table[table]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_table.clear()
+            self._bytes = 0
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+            stats["max_bytes"] = self.max_bytes
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
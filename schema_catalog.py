@@ -0,0 +1,205 @@
+import json
+import os
+import threading
+import time
+
+from nl_cache import schema_fingerprint
+from schema_index import SCHEMA_INDEX, SchemaIndex
+from sql import get_comments, get_foreign_keys, get_primary_keys, get_table_columns, get_table_signatures
+
+CATALOG_FORMAT_VERSION = 1
+SNAPSHOT_PATH = os.getenv("schema_snapshot_path", "schema_snapshot.json")
+REFRESH_INTERVAL = float(os.getenv("schema_refresh_interval", "300"))
+
+
+class SchemaCatalog:
+    """
+    Tables, columns, types, primary and foreign keys and comments of the live database.
+    Loaded with a handful of bulk catalog queries, persisted as a versioned JSON snapshot
+    and refreshed per table when pg_catalog signatures change.
+    """
+
+    def __init__(self, schemas, tables=None, signatures=None, revision=0):
+        self.schemas = list(schemas)
+        self.tables = tables or {}          # "schema.table" -> table entry (see _load_tables)
+        self.signatures = signatures or {}  # "schema.table" -> md5 of columns/constraints/comments
+        self.revision = revision
+        self._index = None
+        self._texts = None                  # (revision, {schema: text}, fingerprint)
+
+    @staticmethod
+    def _load_tables(schemas, tables=None):
+        entries = {}
+        for schema, table, column, data_type in get_table_columns(schemas, tables):
+            entry = entries.setdefault(f"{schema}.{table}", {
+                "columns": [], "primary_key": [], "foreign_keys": {}, "comment": None, "column_comments": {},
+            })
+            entry["columns"].append([column, data_type])
+        for schema, table, column, _ in get_primary_keys(schemas, tables):
+            if f"{schema}.{table}" in entries:
+                entries[f"{schema}.{table}"]["primary_key"].append(column)
+        for schema, table, column, ref_schema, ref_table, ref_column in get_foreign_keys(schemas, tables):
+            if f"{schema}.{table}" in entries:
+                entries[f"{schema}.{table}"]["foreign_keys"][column] = [f"{ref_schema}.{ref_table}", ref_column]
+        for schema, table, column, comment in get_comments(schemas, tables):
+            entry = entries.get(f"{schema}.{table}")
+            if entry is None:
+                continue
+            if column is None:
+                entry["comment"] = comment
+            else:
+                entry["column_comments"][column] = comment
+        return entries
+
+    @classmethod
+    def from_database(cls, schemas):
+        signatures = {f"{s}.{t}": sig for s, t, sig in get_table_signatures(schemas)}
+        if not signatures:
+            return None
+        return cls(schemas, cls._load_tables(schemas), signatures, revision=1)
+
+    def refreshed(self):
+        """
+        Return an updated catalog, reloading only tables whose signature changed,
+        or self when nothing changed (or the database is unreachable).
+        """
+        current = {f"{s}.{t}": sig for s, t, sig in get_table_signatures(self.schemas)}
+        if not current or current == self.signatures:
+            return self
+        changed = [name for name, sig in current.items() if self.signatures.get(name) != sig]
+        tables = {name: entry for name, entry in self.tables.items() if name in current and name not in changed}
+        if changed:
+            tables.update(self._load_tables(self.schemas, changed))
+        return SchemaCatalog(self.schemas, tables, current, self.revision + 1)
+
+    def to_snapshot(self):
+        return {
+            "format": CATALOG_FORMAT_VERSION,
+            "revision": self.revision,
+            "saved_at": time.time(),
+            "schemas": self.schemas,
+            "signatures": self.signatures,
+            "tables": self.tables,
+        }
+
+    def save(self, path=SNAPSHOT_PATH):
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.to_snapshot(), f, separators=(",", ":"))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path=SNAPSHOT_PATH, schemas=None):
+        """Read a snapshot file; None if it is missing, unreadable, from another format or other schemas."""
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get("format") != CATALOG_FORMAT_VERSION:
+            return None
+        if schemas is not None and sorted(data.get("schemas", [])) != sorted(schemas):
+            return None
+        return cls(data["schemas"], data["tables"], data["signatures"], data.get("revision", 0))
+
+    def index(self):
+        if self._index is None:
+            columns, foreign_keys, comments = [], [], []
+            for name, entry in self.tables.items():
+                schema, table = name.split(".", 1)
+                columns.extend((schema, table, col, data_type) for col, data_type in entry["columns"])
+                foreign_keys.extend(
+                    (schema, table, col, *ref[0].split(".", 1), ref[1]) for col, ref in entry["foreign_keys"].items()
+                )
+                if entry["comment"]:
+                    comments.append((schema, table, None, entry["comment"]))
+                comments.extend((schema, table, col, text) for col, text in entry["column_comments"].items())
+            self._index = SchemaIndex(columns, foreign_keys, comments)
+        return self._index
+
+    def _rendered(self):
+        if self._texts is None or self._texts[0] != self.revision:
+            index = self.index()
+            dbname = os.getenv("dbname", "pagila")
+            texts = {}
+            for schema in self.schemas:
+                names = sorted(name for name in self.tables if name.split(".", 1)[0] == schema)
+                texts[schema] = f"\n    Tables in {dbname}:\n\n{index.render(names)}\n    "
+            self._texts = (self.revision, texts, schema_fingerprint(texts))
+        return self._texts
+
+    def schema_texts(self):
+        """{schema: text} in the form of the hand-written SCHEMAS dict, rendered once per revision."""
+        return dict(self._rendered()[1])
+
+    def fingerprint(self):
+        """schema_fingerprint of schema_texts(), computed once per revision."""
+        return self._rendered()[2]
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+_last_check = None
+_refreshing = False
+
+
+def refresh_catalog(schemas):
+    """Bring the catalog up to date with the database now and persist it if it changed."""
+    global _catalog, _last_check
+    catalog = _catalog
+    if catalog is None or sorted(catalog.schemas) != sorted(schemas):
+        updated = SchemaCatalog.from_database(schemas)
+    else:
+        updated = catalog.refreshed()
+    _last_check = time.monotonic()
+    if updated is not None and updated is not catalog:
+        _catalog = updated
+        try:
+            updated.save()
+        except OSError as e:
+            print("❌ Failed to save schema snapshot:", e)
+    return _catalog
+
+
+def _refresh_in_background(schemas):
+    global _refreshing
+    try:
+        refresh_catalog(schemas)
+    except Exception as e:
+        print("❌ Schema catalog refresh failed:", e)
+    finally:
+        _refreshing = False
+
+
+def get_catalog(schemas):
+    """
+    Return the process-wide catalog. The snapshot file is used at startup; the database
+    is only queried when there is no usable snapshot or a refresh is due (in the background).
+    """
+    global _catalog, _last_check, _refreshing
+    if _catalog is None:
+        with _catalog_lock:
+            if _catalog is None:
+                if _last_check is not None and time.monotonic() - _last_check < REFRESH_INTERVAL:
+                    # No snapshot and the database was unreachable moments ago.
+                    return None
+                _catalog = SchemaCatalog.load(schemas=schemas)
+                if _catalog is None:
+                    refresh_catalog(schemas)
+                    return _catalog
+
+    due = _last_check is None or time.monotonic() - _last_check > REFRESH_INTERVAL
+    if REFRESH_INTERVAL and due and not _refreshing:
+        with _catalog_lock:
+            if not _refreshing:
+                _refreshing = True
+                _last_check = time.monotonic()
+                threading.Thread(target=_refresh_in_background, args=(schemas,), daemon=True).start()
+    return _catalog
+
+
+def get_schema_index(schemas):
+    catalog = get_catalog(schemas)
+    if not SCHEMA_INDEX or catalog is None or not catalog.tables:
+        return None
+    return catalog.index()
@@ -0,0 +1,110 @@
+import hashlib
+import math
+import os
+import re
+from collections import defaultdict
+
+from prompt_builder import question_words
+
+SCHEMA_INDEX = os.getenv("schema_index", "1").lower() not in ("0", "false", "no")
+SCHEMA_TOP_K = int(os.getenv("schema_top_k", "5"))
+
+TABLE_WEIGHT = 3.0
+COLUMN_WEIGHT = 1.0
+COMMENT_WEIGHT = 0.5
+IGNORED_COLUMNS = {"last_update", "id"}
+
+
+def _terms(name):
+    return question_words(name.replace("_", " "))
+
+
+class SchemaIndex:
+    """
+    Inverted index over table names, column names and comments with foreign-key edges.
+    search() ranks tables lexically (IDF-weighted term overlap) and adds join neighbours.
+    """
+
+    def __init__(self, columns, foreign_keys=(), comments=()):
+        self.tables = {}                          # "schema.table" -> [column, ...]
+        self.comments = {}                        # "schema.table" -> table comment
+        self.references = defaultdict(dict)       # table -> {column: (ref_table, ref_column)}
+        self._postings = defaultdict(dict)        # term -> {table: weight}
+
+        for schema, table, column, _ in columns:
+            self.tables.setdefault(f"{schema}.{table}", []).append(column)
+        for schema, table, column, ref_schema, ref_table, ref_column in foreign_keys:
+            self.references[f"{schema}.{table}"][column] = (f"{ref_schema}.{ref_table}", ref_column)
+
+        for name, cols in self.tables.items():
+            self._add(name, _terms(name.split(".", 1)[1]), TABLE_WEIGHT)
+            for col in cols:
+                # Foreign key columns name the referenced table, not this one.
+                if col not in IGNORED_COLUMNS and col not in self.references.get(name, {}):
+                    self._add(name, _terms(col), COLUMN_WEIGHT)
+        for schema, table, column, comment in comments:
+            name = f"{schema}.{table}"
+            if name not in self.tables:
+                continue
+            if column is None:
+                self.comments[name] = comment
+            self._add(name, question_words(comment), COMMENT_WEIGHT)
+
+        self._idf = {
+            term: math.log(1 + len(self.tables) / len(postings)) for term, postings in self._postings.items()
+        }
+        signature = repr(sorted((name, tuple(cols)) for name, cols in self.tables.items()))
+        signature += repr(sorted((t, sorted(r.items())) for t, r in self.references.items()))
+        self.fingerprint = hashlib.sha256(signature.encode("utf-8")).hexdigest()[:16]
+
+    def _add(self, table, terms, weight):
+        for term in terms - {"id"}:
+            postings = self._postings[term]
+            postings[table] = max(postings.get(table, 0.0), weight)
+
+    def score(self, question):
+        scores = defaultdict(float)
+        for term in question_words(question):
+            for table, weight in self._postings.get(term, {}).items():
+                scores[table] += weight * self._idf[term]
+        return scores
+
+    def search(self, question, k=None):
+        """Return the top-k tables for `question` followed by the tables needed to join them."""
+        k = SCHEMA_TOP_K if k is None else k
+        scores = self.score(question)
+        if not scores:
+            # Small schemas are cheap to send whole; large ones get nothing rather than noise.
+            return sorted(self.tables) if len(self.tables) <= k * 3 else []
+        ranked = sorted(scores, key=lambda t: (-scores[t], t))[:k]
+
+        selected = list(ranked)
+        chosen = set(ranked)
+        for table in ranked:
+            for ref_table, _ in self.references.get(table, {}).values():
+                if ref_table not in chosen and ref_table in self.tables:
+                    chosen.add(ref_table)
+                    selected.append(ref_table)
+        # Bridge tables (e.g. film_category) that reference two or more chosen tables.
+        for table, refs in self.references.items():
+            if table in chosen:
+                continue
+            if len({ref for ref, _ in refs.values()} & set(ranked)) >= 2:
+                chosen.add(table)
+                selected.append(table)
+        return selected
+
+    def render(self, tables):
+        """Schema lines in the same `- schema.table(col, ...)` form as the hand-written SCHEMAS text."""
+        lines = []
+        for name in tables:
+            line = f"    - {name}({', '.join(self.tables[name])})"
+            refs = self.references.get(name)
+            if refs:
+                joins = ", ".join(f"{col} -> {ref}.{ref_col}" for col, (ref, ref_col) in sorted(refs.items()))
+                line += f"  [joins: {joins}]"
+            comment = self.comments.get(name)
+            if comment:
+                line += "  -- " + re.sub(r"\s+", " ", comment).strip()
+            lines.append(line)
+        return "\n".join(lines)
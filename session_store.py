@@ -0,0 +1,217 @@
+import datetime
+import os
+import sys
+from array import array
+from collections import deque
+from decimal import Decimal
+
+SESSION_HISTORY_TURNS = int(os.getenv("session_history_turns", "50"))
+SESSION_MEMORY_BUDGET = int(os.getenv("session_memory_budget", str(4 * 1024 * 1024)))
+
+PENDING_RESPONSE = "🤖 Thinking..."
+
+
+def _column_kind(values):
+    """
+    Pick the storage for one column: int64/float64 arrays, dictionary-encoded text, or a
+    plain list. Decimal and mixed numeric columns stay a list so values come back exactly.
+    """
+    if not values or any(v is None for v in values):
+        return "list"
+    if all(isinstance(v, int) and not isinstance(v, bool) for v in values):
+        return "int" if all(-2**63 <= v < 2**63 for v in values) else "list"
+    if all(isinstance(v, float) for v in values):
+        return "float"
+    if all(isinstance(v, str) for v in values) and len(set(values)) * 2 <= len(values):
+        return "dict"
+    return "list"
+
+
+class ColumnarResult:
+    """
+    One query result stored column by column: integer and numeric columns as typed
+    arrays, repetitive text as dictionary codes. Rows are rebuilt on demand, so the
+    reformat path and the direct-answer prompt share this single copy.
+    """
+
+    __slots__ = ("question", "columns", "kinds", "data", "row_count", "trimmed")
+
+    def __init__(self, question, columns, rows):
+        self.question = question
+        self.columns = list(columns)
+        self.row_count = len(rows)
+        self.trimmed = False
+        self.kinds = []
+        self.data = []
+        for index in range(len(self.columns)):
+            values = [row[index] for row in rows]
+            kind = _column_kind(values)
+            self.kinds.append(kind)
+            if kind == "int":
+                self.data.append(array("q", values))
+            elif kind == "float":
+                self.data.append(array("d", values))
+            elif kind == "dict":
+                labels = list(dict.fromkeys(values))
+                codes = {label: i for i, label in enumerate(labels)}
+                self.data.append((labels, array("I", (codes[v] for v in values))))
+            else:
+                self.data.append(values)
+
+    def _column(self, index, limit):
+        kind, data = self.kinds[index], self.data[index]
+        if kind == "dict":
+            labels, codes = data
+            return [labels[code] for code in codes[:limit]]
+        return list(data[:limit])
+
+    def rows(self, limit=None):
+        limit = self.row_count if limit is None else min(limit, self.row_count)
+        columns = [self._column(i, limit) for i in range(len(self.columns))]
+        return [list(row) for row in zip(*columns)] if columns else [[] for _ in range(limit)]
+
+    def trim(self, row_count):
+        """Keep only the first `row_count` rows (used when the session is over its memory budget)."""
+        if row_count >= self.row_count:
+            return
+        for index, kind in enumerate(self.kinds):
+            if kind == "dict":
+                labels, codes = self.data[index]
+                self.data[index] = (labels, codes[:row_count])
+            else:
+                self.data[index] = self.data[index][:row_count]
+        self.row_count = row_count
+        self.trimmed = True
+
+    def nbytes(self):
+        size = sys.getsizeof(self.question) + sum(sys.getsizeof(c) for c in self.columns)
+        for kind, data in zip(self.kinds, self.data):
+            if kind in ("int", "float"):
+                size += data.itemsize * len(data) + 64
+            elif kind == "dict":
+                labels, codes = data
+                size += codes.itemsize * len(codes) + sum(sys.getsizeof(label) for label in labels)
+            else:
+                size += sys.getsizeof(data) + sum(_value_size(v) for v in data)
+        return size
+
+
+def _value_size(value):
+    if isinstance(value, (datetime.date, datetime.timedelta, Decimal)):
+        return 48
+    return sys.getsizeof(value)
+
+
+class SessionContext:
+    """
+    What query_agent reads and writes for a conversation: the last result (for reformat
+    requests and follow-ups) and the entities of the last answer. A bare instance is a
+    one-off context for stateless callers; SessionStore keeps the whole conversation.
+    """
+
+    last_result = None
+
+    def __init__(self):
+        self.entities = []
+
+
+class SessionStore(SessionContext):
+    """
+    Conversation state of one chat session: a ring buffer of the last `max_turns`
+    turns, the result of each turn in columnar form, and a memory budget. When the
+    session is over `memory_budget` bytes, result payloads are evicted oldest first;
+    the latest result is trimmed rather than dropped.
+    """
+
+    def __init__(self, max_turns=None, memory_budget=None):
+        self.max_turns = max_turns or SESSION_HISTORY_TURNS
+        self.memory_budget = memory_budget or SESSION_MEMORY_BUDGET
+        self.turns = deque(maxlen=self.max_turns)   # {"id", "user", "response", "result"}
+        super().__init__()
+        self.follow_up = ""
+        self.pending_prompt = ""
+        self.awaiting_refinement = False
+        self._next_id = 1   # a plain counter keeps the store picklable for server-side sessions
+        self.stats = {"results_evicted": 0, "results_trimmed": 0, "turns_dropped": 0}
+
+    def add_turn(self, user, response=PENDING_RESPONSE):
+        if len(self.turns) == self.turns.maxlen:
+            self.stats["turns_dropped"] += 1
+        turn = {"id": self._next_id, "user": user, "response": response, "result": None}
+        self._next_id += 1
+        self.turns.append(turn)
+        self.enforce_budget()
+        return turn
+
+    @property
+    def pending_turn(self):
+        if self.turns and self.turns[-1]["response"] == PENDING_RESPONSE:
+            return self.turns[-1]
+        return None
+
+    def history(self, exclude_pending=True):
+        """Turns as the chat_context list used by the prompts (oldest first)."""
+        turns = list(self.turns)
+        if exclude_pending and turns and turns[-1]["response"] == PENDING_RESPONSE:
+            turns = turns[:-1]
+        return turns
+
+    def set_response(self, response, turn=None):
+        turn = turn or self.turns[-1]
+        turn["response"] = response
+        self.enforce_budget()
+
+    def set_result(self, question, columns, rows, turn=None):
+        """Remember the rows of a turn (the latest one by default) for reformatting and follow-ups."""
+        if not self.turns:
+            self.add_turn(question, "")
+        turn = turn or self.turns[-1]
+        turn["result"] = ColumnarResult(question, columns, rows)
+        self.enforce_budget()
+        return turn["result"]
+
+    @property
+    def last_result(self):
+        for turn in reversed(self.turns):
+            if turn["result"] is not None:
+                return turn["result"]
+        return None
+
+    def clear(self):
+        self.turns.clear()
+        self.entities = []
+        self.follow_up = ""
+        self.pending_prompt = ""
+        self.awaiting_refinement = False
+
+    def nbytes(self):
+        size = 0
+        for turn in self.turns:
+            size += sys.getsizeof(turn["user"]) + sys.getsizeof(turn["response"]) + 200
+            if turn["result"] is not None:
+                size += turn["result"].nbytes()
+        return size
+
+    def enforce_budget(self):
+        size = self.nbytes()
+        if size <= self.memory_budget:
+            return
+        latest = self.last_result
+        for turn in self.turns:
+            result = turn["result"]
+            if result is None or result is latest:
+                continue
+            size -= result.nbytes()
+            turn["result"] = None
+            self.stats["results_evicted"] += 1
+            if size <= self.memory_budget:
+                return
+        if latest is not None and latest.row_count:
+            # Keep the share of rows that fits; the question and column names stay.
+            over = size - self.memory_budget
+            per_row = max(1, latest.nbytes() // latest.row_count)
+            latest.trim(max(0, latest.row_count - over // per_row - 1))
+            self.stats["results_trimmed"] += 1
+
+    def metrics(self):
+        return dict(self.stats, turns=len(self.turns), bytes=self.nbytes(), budget=self.memory_budget)
@@ -0,0 +1,110 @@
+import os
+import threading
+
+from tracing import current_span
+
+SINGLE_FLIGHT = os.getenv("single_flight", "1").lower() not in ("0", "false", "no")
+
+
+class _Call:
+    __slots__ = ("done", "result", "error", "waiters")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+def _copy(value):
+    """A shallow copy per caller, so one caller mutating its result cannot change another's."""
+    if isinstance(value, tuple):
+        return tuple(_copy(item) for item in value)
+    if isinstance(value, (list, dict)):
+        return type(value)(value)
+    return value
+
+
+class SingleFlight:
+    """
+    Collapse concurrent calls with the same key into one: the first caller runs the
+    function, callers arriving while it is in flight wait and get its result (or its
+    exception). Every caller gets its own shallow copy of lists and dicts in the result,
+    like the caches return. Nothing is kept once the call returns.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.stats = {"calls": 0, "executions": 0, "coalesced": 0, "errors": 0}
+
+    def do(self, key, fn, *args, **kwargs):
+        if not SINGLE_FLIGHT:
+            return fn(*args, **kwargs)
+        with self._lock:
+            self.stats["calls"] += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.stats["executions"] += 1
+            else:
+                call.waiters += 1
+                self.stats["coalesced"] += 1
+
+        if not leader:
+            current_span().set(coalesced=1)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return _copy(call.result)
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return _copy(call.result)
+        except BaseException as e:
+            call.error = e
+            with self._lock:
+                self.stats["errors"] += 1
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def metrics(self):
+        with self._lock:
+            return dict(self.stats, in_flight=len(self._calls))
+
+
+_groups = {}
+_groups_lock = threading.Lock()
+
+
+def single_flight(name):
+    """The shared SingleFlight group for one stage, created on first use."""
+    with _groups_lock:
+        group = _groups.get(name)
+        if group is None:
+            group = _groups[name] = SingleFlight(name)
+        return group
+
+
+def single_flight_metrics():
+    with _groups_lock:
+        groups = dict(_groups)
+    return {name: group.metrics() for name, group in groups.items()}
+
+
+def prometheus_lines():
+    """The coalescing counters of every group in the Prometheus text format."""
+    metrics = single_flight_metrics()
+    lines = [
+        "# HELP nl2sql_single_flight_coalesced_total Calls that waited for an identical in-flight call instead of running.",
+        "# TYPE nl2sql_single_flight_coalesced_total counter",
+    ]
+    lines += [f'nl2sql_single_flight_coalesced_total{{stage="{name}"}} {m["coalesced"]}' for name, m in sorted(metrics.items())]
+    lines.append("# TYPE nl2sql_single_flight_executions_total counter")
+    lines += [f'nl2sql_single_flight_executions_total{{stage="{name}"}} {m["executions"]}' for name, m in sorted(metrics.items())]
+    return lines
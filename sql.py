@@ -1,10 +1,30 @@
 import psycopg2
 import os
+import threading
+import uuid
+from contextlib import contextmanager
 from dotenv import load_dotenv
 import datetime
 
+from db_pool import ConnectionPool, pool_settings_from_env
+from query_templates import execute_prepared, prepared_statements_for
+from result_cache import ResultCache, estimate_size, is_read_only, referenced_tables
+from single_flight import single_flight
+from tracing import span
+
 load_dotenv()
 
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+_inherited_pools = []   # pools of a parent process, kept alive so their sockets are never closed here
+
+result_cache = ResultCache.from_env()
+
+STREAM_BATCH_SIZE = int(os.getenv("stream_batch_size", "500"))
+QUERY_MAX_ROWS = int(os.getenv("query_max_rows", "1000"))
+STATEMENT_TIMEOUT_MS = int(os.getenv("statement_timeout_ms", "30000"))
+
 def get_connection():
     return psycopg2.connect(
         host=os.getenv("hostname", "localhost"),
@@ -14,19 +34,173 @@ def get_connection():
         port=5432
     )
 
+def get_pool():
+    """Return the process-wide connection pool, creating it on first use (and again after a fork)."""
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is not None and _pool_pid == pid:
+        return _pool
+    with _pool_lock:
+        if _pool is None or _pool_pid != pid:
+            # Connections inherited from a parent process must not be reused, nor closed:
+            # closing them would end the parent's sessions, so the old pool is deliberately leaked.
+            if _pool is not None:
+                _inherited_pools.append(_pool)
+            _pool = ConnectionPool(get_connection, **pool_settings_from_env())
+            _pool_pid = pid
+        return _pool
+
+@contextmanager
+def pooled_connection():
+    with get_pool().connection() as conn:
+        yield conn
+
+def pool_metrics():
+    return get_pool().metrics()
+
+def set_statement_timeout(cur, timeout_ms=None):
+    """Limit the statements of the current transaction to `timeout_ms` (0 disables the limit)."""
+    timeout_ms = STATEMENT_TIMEOUT_MS if timeout_ms is None else timeout_ms
+    if timeout_ms:
+        cur.execute("SET LOCAL statement_timeout = %s", (int(timeout_ms),))
+
+def _record_result(s, columns, rows, cache_hit):
+    if s.recording:
+        s.set(cache_hit=cache_hit, rows=len(rows), result_bytes=estimate_size(columns or [], rows))
+
 def run_query(query):
-    try:
-        conn = get_connection()
+    with span("run_query") as s:
+        cached = result_cache.get(query)
+        if cached is not None:
+            _record_result(s, *cached, cache_hit=True)
+            return cached
+        try:
+            if is_read_only(query):
+                # Identical reads running at the same time share one execution.
+                columns, rows = single_flight("run_query").do(query, _fetch_all, query)
+                result_cache.put(query, columns, rows)
+            else:
+                columns, rows = _fetch_all(query)
+                result_cache.invalidate_tables(referenced_tables(query))
+            _record_result(s, columns, rows, cache_hit=False)
+            return columns, rows
+        except Exception as e:
+            print("❌ SQL Execution Error:", e)
+            raise
+
+def _fetch_all(query):
+    with pooled_connection() as conn:
         cur = conn.cursor()
-        cur.execute(query)
+        if not (is_read_only(query) and execute_prepared(conn, cur, query, setup=set_statement_timeout)):
+            set_statement_timeout(cur)
+            cur.execute(query)
         rows = cur.fetchall()
         columns = [desc[0] for desc in cur.description]
         cur.close()
-        conn.close()
-        return columns, rows
-    except Exception as e:
-        print("❌ SQL Execution Error:", e)
-        raise
+    return columns, rows
+
+def limited_query(query, limit=None):
+    """Wrap a read-only query so the planner can stop after `limit` rows (one extra to detect truncation)."""
+    limit = QUERY_MAX_ROWS + 1 if limit is None else limit
+    body = query.strip().rstrip(";")
+    return f"SELECT * FROM (\n{body}\n) AS limited LIMIT {int(limit)}"
+
+def _run_prepared_bounded(query, max_rows):
+    """
+    Bounded read through the connection's prepared statements. A server-side cursor
+    cannot DECLARE an EXECUTE, so the LIMIT keeps at most max_rows + 1 rows in memory
+    instead. Returns None when the query cannot run as a prepared statement.
+    """
+    with pooled_connection() as conn:
+        if prepared_statements_for(conn) is None:
+            return None
+        cur = conn.cursor()
+        try:
+            if not execute_prepared(conn, cur, limited_query(query, max_rows + 1), setup=set_statement_timeout):
+                return None
+            rows = cur.fetchall()
+            columns = [desc[0] for desc in cur.description]
+        finally:
+            cur.close()
+    return columns, rows[:max_rows], len(rows) > max_rows
+
+class QueryStream:
+    """
+    Iterate over the rows of a SELECT through a named server-side cursor,
+    fetching `batch_size` rows at a time and stopping after `max_rows`.
+    `columns` is set once the first batch arrives and `truncated` tells whether
+    rows were left unread.
+    """
+
+    def __init__(self, query, batch_size=None, max_rows=None):
+        self.query = query
+        self.batch_size = batch_size or STREAM_BATCH_SIZE
+        self.max_rows = max_rows
+        self.columns = None
+        self.row_count = 0
+        self.truncated = False
+
+    def __iter__(self):
+        with pooled_connection() as conn:
+            setup = conn.cursor()
+            set_statement_timeout(setup)
+            setup.close()
+            cur = conn.cursor(name=f"stream_{uuid.uuid4().hex}")
+            cur.itersize = self.batch_size
+            try:
+                cur.execute(self.query)
+                while True:
+                    batch = cur.fetchmany(self.batch_size)
+                    if self.columns is None and cur.description:
+                        self.columns = [desc[0] for desc in cur.description]
+                    if not batch:
+                        return
+                    for row in batch:
+                        if self.max_rows is not None and self.row_count >= self.max_rows:
+                            self.truncated = True
+                            return
+                        self.row_count += 1
+                        yield row
+            finally:
+                cur.close()
+
+def run_query_bounded(query, max_rows=None, batch_size=None):
+    """
+    Like run_query, but never holds more than `max_rows` rows in memory.
+    Returns (columns, rows, truncated).
+    """
+    max_rows = QUERY_MAX_ROWS if max_rows is None else max_rows
+    with span("run_query_bounded") as s:
+        cached = result_cache.get(query)
+        if cached is not None:
+            columns, rows = cached
+            _record_result(s, columns, rows[:max_rows], cache_hit=True)
+            return columns, rows[:max_rows], len(rows) > max_rows
+
+        if not is_read_only(query):
+            # Server-side cursors only accept SELECT/VALUES.
+            columns, rows = run_query(query)
+            return columns, rows[:max_rows], len(rows) > max_rows
+
+        try:
+            columns, rows, truncated = single_flight("run_query").do(
+                ("bounded", query, max_rows), _fetch_bounded, query, max_rows, batch_size)
+            if not truncated:
+                result_cache.put(query, columns, rows)
+            _record_result(s, columns, rows, cache_hit=False)
+            s.set(truncated=truncated)
+            return columns, rows, truncated
+        except Exception as e:
+            print("❌ SQL Execution Error:", e)
+            raise
+
+def _fetch_bounded(query, max_rows, batch_size=None):
+    prepared = _run_prepared_bounded(query, max_rows)
+    if prepared is not None:
+        return prepared
+    stream = QueryStream(query, batch_size=batch_size, max_rows=max_rows)
+    rows = list(stream)
+    return stream.columns, rows, stream.truncated
 
 def get_text_columns(schema=None, table=None):
     """Return all text/varchar columns in the database or filtered by schema/table."""
@@ -42,22 +216,19 @@ def get_text_columns(schema=None, table=None):
         query += f" AND table_name = '{table}'"
 
     try:
-        conn = get_connection()
-        cur = conn.cursor()
-        cur.execute(query)
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
+        with pooled_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(query)
+            rows = cur.fetchall()
+            cur.close()
         return rows
     except Exception as e:
         print("❌ Failed to fetch text columns:", e)
         return []
 
-def get_primary_key_column(schema, table):
-    """Returns the primary key column of a table if available, otherwise None."""
+def get_primary_key_columns(schema, table):
+    """Returns all primary key columns of a table in key order (empty if there is none)."""
     try:
-        conn = get_connection()
-        cur = conn.cursor()
         query = """
             SELECT kcu.column_name
             FROM information_schema.table_constraints tc
@@ -66,70 +237,235 @@ def get_primary_key_column(schema, table):
              AND tc.table_schema = kcu.table_schema
             WHERE tc.constraint_type = 'PRIMARY KEY'
               AND tc.table_schema = %s
-              AND tc.table_name = %s;
+              AND tc.table_name = %s
+            ORDER BY kcu.ordinal_position;
         """
-        cur.execute(query, (schema, table))
-        result = cur.fetchone()
-        cur.close()
-        conn.close()
-        return result[0] if result else None
+        with pooled_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(query, (schema, table))
+            rows = cur.fetchall()
+            cur.close()
+        return [row[0] for row in rows]
     except Exception as e:
         print(f"❌ Failed to get primary key for {schema}.{table}:", e)
-        return None
+        return []
+
+def get_primary_key_column(schema, table):
+    """Returns the primary key column of a table if available, otherwise None."""
+    columns = get_primary_key_columns(schema, table)
+    return columns[0] if columns else None
 
-def fix_encoding_for_column(schema, table, column, id_column="id", corruption_regex=None):
+def get_table_columns(schemas=None, tables=None):
+    """Return (schema, table, column, data_type) for every column, in ordinal order."""
+    query = """
+        SELECT table_schema, table_name, column_name, data_type
+        FROM information_schema.columns
+        WHERE table_schema NOT IN ('information_schema', 'pg_catalog')
     """
-    Fix encoding issues in a single column.
-    If corruption_regex is provided, it will filter values using it.
+    params = []
+    if schemas:
+        query += " AND table_schema = ANY(%s)"
+        params.append(list(schemas))
+    if tables:
+        query += " AND table_schema || '.' || table_name = ANY(%s)"
+        params.append(list(tables))
+    query += " ORDER BY table_schema, table_name, ordinal_position"
+
+    try:
+        with pooled_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(query, params)
+            rows = cur.fetchall()
+            cur.close()
+        return rows
+    except Exception as e:
+        print("❌ Failed to fetch table columns:", e)
+        return []
+
+def get_foreign_keys(schemas=None, tables=None):
+    """Return (schema, table, column, ref_schema, ref_table, ref_column) for every foreign key column."""
+    query = """
+        SELECT tc.table_schema, tc.table_name, kcu.column_name,
+               ccu.table_schema, ccu.table_name, ccu.column_name
+        FROM information_schema.table_constraints tc
+        JOIN information_schema.key_column_usage kcu
+          ON tc.constraint_name = kcu.constraint_name
+         AND tc.table_schema = kcu.table_schema
+        JOIN information_schema.constraint_column_usage ccu
+          ON tc.constraint_name = ccu.constraint_name
+         AND tc.constraint_schema = ccu.constraint_schema
+        WHERE tc.constraint_type = 'FOREIGN KEY'
     """
-    fixed_count = 0
+    params = []
+    if schemas:
+        query += " AND tc.table_schema = ANY(%s)"
+        params.append(list(schemas))
+    if tables:
+        query += " AND tc.table_schema || '.' || tc.table_name = ANY(%s)"
+        params.append(list(tables))
+
     try:
-        conn = get_connection()
-        cur = conn.cursor()
+        with pooled_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(query, params)
+            rows = cur.fetchall()
+            cur.close()
+        return rows
+    except Exception as e:
+        print("❌ Failed to fetch foreign keys:", e)
+        return []
 
-        full_table = f'"{schema}"."{table}"'
-        corruption_clause = f"WHERE {column} ~ '{corruption_regex}'" if corruption_regex else ""
+def get_comments(schemas=None, tables=None):
+    """Return (schema, table, column_or_None, comment) for every commented table and column."""
+    query = """
+        SELECT n.nspname, c.relname, NULL, obj_description(c.oid, 'pg_class')
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE c.relkind IN ('r', 'p', 'v', 'm')
+          AND obj_description(c.oid, 'pg_class') IS NOT NULL
+          AND n.nspname NOT IN ('information_schema', 'pg_catalog')
+          AND (%(schemas)s::text[] IS NULL OR n.nspname = ANY(%(schemas)s::text[]))
+          AND (%(tables)s::text[] IS NULL OR n.nspname || '.' || c.relname = ANY(%(tables)s::text[]))
+        UNION ALL
+        SELECT n.nspname, c.relname, a.attname, col_description(c.oid, a.attnum)
+        FROM pg_attribute a
+        JOIN pg_class c ON c.oid = a.attrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE a.attnum > 0 AND NOT a.attisdropped
+          AND c.relkind IN ('r', 'p', 'v', 'm')
+          AND col_description(c.oid, a.attnum) IS NOT NULL
+          AND n.nspname NOT IN ('information_schema', 'pg_catalog')
+          AND (%(schemas)s::text[] IS NULL OR n.nspname = ANY(%(schemas)s::text[]))
+          AND (%(tables)s::text[] IS NULL OR n.nspname || '.' || c.relname = ANY(%(tables)s::text[]));
+    """
+    try:
+        with pooled_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(query, {
+                "schemas": list(schemas) if schemas else None,
+                "tables": list(tables) if tables else None,
+            })
+            rows = cur.fetchall()
+            cur.close()
+        return rows
+    except Exception as e:
+        print("❌ Failed to fetch comments:", e)
+        return []
 
-        query = f"""
-            SELECT {id_column}, {column}
-            FROM {full_table}
-            {corruption_clause};
-        """
+def get_primary_keys(schemas=None, tables=None):
+    """Return (schema, table, column, position) for every primary key column of every table."""
+    query = """
+        SELECT tc.table_schema, tc.table_name, kcu.column_name, kcu.ordinal_position
+        FROM information_schema.table_constraints tc
+        JOIN information_schema.key_column_usage kcu
+          ON tc.constraint_name = kcu.constraint_name
+         AND tc.table_schema = kcu.table_schema
+         AND tc.table_name = kcu.table_name
+        WHERE tc.constraint_type = 'PRIMARY KEY'
+    """
+    params = []
+    if schemas:
+        query += " AND tc.table_schema = ANY(%s)"
+        params.append(list(schemas))
+    if tables:
+        query += " AND tc.table_schema || '.' || tc.table_name = ANY(%s)"
+        params.append(list(tables))
+    query += " ORDER BY tc.table_schema, tc.table_name, kcu.ordinal_position"
 
-        cur.execute(query)
-        rows = cur.fetchall()
+    try:
+        with pooled_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(query, params)
+            rows = cur.fetchall()
+            cur.close()
+        return rows
+    except Exception as e:
+        print("❌ Failed to fetch primary keys:", e)
+        return []
 
-        for row_id, bad_value in rows:
-            if not isinstance(bad_value, str):
-                continue
-            try:
-                fixed_value = bad_value.encode('latin1').decode('utf-8')
-                if fixed_value != bad_value:
-                    cur.execute(
-                        f"UPDATE {full_table} SET {column} = %s WHERE {id_column} = %s",
-                        (fixed_value, row_id)
-                    )
-                    fixed_count += 1
-            except UnicodeDecodeError:
-                continue 
-
-        conn.commit()
-        cur.close()
-        conn.close()
-        print(f"✅ Fixed {fixed_count} entries in {schema}.{table}.{column}")
+def get_table_signatures(schemas=None):
+    """
+    Return (schema, table, signature) where the signature changes whenever a table's
+    columns, types or constraints change. One cheap pg_catalog query for all tables.
+    """
+    query = """
+        SELECT n.nspname, c.relname,
+               md5(
+                   string_agg(
+                       a.attname || ':' || format_type(a.atttypid, a.atttypmod)
+                       || ':' || coalesce(col_description(c.oid, a.attnum), ''),
+                       ',' ORDER BY a.attnum
+                   )
+                   || '|' || coalesce((
+                       SELECT string_agg(con.conname || ':' || pg_get_constraintdef(con.oid), ',' ORDER BY con.conname)
+                       FROM pg_constraint con
+                       WHERE con.conrelid = c.oid
+                   ), '')
+                   || '|' || coalesce(obj_description(c.oid, 'pg_class'), '')
+               )
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+        WHERE c.relkind IN ('r', 'p', 'v', 'm')
+          AND n.nspname NOT IN ('information_schema', 'pg_catalog')
+    """
+    params = []
+    if schemas:
+        query += " AND n.nspname = ANY(%s)"
+        params.append(list(schemas))
+    query += " GROUP BY n.nspname, c.relname, c.oid"
+
+    try:
+        with pooled_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(query, params)
+            rows = cur.fetchall()
+            cur.close()
+        return rows
+    except Exception as e:
+        print("❌ Failed to fetch table signatures:", e)
+        return []
+
+def fix_encoding_for_column(schema, table, column, id_column="id", corruption_regex=None, dry_run=False,
+                            scan_mode=None, page_size=None, throttle=None, server_side=None):
+    """
+    Fix encoding issues in a single column.
+    If corruption_regex is provided, it will filter values using it.
+    `id_column` may be a list for composite keys, or None to use the table's primary key.
+    With server_side=True the values are converted inside Postgres and only counts come back.
+    """
+    # encoding_repair builds on this module, so it is imported on use.
+    from encoding_repair import REPAIR_SERVER_SIDE, repair_table, repair_table_in_database
+
+    if id_column is None:
+        pk_columns = get_primary_key_columns(schema, table)
+    elif isinstance(id_column, str):
+        pk_columns = [id_column]
+    else:
+        pk_columns = list(id_column)
+    server_side = REPAIR_SERVER_SIDE if server_side is None else server_side
+    if not pk_columns:
+        print(f"Skipping {schema}.{table} - no suitable primary key found.")
+        return 0
+
+    try:
+        options = {"dry_run": dry_run, "scan_mode": scan_mode, "page_size": page_size, "throttle": throttle}
+        if server_side:
+            report = repair_table_in_database(schema, table, [column], pk_columns, corruption_regex, **options)
+        else:
+            report = repair_table(schema, table, [column], pk_columns, corruption_regex, **options)
+        return report["fixed"][column]
     except Exception as e:
         print(f"❌ Error processing {schema}.{table}.{column}:", e)
+        return 0
 
-def fix_all_encoding_issues(corruption_regex="Ã|â€™|â€“|â€œ|â€|Ãƒ"):
+def fix_all_encoding_issues(corruption_regex="Ã|â€™|â€“|â€œ|â€|Ãƒ", dry_run=False, scan_mode=None, page_size=None,
+                            throttle=None, server_side=None):
     """
-    Run fix_encoding_for_column on all text/varchar/char columns in all tables.
+    Run the bulk repair on all text/varchar/char columns in all tables, one pass per table.
     `corruption_regex` can be changed or set to None for full scan.
     """
-    columns_info = get_text_columns()
-    for schema, table, column in columns_info:
-        id_column = get_primary_key_column(schema, table)
-        if id_column:
-            fix_encoding_for_column(schema, table, column, id_column, corruption_regex)
-        else:
-            print(f"Skipping {schema}.{table} - no suitable primary key found.")
+    from encoding_repair import fix_all_encoding_issues as repair_all
 
+    return repair_all(corruption_regex, dry_run=dry_run, scan_mode=scan_mode, page_size=page_size, throttle=throttle,
+                      server_side=server_side)
@@ -0,0 +1,365 @@
+import difflib
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from tracing import span
+
+SQL_VALIDATION = os.getenv("sql_validation", "1").lower() not in ("0", "false", "no")
+SQL_PARSE_CACHE_SIZE = int(os.getenv("sql_parse_cache_size", "1000"))
+
+TOKEN = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<comment>--[^\n]*|/\*.*?\*/)
+  | (?P<string>[eE]'(?:[^'\\]|\\.|'')*'|(?:[uU]&|[bBxXnN])?'(?:[^']|'')*')
+  | (?P<dollar>\$(?P<tag>[A-Za-z_]\w*)?\$.*?\$(?P=tag)?\$)
+  | (?P<quoted>(?:[uU]&)?"(?:[^"]|"")+")
+  | (?P<param>%s|%\(\w+\)s|\$\d+)
+  | (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<word>[A-Za-z_][\w$]*)
+  | (?P<punct>::|[(),;.\[\]])
+  | (?P<op>[-+*/<>=~!@#%^&|`?:]+)
+""", re.VERBOSE | re.DOTALL)
+
+KEYWORDS = {
+    "all", "and", "any", "array", "as", "asc", "between", "both", "by", "case", "cast", "cross", "current_date",
+    "current_time", "current_timestamp", "desc", "distinct", "else", "end", "except", "exists", "false", "fetch",
+    "filter", "first", "following", "for", "from", "full", "group", "having", "ilike", "in", "inner", "intersect",
+    "interval", "is", "join", "last", "lateral", "leading", "left", "like", "limit", "materialized", "natural",
+    "next", "not", "null", "nulls", "offset", "on", "only", "or", "order", "outer", "over", "partition",
+    "preceding", "range", "recursive", "right", "row", "rows", "select", "similar", "some", "tablesample", "then",
+    "ties", "trailing", "true", "unbounded", "union", "using", "values", "when", "where", "window", "with",
+}
+# A single statement starting with SELECT/WITH/VALUES can still write through a data-modifying
+# CTE, SELECT INTO or FOR UPDATE. These count as statements only where a statement can start
+# (see _write_verbs); elsewhere most are ordinary identifiers, e.g. a column named "update".
+WRITE_KEYWORDS = {
+    "alter", "copy", "create", "delete", "drop", "grant", "insert", "into", "merge", "revoke", "truncate", "update",
+}
+# Functions with side effects or access outside the database; not allowed in generated SQL.
+UNSAFE_FUNCTIONS = {
+    "dblink", "dblink_exec", "lo_export", "lo_import", "nextval", "pg_advisory_lock", "pg_cancel_backend",
+    "pg_ls_dir", "pg_read_binary_file", "pg_read_file", "pg_reload_conf", "pg_sleep", "pg_terminate_backend",
+    "set_config", "setval",
+}
+# "(" after these opens a subquery or an expression, not a function call.
+GROUPING_WORDS = KEYWORDS - {"cast", "current_date", "current_time", "current_timestamp", "filter", "over"}
+
+
+class InvalidSQL(Exception):
+    """Raised when generated SQL fails the local checks (syntax, read-only, unknown tables or columns)."""
+
+    def __init__(self, query, problems):
+        super().__init__("Invalid SQL: " + "; ".join(problems))
+        self.query = query
+        self.problems = list(problems)
+
+    def feedback(self):
+        """Text for the regeneration prompt: the rejected SQL and what is wrong with it."""
+        problems = "\n".join(f"- {problem}" for problem in self.problems)
+        return (
+            f"Your previous SQL for this question was rejected before running because it is invalid.\n"
+            f"Previous SQL:\n{self.query}\n"
+            f"Problems:\n{problems}\n"
+            "Write a single read-only SELECT that only uses the tables and columns listed in the schema."
+        )
+
+
+def tokenize(query):
+    """Split SQL into (kind, text) tokens without whitespace and comments; raise ValueError on stray characters."""
+    tokens = []
+    pos = 0
+    while pos < len(query):
+        match = TOKEN.match(query, pos)
+        if match is None:
+            char = query[pos]
+            what = "string literal" if char == "'" else "quoted identifier" if char == '"' else repr(char)
+            raise ValueError(f"unterminated {what} at position {pos}" if char in "'\"" else f"unexpected {what} at position {pos}")
+        kind = match.lastgroup if match.lastgroup != "tag" else "dollar"
+        if kind not in ("space", "comment"):
+            text = match.group()
+            tokens.append((kind, text.lower() if kind == "word" else text))
+        pos = match.end()
+    return tokens
+
+
+def canonicalize(tokens):
+    """
+    Render tokens as canonical SQL: keywords upper case, unquoted identifiers lower case,
+    one space between tokens and none around ".", "::" and inside brackets.
+    """
+    parts = []
+    previous = None
+    for kind, text in tokens:
+        out = text.upper() if kind == "word" and text in KEYWORDS else text
+        if previous is not None:
+            prev_kind, prev_text = previous
+            tight = (
+                text in (",", ")", "]", ".", "::")
+                or prev_text in ("(", "[", ".", "::")
+                or (text in ("(", "[") and prev_kind in ("word", "quoted") and prev_text not in GROUPING_WORDS)
+            )
+            if not tight:
+                parts.append(" ")
+        parts.append(out)
+        previous = (kind, text)
+    return "".join(parts)
+
+
+def _closing(tokens, start):
+    """Index of the ")" matching the "(" at `start`."""
+    depth = 0
+    for i in range(start, len(tokens)):
+        if tokens[i][1] == "(":
+            depth += 1
+        elif tokens[i][1] == ")":
+            depth -= 1
+            if depth == 0:
+                return i
+    return len(tokens) - 1
+
+
+def _name(token):
+    kind, text = token
+    return text[1:-1].replace('""', '"') if kind == "quoted" else text
+
+
+def _is_name(token):
+    return token[0] == "quoted" or (token[0] == "word" and token[1] not in KEYWORDS)
+
+
+def _cte_names(tokens):
+    names = set()
+    for i, (kind, text) in enumerate(tokens[1:], 1):
+        if not _is_name((kind, text)) or tokens[i - 1][1] not in ("with", "recursive", ","):
+            continue
+        j = i + 1
+        if j < len(tokens) and tokens[j][1] == "(":
+            j = _closing(tokens, j) + 1
+        if j + 1 < len(tokens) and tokens[j][1] == "as" and tokens[j + 1][1] in ("(", "not", "materialized"):
+            names.add(_name((kind, text)))
+    return names
+
+
+def _table_references(tokens):
+    """
+    Yield (position, schema or None, table, alias) for every table named in a FROM
+    list or JOIN. FROM inside a function call (EXTRACT(year FROM ...)) is skipped,
+    as are subqueries and set-returning functions, whose aliases get table None.
+    """
+    calls = []   # one flag per open "(": True when it is a function call
+    for i, (kind, text) in enumerate(tokens):
+        if text == "(":
+            previous = tokens[i - 1] if i else ("punct", "")
+            calls.append(previous[0] in ("word", "quoted") and previous[1] not in GROUPING_WORDS)
+        elif text == ")":
+            if calls:
+                calls.pop()
+        elif kind == "word" and text in ("from", "join") and not (calls and calls[-1]):
+            if text == "from" and i and tokens[i - 1][1] == "distinct":
+                continue   # IS [NOT] DISTINCT FROM
+            yield from _from_list(tokens, i + 1, many=text == "from")
+
+
+def _from_list(tokens, i, many):
+    while i < len(tokens):
+        while i < len(tokens) and tokens[i][1] in ("only", "lateral"):
+            i += 1
+        if i >= len(tokens):
+            return
+        position, schema, table = i, None, None
+        if tokens[i][1] == "(":
+            i = _closing(tokens, i) + 1
+        elif _is_name(tokens[i]):
+            table = _name(tokens[i])
+            i += 1
+            if i + 1 < len(tokens) and tokens[i][1] == "." and _is_name(tokens[i + 1]):
+                schema, table = table, _name(tokens[i + 1])
+                i += 2
+            if i < len(tokens) and tokens[i][1] == "(":
+                table = None   # set-returning function such as generate_series(...)
+                i = _closing(tokens, i) + 1
+        else:
+            return
+        alias = None
+        if i < len(tokens) and tokens[i][1] == "as":
+            i += 1
+        if i < len(tokens) and _is_name(tokens[i]):
+            alias = _name(tokens[i])
+            i += 1
+            if i < len(tokens) and tokens[i][1] == "(":
+                i = _closing(tokens, i) + 1
+        yield position, schema, table, alias
+        if not (many and i < len(tokens) and tokens[i][1] == ","):
+            return
+        i += 1
+
+
+def _write_verbs(tokens):
+    """
+    Write keywords in statement position: at the start, after ";" or opening the body of
+    a CTE (AS (...)), plus INTO, which is reserved and only appears in SELECT INTO.
+    """
+    verbs = set()
+    for i, (kind, text) in enumerate(tokens):
+        if kind != "word" or text not in WRITE_KEYWORDS:
+            continue
+        j = i - 1
+        while j >= 0 and tokens[j][1] == "(":
+            j -= 1
+        previous = tokens[j][1] if j >= 0 else None
+        if text == "into" or previous in (None, ";") or (j < i - 1 and previous in ("as", "materialized")):
+            verbs.add(text)
+    return verbs
+
+
+def check_tokens(tokens, catalog=None):
+    """Return the list of problems found in a tokenized statement (empty when it looks valid)."""
+    if not tokens:
+        return ["the query is empty"]
+    problems = []
+
+    depth = 0
+    for _, text in tokens:
+        depth += text == "("
+        depth -= text == ")"
+        if depth < 0:
+            break
+    if depth:
+        problems.append("unbalanced parentheses")
+
+    if any(text == ";" for _, text in tokens):
+        problems.append("only a single statement is allowed")
+    first = next((text for _, text in tokens if text != "("), "")
+    if first not in ("select", "with", "values"):
+        problems.append(f"only SELECT queries are allowed, not {first.upper() or 'this statement'}")
+    writes = sorted(_write_verbs(tokens))
+    for i, (kind, text) in enumerate(tokens[:-1]):
+        if kind == "word" and text == "for" and tokens[i + 1][1] in ("update", "share", "key", "no"):
+            writes.append("FOR UPDATE" if tokens[i + 1][1] == "update" else "FOR SHARE")
+            break
+    if writes:
+        problems.append(f"the query must be read-only (found {', '.join(w.upper() for w in writes)})")
+    unsafe = sorted({text for i, (kind, text) in enumerate(tokens[:-1])
+                     if kind == "word" and text in UNSAFE_FUNCTIONS and tokens[i + 1][1] == "("})
+    if unsafe:
+        problems.append(f"function(s) not allowed: {', '.join(unsafe)}")
+    if problems or catalog is None or not catalog.tables:
+        return problems
+
+    ctes = _cte_names(tokens)
+    schemas = list(catalog.schemas)
+    aliases = {}   # qualifier -> "schema.table", or None when it is not a catalog table
+    for _, schema, table, alias in _table_references(tokens):
+        full = None
+        if table is None or (schema is None and table in ctes):
+            pass
+        elif schema is not None:
+            if schema in schemas:
+                full = f"{schema}.{table}"
+                if full not in catalog.tables:
+                    problems.append(_unknown_table(full, catalog))
+                    full = None
+        else:
+            full = next((f"{s}.{table}" for s in schemas if f"{s}.{table}" in catalog.tables), None)
+            if full is None and not table.startswith("pg_"):
+                problems.append(_unknown_table(table, catalog))
+        qualifier = alias or table
+        if qualifier is not None:
+            # The same alias for different tables in two subqueries: do not guess which one is meant.
+            aliases[qualifier] = full if aliases.get(qualifier, full) == full else None
+
+    for i in range(len(tokens) - 2):
+        if tokens[i + 1][1] != "." or not _is_name(tokens[i]) or not _is_name(tokens[i + 2]):
+            continue
+        if i + 3 < len(tokens) and tokens[i + 3][1] in ("(", "."):
+            continue   # schema.function(...) or schema.table.column
+        if i and tokens[i - 1][1] == ".":
+            continue
+        full = aliases.get(_name(tokens[i]))
+        if full is None:
+            continue
+        column = _name(tokens[i + 2])
+        columns = [col for col, _ in catalog.tables[full]["columns"]]
+        if column not in columns:
+            hint = difflib.get_close_matches(column, columns, n=1)
+            suggestion = f" (did you mean {hint[0]}?)" if hint else ""
+            problems.append(f"column {column} does not exist in {full}{suggestion}")
+    return list(dict.fromkeys(problems))
+
+
+def _unknown_table(name, catalog):
+    short = name.split(".", 1)[-1]
+    hint = difflib.get_close_matches(short, [t.split(".", 1)[1] for t in catalog.tables], n=1)
+    return f"table {name} does not exist" + (f" (did you mean {hint[0]}?)" if hint else "")
+
+
+class SQLValidator:
+    """
+    Check generated SQL locally before it reaches the database: it must tokenize,
+    be a single read-only SELECT and only use tables and qualified columns that exist
+    in the schema catalog. Results (canonical text or problems) are memoized per
+    query text and catalog revision.
+    """
+
+    def __init__(self, max_entries=SQL_PARSE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._parsed = OrderedDict()   # (query, catalog key) -> (canonical, problems)
+        self.stats = {"validated": 0, "cache_hits": 0, "invalid": 0}
+
+    def _parse(self, query, catalog):
+        stripped = query.strip()
+        try:
+            tokens = tokenize(stripped)
+        except ValueError as e:
+            return None, [str(e)]
+        while tokens and tokens[-1][1] == ";":
+            tokens.pop()
+        problems = check_tokens(tokens, catalog)
+        return (None if problems else canonicalize(tokens)), problems
+
+    def validate(self, query, catalog=None):
+        """Return the canonical form of `query` or raise InvalidSQL."""
+        key = (query, id(catalog), getattr(catalog, "revision", None))
+        with span("validate_sql") as s:
+            with self._lock:
+                self.stats["validated"] += 1
+                entry = self._parsed.get(key)
+                if entry is not None:
+                    self._parsed.move_to_end(key)
+                    self.stats["cache_hits"] += 1
+            s.set(cache_hit=entry is not None)
+            if entry is None:
+                entry = self._parse(query, catalog)
+                with self._lock:
+                    self._parsed[key] = entry
+                    while len(self._parsed) > self.max_entries:
+                        self._parsed.popitem(last=False)
+            canonical, problems = entry
+            if problems:
+                with self._lock:
+                    self.stats["invalid"] += 1
+                s.set(valid=False)
+                raise InvalidSQL(query, problems)
+            s.set(valid=True)
+            return canonical
+
+    def metrics(self):
+        with self._lock:
+            return dict(self.stats, cached=len(self._parsed))
+
+
+sql_validator = SQLValidator()
+
+
+def validate_sql(query, catalog=None):
+    """Validate and canonicalize `query` with the process-wide validator; a no-op when sql_validation is off."""
+    if not SQL_VALIDATION:
+        return query
+    return sql_validator.validate(query, catalog)
+
+
+def validator_metrics():
+    return sql_validator.metrics()
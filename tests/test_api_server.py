@@ -0,0 +1,115 @@
+import http.client
+import json
+import threading
+
+import pytest
+
+import api_server
+from api_server import Admission, APIServer, Overloaded, SessionDB
+
+
+def fake_answer(session, question):
+    return {"answer": f"echo: {question}", "sql": None, "follow_up": None, "columns": None, "rows": None,
+            "truncated": False, "timings": {}}
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.setattr(api_server, "answer", fake_answer)
+    servers = []
+
+    def start(admission=None):
+        srv = APIServer(("127.0.0.1", 0), sessions=SessionDB(str(tmp_path / "sessions.db")), admission=admission)
+        threading.Thread(target=srv.serve_forever, daemon=True).start()
+        servers.append(srv)
+        return srv
+
+    yield start
+    for srv in servers:
+        srv.shutdown()
+        srv.server_close()
+
+
+def post(srv, path, body, conn=None):
+    conn = conn or http.client.HTTPConnection(*srv.server_address, timeout=5)
+    conn.request("POST", path, body=json.dumps(body), headers={"Content-Type": "application/json"})
+    response = conn.getresponse()
+    return response, json.loads(response.read())
+
+
+def test_ask_saves_the_turn(server):
+    srv = server()
+    response, body = post(srv, "/v1/ask", {"question": "hello", "session_id": "s1"})
+    assert response.status == 200 and body["answer"] == "echo: hello"
+    session, version = srv.sessions.load("s1")
+    assert version == 1 and [turn["user"] for turn in session.history()] == ["hello"]
+
+
+def test_conflicting_saves_return_409(server, monkeypatch):
+    srv = server()
+    monkeypatch.setattr(srv.sessions, "save", lambda *args: False)
+    response, body = post(srv, "/v1/ask", {"question": "hello", "session_id": "s1"})
+    assert response.status == 409 and "ask again" in body["error"]
+    assert srv.stats["save_conflicts"] == api_server.SAVE_ATTEMPTS and srv.stats["lost_turns"] == 1
+
+
+def test_a_lost_race_is_applied_to_the_newer_session(server, monkeypatch):
+    srv = server()
+    post(srv, "/v1/ask", {"question": "first", "session_id": "s1"})
+    save = srv.sessions.save
+    raced = []
+
+    def save_after_another_worker(session_id, session, version):
+        if not raced:
+            raced.append(1)
+            other, other_version = srv.sessions.load(session_id)
+            other.add_turn("from another worker", "answer")
+            assert save(session_id, other, other_version)
+        return save(session_id, session, version)
+
+    monkeypatch.setattr(srv.sessions, "save", save_after_another_worker)
+    response, _ = post(srv, "/v1/ask", {"question": "second", "session_id": "s1"})
+    assert response.status == 200 and srv.stats["save_conflicts"] == 1
+    session, version = srv.sessions.load("s1")
+    assert version == 3
+    assert [turn["user"] for turn in session.history()] == ["first", "from another worker", "second"]
+
+
+def test_full_queue_returns_503(server):
+    admission = Admission(max_active=1, max_queued=0, timeout=0.01)
+    srv = server(admission)
+    response, body = post(srv, "/v1/ask", {"question": "hello"})
+    assert response.status == 503 and "queue is full" in body["error"]
+    assert response.getheader("Retry-After") == "1"
+    assert admission.metrics()["rejected_full"] == 1
+
+
+def test_admission_times_out_when_every_slot_is_busy():
+    admission = Admission(max_active=1, max_queued=1, timeout=0.01)
+    admission.acquire()
+    with pytest.raises(Overloaded, match="no worker free"):
+        admission.acquire()
+    admission.release()
+    admission.acquire()
+    metrics = admission.metrics()
+    assert metrics["admitted"] == 2 and metrics["rejected_timeout"] == 1 and metrics["queued"] == 0
+
+
+def test_unknown_route_keeps_the_connection_usable(server):
+    srv = server()
+    conn = http.client.HTTPConnection(*srv.server_address, timeout=5)
+    response, _ = post(srv, "/v1/nope", {"question": "x" * 1000}, conn)
+    assert response.status == 404
+    response, body = post(srv, "/v1/ask", {"question": "hello"}, conn)
+    assert response.status == 200 and body["answer"] == "echo: hello"
+
+
+def test_session_db_versions(tmp_path):
+    sessions = SessionDB(str(tmp_path / "sessions.db"))
+    session, version = sessions.load("s1")
+    assert version == 0
+    assert sessions.save("s1", session, 0)
+    assert not sessions.save("s1", session, 0)
+    assert sessions.save("s1", session, 1)
+    assert not sessions.save("s1", session, 1)
+    assert sessions.delete("s1") and sessions.load("s1")[1] == 0
@@ -0,0 +1,65 @@
+import json
+
+import batch
+from nl_cache import normalize_question
+
+
+def write_lines(path, lines):
+    path.write_text("".join(lines), encoding="utf-8")
+
+
+def record(question, status="ok", answer="done"):
+    return json.dumps({"key": normalize_question(question), "status": status, "answer": answer}) + "\n"
+
+
+def test_completed_keys_retries_errors_and_failed_answers(tmp_path):
+    output = tmp_path / "out.jsonl"
+    write_lines(output, [
+        record("answered"),
+        record("rejected", status="rejected", answer="❌ not allowed"),
+        record("errored", status="error", answer=None),
+        record("gemini failed", answer="Gemini error: 503 overloaded"),
+        record("format failed", answer="Error formatting response: timeout"),
+        '{"key": "cut short", "sta',
+    ])
+    assert batch.completed_keys(str(output)) == {normalize_question("answered"), normalize_question("rejected")}
+
+
+def test_completed_keys_of_missing_file(tmp_path):
+    assert batch.completed_keys(str(tmp_path / "missing.jsonl")) == set()
+
+
+def test_run_resumes_after_an_interrupted_run(tmp_path, monkeypatch):
+    questions = tmp_path / "questions.jsonl"
+    write_lines(questions, [
+        '{"id": 1, "question": "Answered"}\n',
+        '{"id": 2, "question": "Errored"}\n',
+        '"New one"\n',
+        '{"id": 4, "question": "answered "}\n',
+    ])
+    output = tmp_path / "out.jsonl"
+    write_lines(output, [record("answered"), record("errored", status="error", answer=None), '{"key": "new'])
+
+    asked = []
+
+    def answer(self, key, question, ids):
+        asked.append(question)
+        return {"key": key, "ids": ids, "question": question, "status": "ok", "answer": "fresh"}
+
+    monkeypatch.setattr(batch.BatchRunner, "answer", answer)
+    stats = batch.BatchRunner(llm_concurrency=1, db_concurrency=1).run(str(questions), str(output))
+
+    assert sorted(asked) == ["Errored", "New one"]
+    assert stats["questions"] == 4 and stats["unique"] == 3 and stats["skipped"] == 1
+    lines = output.read_text(encoding="utf-8").splitlines()
+    assert lines[2] == '{"key": "new'   # the cut-short line is left alone, new records start on a fresh line
+    assert batch.completed_keys(str(output)) == {normalize_question(q) for q in ("answered", "errored", "new one")}
+
+
+def test_failed_gemini_answer_is_an_error(monkeypatch):
+    monkeypatch.setattr(batch.query_agent, "english_to_guarded_sql", lambda question, **kwargs: {"sql": None})
+    monkeypatch.setattr(batch.query_agent, "gemini_direct_answer",
+                        lambda question, **kwargs: "Gemini error: 429 quota exceeded")
+    result = batch.BatchRunner().answer("hello", "Hello", [1])
+    assert result["status"] == "error"
+    assert "429 quota exceeded" in result["error"]
@@ -0,0 +1,44 @@
+import pytest
+
+from result_cache import is_read_only, normalize_sql, referenced_tables
+
+
+@pytest.mark.parametrize("query", [
+    "select * from orders",
+    "  WITH x AS (select 1) select * from x",
+    "select 'delete from orders' as note from orders",
+])
+def test_read_only(query):
+    assert is_read_only(query)
+
+
+@pytest.mark.parametrize("query", [
+    "delete from orders",
+    "with x as (delete from orders returning *) select * from x",
+    "select * from orders for update",
+    "select nextval('s'); drop table orders",
+])
+def test_not_read_only(query):
+    assert not is_read_only(query)
+
+
+def test_referenced_tables():
+    query = 'select * from orders o join sales."Items" i on i.order_id = o.id where o.note = \'from x\''
+    assert referenced_tables(query) == {"public.orders", "sales.items"}
+
+
+def test_referenced_tables_with_aliases_in_a_from_list():
+    query = "select * from orders o, customers AS c, regions where c.id = o.customer_id"
+    assert referenced_tables(query) == {"public.orders", "public.customers", "public.regions"}
+
+
+def test_referenced_tables_of_writes():
+    assert referenced_tables("update stock set n = 0") == {"public.stock"}
+    assert referenced_tables("insert into audit.log select * from events", default_schema="app") == {
+        "audit.log", "app.events",
+    }
+    assert referenced_tables("truncate table orders") == {"public.orders"}
+
+
+def test_normalize_sql_keeps_literals():
+    assert normalize_sql("select  *\n from t where a = 'x   y' ;") == "select * from t where a = 'x   y'"
@@ -0,0 +1,58 @@
+import pickle
+
+from session_store import ColumnarResult, SessionStore
+
+
+def rows(n, label="north"):
+    return [(i, float(i) / 2, label, f"note {i}") for i in range(n)]
+
+
+COLUMNS = ["id", "amount", "region", "note"]
+
+
+def test_columnar_result_round_trip():
+    result = ColumnarResult("q", COLUMNS, rows(5))
+    assert result.kinds[:2] == ["int", "float"]
+    assert result.rows() == [list(row) for row in rows(5)]
+    assert result.rows(limit=2) == [list(row) for row in rows(2)]
+
+
+def test_enforce_budget_evicts_older_results_first():
+    session = SessionStore(memory_budget=10 ** 9)
+    for question in ("first", "second", "third"):
+        session.add_turn(question, "answer")
+        session.set_result(question, COLUMNS, rows(200))
+    budget = session.nbytes() - session.turns[0]["result"].nbytes() + 1
+    session.memory_budget = budget
+    session.enforce_budget()
+
+    assert [turn["result"] is None for turn in session.turns] == [True, False, False]
+    assert session.stats["results_evicted"] == 1
+    assert session.stats["results_trimmed"] == 0
+    assert session.nbytes() <= budget
+
+
+def test_enforce_budget_trims_the_latest_result_instead_of_dropping_it():
+    session = SessionStore(memory_budget=10 ** 9)
+    session.add_turn("older", "answer")
+    session.set_result("older", COLUMNS, rows(100))
+    session.add_turn("latest", "answer")
+    session.set_result("latest", COLUMNS, rows(1000))
+    session.memory_budget = session.nbytes() // 4
+    session.enforce_budget()
+
+    latest = session.last_result
+    assert session.turns[0]["result"] is None
+    assert latest.question == "latest" and latest.trimmed
+    assert 0 < latest.row_count < 1000
+    assert latest.rows(limit=3) == [list(row) for row in rows(3)]
+    assert session.nbytes() <= session.memory_budget
+
+
+def test_ring_buffer_and_pickling():
+    session = SessionStore(max_turns=2)
+    for question in ("a", "b", "c"):
+        session.add_turn(question, "answer")
+    assert [turn["user"] for turn in session.history()] == ["b", "c"]
+    assert session.stats["turns_dropped"] == 1
+    assert pickle.loads(pickle.dumps(session)).history() == session.history()
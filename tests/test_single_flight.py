@@ -0,0 +1,89 @@
+import threading
+import time
+
+import pytest
+
+import single_flight
+from single_flight import SingleFlight
+
+
+@pytest.fixture(autouse=True)
+def enabled(monkeypatch):
+    monkeypatch.setattr(single_flight, "SINGLE_FLIGHT", True)
+
+
+def run_concurrently(group, key, fn, callers):
+    """Start `callers` threads on group.do(key, fn) while fn is blocked; return their results."""
+    results, errors = [None] * callers, []
+
+    def call(index):
+        try:
+            results[index] = group.do(key, fn)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(callers)]
+    for thread in threads:
+        thread.start()
+    return threads, results, errors
+
+
+def wait_for_waiters(group, key, count):
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        with group._lock:
+            call = group._calls.get(key)
+            if call is not None and call.waiters == count:
+                return
+        time.sleep(0.001)
+    pytest.fail(f"{count} callers never waited on {key!r}")
+
+
+def test_concurrent_calls_share_one_execution_with_isolated_copies():
+    group = SingleFlight("test")
+    release = threading.Event()
+    executions = []
+
+    def fn():
+        executions.append(1)
+        release.wait(5)
+        return ["sql", {"rows": 1}], ("columns", ["a"])
+
+    threads, results, errors = run_concurrently(group, "q", fn, 4)
+    wait_for_waiters(group, "q", 3)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert not errors and len(executions) == 1
+    assert group.metrics() == {"calls": 4, "executions": 1, "coalesced": 3, "errors": 0, "in_flight": 0}
+    first, second = results[0], results[1]
+    assert first == second
+    first[0].append("changed")
+    first[1][1].append("b")
+    assert second == (["sql", {"rows": 1}], ("columns", ["a"]))
+
+
+def test_waiters_get_the_leader_exception():
+    group = SingleFlight("test")
+    release = threading.Event()
+
+    def fn():
+        release.wait(5)
+        raise RuntimeError("boom")
+
+    threads, results, errors = run_concurrently(group, "q", fn, 3)
+    wait_for_waiters(group, "q", 2)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert [str(e) for e in errors] == ["boom"] * 3
+    assert group.metrics()["errors"] == 1 and group.metrics()["in_flight"] == 0
+
+
+def test_sequential_calls_are_not_cached():
+    group = SingleFlight("test")
+    assert group.do("q", lambda: [1]) == [1]
+    assert group.do("q", lambda: [2]) == [2]
+    assert group.metrics()["executions"] == 2
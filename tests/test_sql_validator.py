@@ -0,0 +1,78 @@
+from types import SimpleNamespace
+
+import pytest
+
+from sql_validator import InvalidSQL, SQLValidator, canonicalize, check_tokens, tokenize
+
+CATALOG = SimpleNamespace(
+    schemas=["public"],
+    tables={"public.orders": {"columns": [("id", "integer"), ("status", "text"), ("update", "text")]}},
+    revision=1,
+)
+
+
+def kinds(query):
+    return [kind for kind, _ in tokenize(query)]
+
+
+def test_tokenize_string_forms():
+    tokens = tokenize(r"select E'it\'s', U&'d\0061t', x'1F', 'a''b', U&" + '"col"')
+    assert [text for kind, text in tokens if kind in ("string", "quoted")] == [
+        r"E'it\'s'", r"U&'d\0061t'", "x'1F'", "'a''b'", 'U&"col"',
+    ]
+
+
+def test_tokenize_drops_comments_and_keeps_dollar_quotes_and_params():
+    assert kinds("select $$a;b$$ -- note\n, %s, $1") == ["word", "dollar", "punct", "param", "punct", "param"]
+
+
+def test_tokenize_rejects_unterminated_string():
+    with pytest.raises(ValueError, match="unterminated"):
+        tokenize("select 'abc")
+
+
+def test_canonical_output():
+    tokens = tokenize("select  o.id ,COUNT( * )from orders o  where o.status='New'  -- latest\n")
+    assert canonicalize(tokens) == "SELECT o.id, count(*) FROM orders o WHERE o.status = 'New'"
+
+
+def test_canonical_output_keeps_literals_intact():
+    query = r"SELECT E'it\'s', U&'d!0061t' uescape '!' FROM orders"
+    assert canonicalize(tokenize(query)) == query
+
+
+@pytest.mark.parametrize("query, problem", [
+    ("delete from orders", "only SELECT queries are allowed"),
+    ("select 1; drop table orders", "only a single statement is allowed"),
+    ("with x as (delete from orders returning *) select * from x", "found DELETE"),
+    ("with x as materialized (update orders set status = 'a' returning *) select * from x", "found UPDATE"),
+    ("select * into copy_of_orders from orders", "found INTO"),
+    ("select * from orders for update", "found FOR UPDATE"),
+    ("select * from orders for no key update", "found FOR SHARE"),
+    ("select pg_sleep(10)", "function(s) not allowed"),
+    ("select (1", "unbalanced parentheses"),
+])
+def test_rejects(query, problem):
+    problems = check_tokens(tokenize(query))
+    assert any(problem in p for p in problems), problems
+
+
+def test_write_keywords_as_identifiers_are_allowed():
+    assert check_tokens(tokenize("select o.update, o.status from orders o where o.update is not null"), CATALOG) == []
+
+
+def test_catalog_checks():
+    problems = check_tokens(tokenize("select o.stauts from orderz o"), CATALOG)
+    assert problems == ["table orderz does not exist (did you mean orders?)"]
+    problems = check_tokens(tokenize("select o.stauts from orders o"), CATALOG)
+    assert problems == ["column stauts does not exist in public.orders (did you mean status?)"]
+
+
+def test_validator_caches_and_raises():
+    validator = SQLValidator()
+    assert validator.validate("select id from orders", CATALOG) == "SELECT id FROM orders"
+    assert validator.validate("select id from orders", CATALOG) == "SELECT id FROM orders"
+    with pytest.raises(InvalidSQL) as e:
+        validator.validate("drop table orders", CATALOG)
+    assert "drop table orders" in e.value.feedback()
+    assert validator.metrics()["cache_hits"] == 1
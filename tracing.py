@@ -0,0 +1,278 @@
+import contextvars
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+TRACE_SAMPLE_RATE = float(os.getenv("trace_sample_rate", "1"))
+TRACE_JSONL_PATH = os.getenv("trace_jsonl_path") or None
+METRICS_PORT = int(os.getenv("metrics_port", "0"))
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Numeric span attributes that are summed into counters per stage.
+COUNTERS = {
+    "prompt_tokens": "Prompt tokens sent to the model.",
+    "response_tokens": "Response tokens received from the model.",
+    "rows": "Rows returned by the database.",
+    "result_bytes": "Approximate in-memory size of query results.",
+    "coalesced": "Calls that waited for an identical in-flight call.",
+}
+
+_current = contextvars.ContextVar("trace_span", default=None)
+
+
+class Span:
+    """One timed stage of a request. Attributes are set with span.set(key=value)."""
+
+    recording = True
+
+    def __init__(self, name, trace_id, parent_id, finished):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attrs = {}
+        self.error = None
+        self.started_at = time.time()
+        self.duration = None
+        self._start = time.perf_counter()
+        self._finished = finished      # shared by all spans of the trace
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": round(self.started_at, 6),
+            "duration_ms": round(self.duration * 1000, 3),
+            "attrs": self.attrs,
+            "error": self.error,
+        }
+
+
+class _NoopSpan:
+    """Stands in for every span of an unsampled request, so instrumentation costs almost nothing."""
+
+    recording = False
+
+    def set(self, **attrs):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Tracer:
+    """
+    Records nested spans per request. A request (root span) is sampled with
+    probability `sample_rate`; its spans are aggregated into per-stage duration
+    histograms and counters and, if `jsonl_path` is set, appended there one span
+    per line when the request finishes.
+    """
+
+    def __init__(self, sample_rate=1.0, jsonl_path=None):
+        self.sample_rate = sample_rate
+        self.jsonl_path = jsonl_path
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._recent = deque(maxlen=20)
+        self.stats = {"traces": 0, "sampled": 0, "spans": 0, "export_errors": 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(sample_rate=TRACE_SAMPLE_RATE, jsonl_path=TRACE_JSONL_PATH)
+
+    @contextmanager
+    def span(self, name, **attrs):
+        parent = _current.get()
+        if parent is None:
+            sampled = self.sample_rate >= 1 or random.random() < self.sample_rate
+            with self._lock:
+                self.stats["traces"] += 1
+                self.stats["sampled"] += int(sampled)
+            if not sampled:
+                _current.set(NOOP_SPAN)
+                try:
+                    yield NOOP_SPAN
+                finally:
+                    _current.set(None)
+                return
+            span = Span(name, uuid.uuid4().hex[:16], None, [])
+        elif not parent.recording:
+            yield NOOP_SPAN
+            return
+        else:
+            span = Span(name, parent.trace_id, parent.span_id, parent._finished)
+
+        span.attrs.update(attrs)
+        _current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = type(e).__name__
+            raise
+        finally:
+            # set() rather than reset(token): a streaming generator may be closed from another context.
+            _current.set(parent)
+            span.duration = time.perf_counter() - span._start
+            self._record(span)
+            if span.parent_id is None:
+                self._export(span._finished)
+
+    def _record(self, span):
+        with self._lock:
+            self.stats["spans"] += 1
+            stage = self._stages.get(span.name)
+            if stage is None:
+                stage = self._stages[span.name] = {
+                    "count": 0, "sum": 0.0, "errors": 0, "buckets": [0] * len(DURATION_BUCKETS),
+                    "cache_hits": 0, "cache_misses": 0, **dict.fromkeys(COUNTERS, 0),
+                }
+            stage["count"] += 1
+            stage["sum"] += span.duration
+            stage["errors"] += int(span.error is not None)
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if span.duration <= bound:
+                    stage["buckets"][i] += 1
+            for key in COUNTERS:
+                value = span.attrs.get(key)
+                if isinstance(value, (int, float)):
+                    stage[key] += value
+            if "cache_hit" in span.attrs:
+                stage["cache_hits" if span.attrs["cache_hit"] else "cache_misses"] += 1
+            span._finished.append(span)
+
+    def _export(self, spans):
+        records = [span.to_dict() for span in spans]
+        with self._lock:
+            self._recent.append(records)
+        if not self.jsonl_path:
+            return
+        try:
+            lines = "".join(json.dumps(record, default=str) + "\n" for record in records)
+            with self._lock, open(self.jsonl_path, "a", encoding="utf-8") as f:
+                f.write(lines)
+        except OSError as e:
+            with self._lock:
+                self.stats["export_errors"] += 1
+            print("❌ Failed to write trace spans:", e)
+
+    def metrics(self):
+        with self._lock:
+            stages = {name: dict(stage, buckets=list(stage["buckets"])) for name, stage in self._stages.items()}
+            stats = dict(self.stats, sample_rate=self.sample_rate)
+            recent = list(self._recent)[-5:]
+        for stage in stages.values():
+            stage["avg_ms"] = round(stage["sum"] / stage["count"] * 1000, 2) if stage["count"] else 0.0
+        return {"stats": stats, "stages": stages, "recent": recent}
+
+    def prometheus_text(self):
+        """Render the aggregated spans in the Prometheus text exposition format."""
+        with self._lock:
+            stages = {name: dict(stage, buckets=list(stage["buckets"])) for name, stage in self._stages.items()}
+            stats = dict(self.stats)
+
+        lines = [
+            "# HELP nl2sql_stage_duration_seconds Duration of traced pipeline stages (sampled requests only).",
+            "# TYPE nl2sql_stage_duration_seconds histogram",
+        ]
+        for name, stage in sorted(stages.items()):
+            for bound, count in zip(DURATION_BUCKETS, stage["buckets"]):
+                lines.append(f'nl2sql_stage_duration_seconds_bucket{{stage="{name}",le="{bound:g}"}} {count}')
+            lines.append(f'nl2sql_stage_duration_seconds_bucket{{stage="{name}",le="+Inf"}} {stage["count"]}')
+            lines.append(f'nl2sql_stage_duration_seconds_sum{{stage="{name}"}} {stage["sum"]:.6f}')
+            lines.append(f'nl2sql_stage_duration_seconds_count{{stage="{name}"}} {stage["count"]}')
+
+        counters = {"errors": "Stages that raised an exception.",
+                    "cache_hits": "Stages answered from a cache.",
+                    "cache_misses": "Stages that missed their cache."}
+        counters.update(COUNTERS)
+        for key, help_text in counters.items():
+            metric = f"nl2sql_{key}_total"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            for name, stage in sorted(stages.items()):
+                lines.append(f'{metric}{{stage="{name}"}} {stage[key]}')
+
+        lines.append("# HELP nl2sql_traces_total Requests seen by the tracer, sampled or not.")
+        lines.append("# TYPE nl2sql_traces_total counter")
+        lines.append(f"nl2sql_traces_total {stats['traces']}")
+        lines.append("# TYPE nl2sql_traces_sampled_total counter")
+        lines.append(f"nl2sql_traces_sampled_total {stats['sampled']}")
+        lines.append("# TYPE nl2sql_trace_sample_rate gauge")
+        lines.append(f"nl2sql_trace_sample_rate {self.sample_rate:g}")
+        return "\n".join(lines) + "\n"
+
+
+tracer = Tracer.from_env()
+
+
+def span(name, **attrs):
+    """Time a stage: `with span("run_query") as s: ...; s.set(rows=len(rows))`."""
+    return tracer.span(name, **attrs)
+
+
+def current_span():
+    """The innermost active span, or a no-op span outside of a (sampled) request."""
+    return _current.get() or NOOP_SPAN
+
+
+def trace_metrics():
+    return tracer.metrics()
+
+
+def _metrics_handler():
+    # http.server is imported here, so importing tracing (and the agent) stays cheap.
+    from http.server import BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+                self.send_error(404)
+                return
+            from single_flight import prometheus_lines
+
+            body = (tracer.prometheus_text() + "\n".join(prometheus_lines()) + "\n").encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MetricsHandler
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(port=None, host="127.0.0.1"):
+    """Serve /metrics on `port` (default: metrics_port) from a daemon thread; a no-op once started or when unset."""
+    global _server
+    port = METRICS_PORT if port is None else port
+    if not port:
+        return None
+    with _server_lock:
+        if _server is None:
+            from http.server import ThreadingHTTPServer
+
+            try:
+                _server = ThreadingHTTPServer((host, port), _metrics_handler())
+            except OSError as e:
+                # Another process (e.g. a second Streamlit worker) already serves this port.
+                print(f"❌ Metrics endpoint not started on port {port}:", e)
+                return None
+            threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+            print(f"✅ Metrics available at http://{host}:{port}/metrics")
+        return _server